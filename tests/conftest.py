@@ -1 +1,5 @@
-pytest_plugins = ["tests.fixtures.compile_error_programs", "tests.fixtures.programs"]
+pytest_plugins = [
+    "tests.fixtures.acoustic_models",
+    "tests.fixtures.compile_error_programs",
+    "tests.fixtures.programs",
+]
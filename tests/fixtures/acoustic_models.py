@@ -0,0 +1,27 @@
+import pytest
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import token_encoding
+
+
+@pytest.fixture(scope="session")
+def tiny_wav2vec2() -> Wav2Vec2ForCTC:
+    "A randomly initialized wav2vec2 small enough to run in tests"
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        vocab_size=token_encoding.n_tokens,
+        conv_dim=(32,) * 7,
+        num_conv_pos_embeddings=16,
+    )
+    return Wav2Vec2ForCTC(config).eval()
+
+
+@pytest.fixture(autouse=True)
+def no_tuned_configs(monkeypatch, tmp_path_factory):
+    "Keep configurations saved by autotune on this machine out of the tests"
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path_factory.mktemp("config")))
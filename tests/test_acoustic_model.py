@@ -0,0 +1,263 @@
+import copy
+import time
+import wave
+from dataclasses import replace
+
+import numpy as np
+import pytest
+import torch
+from transformers import Wav2Vec2FeatureExtractor, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.benchmark import (
+    agreement,
+    compare,
+    edit_distance,
+    format_accuracy,
+    load_audio_set,
+    processor_model,
+    score_audio_set,
+)
+from vocoder.acoustic_models.wav2vec2 import (
+    AcousticModel,
+    ModelConfig,
+    ReleasingModel,
+    bfloat16_supported,
+    load_model,
+    mmap_weights,
+    quantize,
+    receptive_field,
+    stand_in_model,
+    token_encoding,
+    weights_path,
+    windows,
+)
+
+
+@pytest.fixture
+def audio() -> torch.Tensor:
+    rng = np.random.default_rng(0)
+    return torch.from_numpy(rng.uniform(-0.2, 0.2, (1, 16000)).astype(np.float32))
+
+
+def test_log_probabilities(tiny_wav2vec2: Wav2Vec2ForCTC, audio: torch.Tensor):
+    model = AcousticModel(tiny_wav2vec2, token_encoding)
+    original = audio.clone()
+    ctc = model(audio)
+
+    assert ctc.dtype == np.float32 and ctc.flags.c_contiguous
+    assert ctc.shape == (49, token_encoding.n_tokens)
+    assert np.allclose(np.logaddexp.reduce(ctc, axis=1), 0, atol=1e-5)
+    assert torch.equal(audio, original)
+
+
+def test_matches_processor(tiny_wav2vec2: Wav2Vec2ForCTC, audio: torch.Tensor):
+    baseline = processor_model(
+        tiny_wav2vec2, Wav2Vec2FeatureExtractor(do_normalize=True)
+    )
+    model = AcousticModel(tiny_wav2vec2, token_encoding)
+    # the second call reuses the scratch buffer for shorter audio
+    for x in [audio, audio[:, :8000]]:
+        expected = torch.log_softmax(torch.from_numpy(baseline(x)), -1).numpy()
+        assert np.allclose(model(x), expected, atol=1e-4)
+
+
+def test_compare(tiny_wav2vec2: Wav2Vec2ForCTC):
+    model = AcousticModel(tiny_wav2vec2, token_encoding)
+    table = compare({"a": model, "b": model}, durations=(0.5,), repeats=1)
+    assert len(table.splitlines()) == 3
+
+
+def test_quantize(tiny_wav2vec2: Wav2Vec2ForCTC, audio: torch.Tensor):
+    quantized = quantize(copy.deepcopy(tiny_wav2vec2))
+    assert not any(type(m) is torch.nn.Linear for m in quantized.modules())
+
+    ctc = AcousticModel(quantized, token_encoding)(audio)
+    expected = AcousticModel(tiny_wav2vec2, token_encoding)(audio)
+    assert ctc.dtype == np.float32 and ctc.shape == expected.shape
+    assert np.allclose(np.logaddexp.reduce(ctc, axis=1), 0, atol=1e-5)
+
+
+def test_accuracy_report(tiny_wav2vec2: Wav2Vec2ForCTC, tmp_path):
+    rng = np.random.default_rng(0)
+    for name in ["a", "b"]:
+        with wave.open(str(tmp_path / f"{name}.wav"), "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(rng.integers(-3000, 3000, 8000, dtype=np.int16).tobytes())
+    audio_set = load_audio_set(tmp_path)
+    assert list(audio_set) == ["a", "b"]
+
+    model = AcousticModel(tiny_wav2vec2, token_encoding)
+    fp32 = score_audio_set("fp32", model, audio_set, memory=2**20)
+    again = score_audio_set("again", model, audio_set)
+    assert fp32.audio_seconds == 1.0
+    assert agreement(fp32, again) == (1.0, 0.0)
+    assert len(format_accuracy([fp32, again]).splitlines()) == 3
+
+
+def test_edit_distance():
+    assert edit_distance("kitten", "sitting") == 3
+    assert edit_distance("", "abc") == 3
+    assert edit_distance("abc", "abc") == 0
+
+
+@pytest.mark.parametrize(
+    "n_samples", [15 * 320, 16 * 320, 16 * 320 + 17, 40 * 320, 40 * 320 + 17]
+)
+@pytest.mark.parametrize("overlap", [4 * 320, 320])
+def test_windows(n_samples: int, overlap: int):
+    spans = windows(n_samples, 16 * 320, overlap)
+    assert spans[0][0] == 0 and spans[-1][1] == n_samples
+    for (start, end), (next_start, _) in zip(spans, spans[1:]):
+        assert next_start % 320 == 0
+        assert end - next_start == overlap
+        assert end - start == 16 * 320
+    assert receptive_field <= spans[-1][1] - spans[-1][0]
+    assert spans[-1][1] - spans[-1][0] < 16 * 320 + receptive_field
+
+
+def test_windowed_stitching(tiny_wav2vec2: Wav2Vec2ForCTC):
+    class PositionModel(AcousticModel):
+        "One frame per samples_per_frame, holding the normalized first sample"
+
+        def log_probabilities(self, x: torch.Tensor) -> np.ndarray:
+            self.lengths.append(x.shape[-1])
+            return x[0, : x.shape[-1] - 80 : 320, None].numpy().copy()
+
+    audio = torch.arange(40 * 320 + 17, dtype=torch.float32)[None]
+    config = ModelConfig(window_duration=16 * 0.02, window_overlap=4 * 0.02)
+    windowed = PositionModel(tiny_wav2vec2, token_encoding, config)
+    windowed.lengths = []
+    whole = PositionModel(
+        tiny_wav2vec2, token_encoding, ModelConfig(window_duration=None)
+    )
+    whole.lengths = []
+
+    assert np.array_equal(windowed(audio), whole(audio))
+    assert max(windowed.lengths) == 16 * 320 and len(windowed.lengths) > 1
+    assert whole.lengths == [audio.shape[-1]]
+
+
+def test_windowed_model(tiny_wav2vec2: Wav2Vec2ForCTC, audio: torch.Tensor):
+    config = ModelConfig(window_duration=0.4, window_overlap=0.1)
+    ctc = AcousticModel(tiny_wav2vec2, token_encoding, config)(audio)
+    assert ctc.shape == AcousticModel(tiny_wav2vec2, token_encoding)(audio).shape
+    assert np.allclose(np.logaddexp.reduce(ctc, axis=1), 0, atol=1e-5)
+
+
+def test_stand_in(mocker):
+    mocker.patch.object(Wav2Vec2ForCTC, "from_pretrained", side_effect=OSError)
+    model = load_model(ModelConfig(stand_in=True))
+
+    config = model.model.config
+    assert (config.hidden_size, config.num_hidden_layers) == (768, 12)
+    assert config.vocab_size == token_encoding.n_tokens
+    assert not model.masks_padding
+    n_parameters = sum(p.numel() for p in model.model.parameters())
+    assert 90e6 < n_parameters < 100e6
+
+    # the same weights every time
+    other = stand_in_model()
+    assert all(
+        torch.equal(a, b) for a, b in zip(model.model.parameters(), other.parameters())
+    )
+
+
+def test_bfloat16(mocker, audio: torch.Tensor):
+    mocker.patch.object(Wav2Vec2ForCTC, "from_pretrained", side_effect=OSError)
+    config = ModelConfig(stand_in=True, window_duration=None)
+    fp32 = load_model(config)
+
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.bfloat16_supported", return_value=True
+    )
+    model = load_model(replace(config, bfloat16=True))
+    assert model.dtype == torch.bfloat16
+    ctc = model(audio)
+    assert ctc.dtype == np.float32 and ctc.shape == fp32(audio).shape
+    assert np.allclose(np.logaddexp.reduce(ctc, axis=1), 0, atol=1e-4)
+
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.bfloat16_supported", return_value=False
+    )
+    assert load_model(replace(config, bfloat16=True)).dtype == torch.float32
+
+    with pytest.raises(ValueError):
+        load_model(replace(config, bfloat16=True, quantize=True))
+
+
+@pytest.mark.parametrize(
+    "cpuinfo, onednn, expected",
+    [
+        ("flags\t: avx2 avx512_bf16 amx_tile", False, True),
+        ("Features\t: fp asimd bf16 i8mm", False, True),
+        ("flags\t: avx2 avx512f", True, True),
+        ("flags\t: avx2 avx512f", False, False),
+    ],
+)
+def test_bfloat16_supported(mocker, cpuinfo: str, onednn: bool, expected: bool):
+    mocker.patch("builtins.open", mocker.mock_open(read_data=cpuinfo))
+    mocker.patch.object(
+        torch.ops.mkldnn, "_is_mkldnn_bf16_supported", return_value=onednn
+    )
+    assert bfloat16_supported() == expected
+
+
+def test_mmap_weights(tiny_wav2vec2: Wav2Vec2ForCTC, mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.stand_in_config",
+        return_value=tiny_wav2vec2.config,
+    )
+    stand_in_model = mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.stand_in_model", return_value=tiny_wav2vec2
+    )
+    config = ModelConfig(stand_in=True, mmap_weights=True)
+    audio = torch.rand(1, 8000) - 0.5
+    expected = AcousticModel(tiny_wav2vec2, token_encoding)(audio)
+
+    for _ in range(2):
+        model = load_model(config)
+        assert np.allclose(model(audio), expected, atol=1e-6)
+    # the second load only maps the saved weights
+    assert stand_in_model.call_count == 1
+    assert [p.name for p in (tmp_path / "vocoder" / "weights").iterdir()] == [
+        weights_path(config, tiny_wav2vec2.config).name
+    ]
+
+    weights = mmap_weights(weights_path(config, tiny_wav2vec2.config))
+    for name, tensor in tiny_wav2vec2.state_dict().items():
+        assert torch.equal(weights[name], tensor)
+
+
+@pytest.mark.timeout(2)
+def test_releasing_model():
+    loads = 0
+
+    def load():
+        nonlocal loads
+        loads += 1
+        return lambda audio: np.full((1, 1), loads)
+
+    model = ReleasingModel(load, release_after=0.05, model=load())
+    assert model.is_loaded and model(np.zeros(1))[0, 0] == 1
+
+    while model.is_loaded:
+        time.sleep(0.01)
+    assert model(np.zeros(1))[0, 0] == 2
+    # calls postpone the release
+    for _ in range(5):
+        time.sleep(0.02)
+        model(np.zeros(1))
+    assert loads == 2
+
+    while model.is_loaded:
+        time.sleep(0.01)
+    model.prefetch()
+    while not model.is_loaded:
+        time.sleep(0.01)
+    assert loads == 3 and model(np.zeros(1))[0, 0] == 3
+    model.close()
+    time.sleep(0.1)
+    assert model.is_loaded
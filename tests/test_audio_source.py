@@ -0,0 +1,82 @@
+import asyncio as aio
+import wave
+
+import numpy as np
+import pytest
+
+from vocoder.audio_source import FileSource, blocksize, read_pcm
+from vocoder.audio_utils import record_duration
+
+
+@pytest.fixture
+def samples() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(-1000, 1000, 10 * blocksize + 100, dtype=np.int16)
+
+
+@pytest.fixture
+def wav_path(tmp_path, samples):
+    path = tmp_path / "audio.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(samples.tobytes())
+    return path
+
+
+def test_read_pcm(tmp_path, wav_path, samples):
+    assert np.array_equal(read_pcm(wav_path), samples)
+
+    raw_path = tmp_path / "audio.pcm"
+    samples.tofile(raw_path)
+    assert np.array_equal(read_pcm(raw_path), samples)
+
+
+def test_read_pcm_rejects_wrong_format(tmp_path):
+    path = tmp_path / "audio.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(b"\0" * 400)
+    with pytest.raises(ValueError):
+        read_pcm(path)
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_file_source_fast_replay(wav_path, samples):
+    source = FileSource(wav_path, tail_silence=0.3)
+    source.start()
+    blocks = [await source.get() for _ in range(source.n_blocks)]
+    tail = [await source.get() for _ in range(source.n_tail_blocks)]
+    source.stop()
+
+    assert source.finished.is_set()
+    assert all(block.shape == (blocksize, 1) for block in blocks + tail)
+    audio = np.concatenate(blocks)[:, 0]
+    assert np.array_equal(audio[: len(samples)], samples)
+    assert not audio[len(samples) :].any()
+    assert not np.concatenate(tail).any()
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_file_source_realtime_replay(wav_path):
+    source = FileSource(wav_path, realtime=True, tail_silence=0)
+    source.start()
+    assert source.empty()
+    loop = aio.get_event_loop()
+    start = loop.time()
+    for _ in range(3):
+        await source.get()
+    assert loop.time() - start >= 0.09
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_record_duration_from_file(wav_path, samples):
+    audio_ = await record_duration(0.09, FileSource(wav_path))
+    assert audio_.shape == (1, 3 * blocksize)
+    assert np.allclose(audio_[0], samples[: 3 * blocksize] / 32768)
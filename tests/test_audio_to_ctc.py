@@ -0,0 +1,280 @@
+import asyncio as aio
+import threading
+import time
+import wave
+
+import numpy as np
+import pytest
+import torch
+
+from vocoder.acoustic_models.autotune import synthetic_utterance
+from vocoder.acoustic_models.cascade import Cascade
+from vocoder.audio_source import FileSource
+from vocoder.audio_to_ctc import (
+    CascadedCtc,
+    SpeculationMetrics,
+    ctc_serve,
+    produce_ctc,
+)
+from vocoder.stitching import CtcStream, samples_per_frame
+from vocoder.vad import Segment
+
+
+def segment(n_frames: int) -> Segment:
+    return Segment(np.zeros(n_frames * samples_per_frame, np.float32))
+
+
+def frames_model(audio: torch.Tensor) -> np.ndarray:
+    return np.zeros((audio.shape[1] // samples_per_frame, 1))
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_inference_does_not_block_the_event_loop():
+    def slow_model(audio: torch.Tensor) -> np.ndarray:
+        time.sleep(0.05)
+        return frames_model(audio)
+
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    for n_frames in [3, 5, 7]:
+        vad_queue.put_nowait(segment(n_frames))
+    exit_event = aio.Event()
+    task = aio.create_task(produce_ctc(vad_queue, exit_event, ctc_queue, slow_model))
+
+    ticks = 0
+    while ctc_queue.qsize() < 3:
+        await aio.sleep(0.005)
+        ticks += 1
+
+    assert ticks > 10
+    assert [len(ctc_queue.get_nowait()) for _ in range(3)] == [3, 5, 7]
+    exit_event.set()
+    await task
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_max_in_flight():
+    release = threading.Event()
+
+    def blocked_model(audio: torch.Tensor) -> np.ndarray:
+        release.wait()
+        return frames_model(audio)
+
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    for _ in range(6):
+        vad_queue.put_nowait(segment(2))
+    exit_event = aio.Event()
+    task = aio.create_task(
+        produce_ctc(vad_queue, exit_event, ctc_queue, blocked_model, max_in_flight=2)
+    )
+
+    await aio.sleep(0.05)
+    # two segments are in flight and a third waits for a slot
+    assert vad_queue.qsize() == 3
+    assert ctc_queue.empty()
+
+    release.set()
+    while ctc_queue.qsize() < 6:
+        await aio.sleep(0.005)
+    exit_event.set()
+    await task
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_stream():
+    def position_model(audio: torch.Tensor) -> np.ndarray:
+        return audio[0, ::samples_per_frame, None].numpy()
+
+    audio = np.arange(40 * samples_per_frame, dtype=np.float32)
+    overlap = 4 * samples_per_frame
+    parts = [(0, 16), (12, 28), (24, 40)]
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue()
+    for i, (start, end) in enumerate(parts):
+        piece = audio[start * samples_per_frame : end * samples_per_frame]
+        vad_queue.put_nowait(Segment(piece, i == len(parts) - 1, overlap if i else 0))
+    exit_event = aio.Event()
+    task = aio.create_task(
+        produce_ctc(vad_queue, exit_event, ctc_queue, position_model, stream=True)
+    )
+
+    ctc_stream = await ctc_queue.get()
+    assert isinstance(ctc_stream, CtcStream)
+    chunks = list[np.ndarray]()
+    while (chunk := await ctc_stream.get()) is not None:
+        chunks.append(chunk)
+
+    # a part's frames are stable once the next part is scored
+    assert len(chunks) == len(parts) - 1
+    assert np.array_equal(np.concatenate(chunks)[:, 0], audio[::samples_per_frame])
+    exit_event.set()
+    await task
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_cascade_scores_whole_utterances():
+    def tier_model(tier: float):
+        def model(audio: torch.Tensor) -> np.ndarray:
+            return np.full((audio.shape[1] // samples_per_frame, 1), tier)
+
+        return model
+
+    # an utterance in one segment, then one in two parts
+    parts = [segment(3), segment(4)._replace(final=False), segment(5)]
+    parts[2] = parts[2]._replace(overlap=samples_per_frame)
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    for part in parts:
+        vad_queue.put_nowait(part)
+    exit_event = aio.Event()
+    cascade = Cascade(tier_model(1), tier_model(2))
+    task = aio.create_task(
+        produce_ctc(vad_queue, exit_event, ctc_queue, tier_model(2), cascade=cascade)
+    )
+
+    whole, stitched = await ctc_queue.get(), await ctc_queue.get()
+    assert isinstance(whole, CascadedCtc)
+    assert np.all(whole.ctc == 1)
+    assert np.all(stitched == 2)
+    rescored = await whole.rescore()
+    assert rescored.shape == whole.ctc.shape and np.all(rescored == 2)
+    assert whole.n_samples == len(parts[0].audio)
+    assert cascade.metrics.escalated_audio_seconds == whole.n_samples / 16000
+    exit_event.set()
+    await task
+
+
+class LatestOffers:
+    "Stands in for a Segmenter whose offers are all current"
+
+    def is_latest_offer(self, segment: Segment) -> bool:
+        return True
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_final_segment_reuses_speculation():
+    calls = list[int]()
+
+    def counting_model(audio: torch.Tensor) -> np.ndarray:
+        calls.append(audio.shape[1])
+        return frames_model(audio)
+
+    speculated = segment(4)._replace(provisional=True, speculative=True)
+    resumed = segment(6)._replace(provisional=True, speculative=True)
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    # speech resumed after the first speculation, not after the second
+    for part in [speculated, segment(5), resumed, Segment(resumed.audio)]:
+        vad_queue.put_nowait(part)
+    exit_event = aio.Event()
+    metrics = SpeculationMetrics()
+    task = aio.create_task(
+        produce_ctc(
+            vad_queue,
+            exit_event,
+            ctc_queue,
+            counting_model,
+            LatestOffers(),
+            metrics=metrics,
+        )
+    )
+
+    assert [len(await ctc_queue.get()) for _ in range(2)] == [5, 6]
+    assert calls == [n * samples_per_frame for n in [4, 5, 6]]
+    assert (metrics.n_speculated, metrics.n_hits) == (2, 1)
+    assert metrics.hit_rate == 0.5 and metrics.saved_seconds >= 0
+    exit_event.set()
+    await task
+
+
+class AcceptingOffers(LatestOffers):
+    "Stands in for a Segmenter that lets every offer end its utterance"
+
+    def end_early(self, segment: Segment) -> bool:
+        return True
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_endpoint_offers_are_not_speculation():
+    offer = segment(4)._replace(provisional=True)
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    vad_queue.put_nowait(offer)
+    exit_event = aio.Event()
+    metrics = SpeculationMetrics()
+    task = aio.create_task(
+        produce_ctc(
+            vad_queue,
+            exit_event,
+            ctc_queue,
+            frames_model,
+            AcceptingOffers(),
+            lambda ctc: True,
+            metrics=metrics,
+        )
+    )
+
+    assert len(await ctc_queue.get()) == 4
+    assert (metrics.n_speculated, metrics.n_hits) == (0, 0)
+    exit_event.set()
+    await task
+
+
+@pytest.mark.timeout(2)
+@pytest.mark.asyncio
+async def test_model_errors_drop_the_utterance():
+    def failing_model(audio: torch.Tensor) -> np.ndarray:
+        if audio.shape[1] == 3 * samples_per_frame:
+            raise RuntimeError("out of memory")
+        return frames_model(audio)
+
+    # the first part of an utterance fails, its rest is dropped and the next scored
+    parts = [segment(3)._replace(final=False), segment(4), segment(5), segment(6)]
+    vad_queue, ctc_queue = aio.Queue[Segment](), aio.Queue[np.ndarray]()
+    for part in parts:
+        vad_queue.put_nowait(part)
+    exit_event = aio.Event()
+    task = aio.create_task(
+        produce_ctc(vad_queue, exit_event, ctc_queue, failing_model, max_in_flight=1)
+    )
+
+    assert [len(await ctc_queue.get()) for _ in range(2)] == [5, 6]
+    exit_event.set()
+    await task
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_ctc_serve_file_source(tmp_path):
+    "Two utterances in a WAV file are segmented and scored without a microphone"
+    rng = np.random.default_rng(0)
+    silence = np.zeros(8000, np.float32)
+    audio = np.concatenate(
+        [
+            silence,
+            synthetic_utterance(1.5, rng),
+            silence,
+            silence,
+            synthetic_utterance(1.0, rng),
+            silence,
+        ]
+    )
+    path = tmp_path / "utterances.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes((audio * 3 * 32767).astype(np.int16).tobytes())
+
+    exit_event, source = aio.Event(), FileSource(path)
+    async with ctc_serve(frames_model, exit_event, source) as ctc_queue:
+        first, second = await ctc_queue.get(), await ctc_queue.get()
+        await source.finished.wait()
+        exit_event.set()
+
+    # the voiced audio and at most the trim margins around it
+    frames_per_second = 16000 / samples_per_frame
+    assert 1.5 * frames_per_second <= len(first) < 2.0 * frames_per_second
+    assert 1.0 * frames_per_second <= len(second) < 1.5 * frames_per_second
+    assert ctc_queue.empty()
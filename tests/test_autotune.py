@@ -0,0 +1,84 @@
+import json
+from dataclasses import replace
+
+import numpy as np
+
+from vocoder.acoustic_models import autotune as autotune_module
+from vocoder.acoustic_models.autotune import (
+    Trial,
+    autotune,
+    frame_agreement,
+    save_tuned,
+)
+from vocoder.acoustic_models.wav2vec2 import ModelConfig, apply_tuned
+
+
+def test_apply_tuned():
+    config = ModelConfig(stand_in=True, tuned=True)
+    path = save_tuned(replace(config, intra_op_threads=2, quantize=True))
+    save_tuned(replace(config, name="other", window_duration=None))
+    assert set(json.loads(path.read_text())) == {
+        "facebook/wav2vec2-base-960h-stand-in",
+        "other-stand-in",
+    }
+
+    assert apply_tuned(config) == replace(config, intra_op_threads=2, quantize=True)
+    # settings made explicitly win over their whole group
+    assert apply_tuned(replace(config, bfloat16=True)) == replace(
+        config, intra_op_threads=2, bfloat16=True
+    )
+    assert apply_tuned(replace(config, tuned=False)) == replace(config, tuned=False)
+    assert apply_tuned(ModelConfig(tuned=True)) == ModelConfig(tuned=True)
+    assert apply_tuned(ModelConfig(stand_in=True)) == ModelConfig(stand_in=True)
+
+
+def test_apply_tuned_skips_conflicting_groups():
+    config = ModelConfig(stand_in=True, tuned=True)
+    save_tuned(replace(config, intra_op_threads=2, backend="onnx"))
+
+    assert apply_tuned(config).backend == "onnx"
+    for explicit in [{"buckets": (1.0,)}, {"mmap_weights": True}]:
+        assert apply_tuned(replace(config, **explicit)) == replace(
+            config, intra_op_threads=2, **explicit
+        )
+
+
+def test_frame_agreement():
+    reference = [np.eye(4)]
+    assert frame_agreement(reference, [np.eye(4)]) == 1.0
+    assert frame_agreement(reference, [np.eye(4)[[0, 1, 3, 2]]]) == 0.5
+
+
+def test_autotune_picks_fastest_agreeing(mocker):
+    def run_trial(name, config, audios, reference, repeats):
+        rtf, agreement = 0.8 / config.intra_op_threads, 1.0
+        if config.quantize:
+            rtf, agreement = 0.1, 0.9
+        if config.bfloat16:
+            rtf, agreement = 0.3, 0.99
+        if config.backend == "onnx":
+            rtf = 0.35
+        if config.window_duration == 4.0:
+            rtf -= 0.05
+        return Trial(name, config, rtf, agreement), []
+
+    mocker.patch.object(autotune_module, "run_trial", side_effect=run_trial)
+    mocker.patch.object(autotune_module, "thread_counts", return_value=[1, 2])
+    mocker.patch.object(autotune_module, "bfloat16_supported", return_value=True)
+
+    chosen, trials = autotune(ModelConfig(stand_in=True), durations=(1.0, 8.0))
+    assert chosen == ModelConfig(
+        stand_in=True,
+        tuned=False,
+        intra_op_threads=2,
+        bfloat16=True,
+        window_duration=4.0,
+    )
+    assert [t.name for t in trials][:4] == [
+        "2 threads",
+        "1 threads",
+        "int8",
+        "bfloat16",
+    ]
+    # 8 s utterances fit one window of 8 s, just like the default of 15 s
+    assert "window 8.0" not in [t.name for t in trials]
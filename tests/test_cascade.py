@@ -0,0 +1,46 @@
+import dataclasses
+
+import numpy as np
+import pytest
+import torch
+
+from vocoder.acoustic_models.cascade import Cascade
+from vocoder.acoustic_models.wav2vec2 import sample_rate, token_encoding
+from vocoder.stitching import samples_per_frame
+
+
+def test_cascade_metrics():
+    def model(confidence: float):
+        def score(audio: torch.Tensor) -> np.ndarray:
+            return np.full((audio.shape[1] // samples_per_frame, 1), confidence)
+
+        return score
+
+    cascade = Cascade(model(1.0), model(9.0))
+    audio = torch.zeros(1, sample_rate)
+    assert np.isnan(cascade.metrics.compute_saved)
+    assert np.all(cascade.score_first(audio) == 1.0)
+    assert np.all(cascade.score_second(audio) == 9.0)
+    cascade.count(sample_rate, escalated=True)
+    assert np.all(cascade.score_first(audio) == 1.0)
+    cascade.count(sample_rate, escalated=False)
+    # a discarded speculation costs compute but is not an utterance
+    cascade.score_first(audio)
+
+    metrics = cascade.metrics
+    assert (metrics.n_utterances, metrics.n_escalated) == (2, 1)
+    assert metrics.escalation_rate == 0.5
+    assert metrics.audio_seconds == 2.0
+    assert not np.isnan(metrics.compute_saved)
+    assert "50% escalated" in metrics.summary()
+
+
+def test_cascade_models_share_token_encoding():
+    class Model:
+        def __init__(self, encoding):
+            self.token_encoding = encoding
+
+    Cascade(Model(token_encoding), Model(dataclasses.replace(token_encoding)))
+    other = dataclasses.replace(token_encoding, blank=token_encoding.space)
+    with pytest.raises(ValueError):
+        Cascade(Model(token_encoding), Model(other))
@@ -0,0 +1,133 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models import compiled as compiled_module
+from vocoder.acoustic_models.benchmark import padding_deviation
+from vocoder.acoustic_models.compiled import BucketStats, CompiledAcousticModel
+from vocoder.acoustic_models.wav2vec2 import (
+    AcousticModel,
+    ModelConfig,
+    load_model,
+    token_encoding,
+)
+
+
+@pytest.fixture(scope="module")
+def layer_norm_wav2vec2() -> Wav2Vec2ForCTC:
+    "A tiny wav2vec2 that can mask padding"
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        vocab_size=token_encoding.n_tokens,
+        conv_dim=(32,) * 7,
+        num_conv_pos_embeddings=16,
+        feat_extract_norm="layer",
+        do_stable_layer_norm=True,
+    )
+    return Wav2Vec2ForCTC(config).eval()
+
+
+def test_buckets(layer_norm_wav2vec2: Wav2Vec2ForCTC):
+    config = ModelConfig(buckets=(0.5, 1.0), compile_backend="eager")
+    model = CompiledAcousticModel(layer_norm_wav2vec2, token_encoding, config)
+    model.warm()
+    assert model.stats.n_calls == 0
+    eager = AcousticModel(layer_norm_wav2vec2, token_encoding)
+
+    rng = np.random.default_rng(0)
+    for n in [3000, 8000, 12000, 20000]:
+        audio = rng.uniform(-0.2, 0.2, (1, n)).astype(np.float32)
+        assert np.allclose(model(audio), eager(audio), atol=1e-5)
+
+    stats = model.stats
+    assert stats.hits == {8000: 2, 16000: 1}
+    assert stats.n_unbucketed == 1
+    assert stats.hit_rates == {8000: 0.5, 16000: 0.25}
+    assert stats.padding_overhead == (5000 + 4000) / (3000 + 8000 + 12000)
+    assert "unbucketed 25%" in stats.summary()
+
+
+def test_suggest_buckets():
+    stats = BucketStats((16000,))
+    assert stats.suggest_buckets(2) == ()
+    for length in [1000, 2000, 3000, 4000]:
+        stats.add(length, None)
+    assert stats.suggest_buckets(1) == (4160 / 16000,)
+    assert len(stats.suggest_buckets(4)) == 4
+
+
+def test_padding_deviation(
+    layer_norm_wav2vec2: Wav2Vec2ForCTC, tiny_wav2vec2: Wav2Vec2ForCTC
+):
+    config = ModelConfig(buckets=(3.0,), compile_backend="eager")
+    for model, masks in [(layer_norm_wav2vec2, True), (tiny_wav2vec2, False)]:
+        padded = CompiledAcousticModel(model, token_encoding, config)
+        difference, same = padding_deviation(
+            AcousticModel(model, token_encoding), padded
+        )
+        if masks:
+            assert difference < 1e-4 and same == 1.0
+        else:
+            assert difference > 1e-3
+
+
+def test_release_keeps_compiled_model(layer_norm_wav2vec2: Wav2Vec2ForCTC, mocker):
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.load_wav2vec2",
+        side_effect=lambda config: copy.deepcopy(layer_norm_wav2vec2),
+    )
+    warm = mocker.spy(CompiledAcousticModel, "warm")
+    config = ModelConfig(buckets=(1.0,), compile_backend="eager", release_after=60)
+    model = load_model(config)
+    compiled = model._model
+    audio = np.random.default_rng(0).uniform(-0.2, 0.2, (1, 8000))
+    expected = model(audio.astype(np.float32))
+
+    model.release()
+    assert not model.is_loaded
+    assert model.token_encoding is token_encoding
+    assert all(p.untyped_storage().nbytes() == 0 for p in compiled.model.parameters())
+    assert np.allclose(model(audio.astype(np.float32)), expected, atol=1e-6)
+    assert model._model is compiled and warm.call_count == 1
+    model.close()
+
+
+def test_release_keeps_mmap_weights(
+    layer_norm_wav2vec2: Wav2Vec2ForCTC, mocker, monkeypatch, tmp_path
+):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.stand_in_config",
+        return_value=layer_norm_wav2vec2.config,
+    )
+    mocker.patch(
+        "vocoder.acoustic_models.wav2vec2.stand_in_model",
+        return_value=copy.deepcopy(layer_norm_wav2vec2),
+    )
+    load_torch_model = mocker.spy(compiled_module, "load_torch_model")
+    config = ModelConfig(
+        stand_in=True,
+        mmap_weights=True,
+        buckets=(1.0,),
+        compile_backend="eager",
+        release_after=60,
+    )
+    model = load_model(config)
+    compiled = model._model
+    audio = np.random.default_rng(0).uniform(-0.2, 0.2, (1, 8000)).astype(np.float32)
+    expected = model(audio)
+
+    for _ in range(2):
+        model.release()
+        assert not model.is_loaded
+        assert np.allclose(model(audio), expected, atol=1e-6)
+    # the mapped weights stay, so there is nothing to load again
+    assert model._model is compiled and load_torch_model.call_count == 0
+    model.close()
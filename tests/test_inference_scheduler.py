@@ -0,0 +1,138 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import AcousticModel, token_encoding
+from vocoder.inference_scheduler import InferenceScheduler
+
+
+class RecordingModel(AcousticModel):
+    "Returns the length of each piece of audio and records the batches"
+
+    def __init__(self):
+        self.token_encoding = token_encoding
+        self.batches = list[int]()
+
+    @property
+    def masks_padding(self) -> bool:
+        return True
+
+    def batch(self, audios):
+        self.batches.append(len(audios))
+        if any(audio.shape[-1] == 0 for audio in audios):
+            raise ValueError("empty audio")
+        return [np.array([audio.shape[-1]]) for audio in audios]
+
+
+def score_concurrently(scheduler, lengths: list[int]) -> list:
+    results = [None] * len(lengths)
+
+    def score(i: int):
+        try:
+            results[i] = scheduler(torch.zeros(1, lengths[i]))
+        except ValueError as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=score, args=(i,)) for i in range(len(lengths))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.timeout(2)
+def test_batches_concurrent_requests():
+    model = RecordingModel()
+    with InferenceScheduler(model, max_batch_size=4, max_wait=0.2) as scheduler:
+        results = score_concurrently(scheduler, [100, 200, 300, 400, 500, 600])
+
+    assert [int(r[0]) for r in results] == [100, 200, 300, 400, 500, 600]
+    assert sorted(model.batches) == [2, 4]
+    assert scheduler.metrics.n_requests == 6
+    assert scheduler.metrics.batch_fill == 6 / 8
+    assert 0 < scheduler.metrics.mean_queueing_delay <= 0.3
+    with pytest.raises(RuntimeError):
+        scheduler(torch.zeros(1, 10))
+
+
+@pytest.mark.timeout(2)
+def test_max_wait():
+    model = RecordingModel()
+    with InferenceScheduler(model, max_batch_size=4, max_wait=0) as scheduler:
+        for length in [10, 20]:
+            assert scheduler(torch.zeros(1, length))[0] == length
+    assert model.batches == [1, 1]
+
+
+@pytest.mark.timeout(2)
+def test_errors_reach_every_request_in_the_batch():
+    model = RecordingModel()
+    with InferenceScheduler(model, max_batch_size=2, max_wait=0.2) as scheduler:
+        results = score_concurrently(scheduler, [0, 100])
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+@pytest.mark.timeout(2)
+def test_close_while_submitting(mocker):
+    "A request queued by a submit that raced close is still scored"
+    entered, release = threading.Event(), threading.Event()
+
+    class PausingQueue(queue.Queue):
+        "Pauses a submit between checking for close and queueing its request"
+
+        def put(self, item, *args, **kwargs):
+            if item is not None:
+                entered.set()
+                release.wait()
+            super().put(item, *args, **kwargs)
+
+    mocker.patch("vocoder.inference_scheduler.queue.Queue", PausingQueue)
+    scheduler = InferenceScheduler(RecordingModel(), max_wait=0)
+    futures = list()
+    submit = threading.Thread(
+        target=lambda: futures.append(scheduler.submit(torch.zeros(1, 10)))
+    )
+    submit.start()
+    entered.wait()
+    close = threading.Thread(target=scheduler.close)
+    close.start()
+    close.join(0.05)
+    release.set()
+    submit.join()
+    close.join()
+    assert futures[0].result(timeout=0.5)[0] == 10
+
+
+def test_padded_batch(tiny_wav2vec2: Wav2Vec2ForCTC):
+    rng = np.random.default_rng(0)
+    audios = [rng.uniform(-0.2, 0.2, (1, n)).astype(np.float32) for n in (16000, 7000)]
+
+    model = AcousticModel(tiny_wav2vec2, token_encoding)
+    assert not model.masks_padding
+    ctcs = model.batch(audios)
+    for audio, ctc in zip(audios, ctcs):
+        assert ctc.shape == model(audio).shape
+    # the longest audio is not padded
+    assert np.allclose(ctcs[0], model(audios[0]), atol=1e-5)
+
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        vocab_size=token_encoding.n_tokens,
+        conv_dim=(32,) * 7,
+        num_conv_pos_embeddings=16,
+        feat_extract_norm="layer",
+        do_stable_layer_norm=True,
+    )
+    model = AcousticModel(Wav2Vec2ForCTC(config), token_encoding)
+    assert model.masks_padding
+    for audio, ctc in zip(audios, model.batch(audios)):
+        assert np.allclose(ctc, model(audio), atol=1e-5)
@@ -1,13 +1,20 @@
 import asyncio as aio
+import dataclasses
+import threading
 
 import numpy as np
 import pytest
 from pytest_mock import MockerFixture
 
 from tests.fixtures.programs import Program
-from vocoder.acoustic_models.wav2vec2 import token_encoding
+from vocoder.acoustic_models.wav2vec2 import ModelConfig, token_encoding
 from vocoder.app import App
+from vocoder.audio_to_ctc import CascadedCtc
+from vocoder.compile_grammar import compile_grammar as _compile_grammar
+from vocoder.grammar import Grammar
 from vocoder.simulate_ctc import simulate_ctc
+from vocoder.stitching import CtcStream
+from vocoder.vad import VadConfig
 
 
 @pytest.fixture
@@ -24,9 +31,9 @@ async def test_run_audio(program: Program, mocker: MockerFixture, no_model):
 
     ctc_queue = aio.Queue[np.ndarray]()
 
-    mocker.patch(
-        "vocoder.app.ctc_serve"
-    ).return_value.__aenter__.return_value = ctc_queue
+    mocker.patch("vocoder.app.ctc_serve").return_value.__aenter__.return_value = (
+        ctc_queue
+    )
 
     app = App(program.grammar)
     app_task = aio.create_task(app.run_async())
@@ -43,6 +50,36 @@ async def test_run_audio(program: Program, mocker: MockerFixture, no_model):
     program.test()
 
 
+@pytest.mark.timeout(0.2)
+@pytest.mark.asyncio
+async def test_run_audio_stream(program: Program, mocker: MockerFixture, no_model):
+
+    ctc_queue = aio.Queue[CtcStream]()
+
+    mocker.patch("vocoder.app.ctc_serve").return_value.__aenter__.return_value = (
+        ctc_queue
+    )
+
+    app = App(program.grammar, stream=True)
+    app_task = aio.create_task(app.run_async())
+
+    for line in program.input:
+        ctc_ = simulate_ctc(line, token_encoding)
+        ctc_stream = CtcStream()
+        for i in range(0, len(ctc_), 4):
+            ctc_stream.put_nowait(ctc_[i : i + 4])
+        ctc_stream.close()
+        ctc_queue.put_nowait(ctc_stream)
+
+    while not ctc_queue.empty():
+        await aio.sleep(0.001)
+    await aio.sleep(0.01)
+
+    app.exit()
+    await app_task
+    program.test()
+
+
 @pytest.mark.timeout(0.2)
 @pytest.mark.asyncio
 async def test_run_app_text(program: Program, mocker: MockerFixture, no_model):
@@ -66,3 +103,194 @@ async def test_run_app_text(program: Program, mocker: MockerFixture, no_model):
     app.exit()
     await app_task
     program.test()
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_endpoint(mocker: MockerFixture, no_model):
+    mocker.patch("vocoder.app.ctc_serve").return_value.__aenter__.return_value = (
+        aio.Queue[np.ndarray]()
+    )
+    grammar = Grammar()
+    grammar("!start = hello world")
+    app = App(grammar, vad_config=VadConfig(endpoint_silence=0.09))
+    app_task = aio.create_task(app.run_async())
+    await aio.sleep(0.01)
+
+    blanks = np.full((6, token_encoding.n_tokens), -20.0)
+    blanks[:, token_encoding.blank] = 0
+    complete = np.concatenate([simulate_ctc("hello world", token_encoding), blanks])
+    assert app.endpoint(complete)
+    assert app.decode(complete)[0] == ("hello", "world")
+
+    assert not app.endpoint(
+        np.concatenate([simulate_ctc("hello", token_encoding), blanks])
+    )
+    assert not app.endpoint(simulate_ctc("hello world", token_encoding))
+
+    app.exit()
+    await app_task
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_endpoint_longer_than_trim_margin(mocker: MockerFixture, no_model):
+    mocker.patch("vocoder.app.ctc_serve").return_value.__aenter__.return_value = (
+        aio.Queue[np.ndarray]()
+    )
+    grammar = Grammar()
+    grammar("!start = hello world")
+    vad_config = VadConfig(endpoint_silence=0.3, trim_margin=0.15)
+    app = App(grammar, vad_config=vad_config)
+    app_task = aio.create_task(app.run_async())
+    await aio.sleep(0.01)
+
+    # offered segments end trim_margin after the speech, 7 frames
+    blanks = np.full((7, token_encoding.n_tokens), -20.0)
+    blanks[:, token_encoding.blank] = 0
+    assert app.endpoint(
+        np.concatenate([simulate_ctc("hello world", token_encoding), blanks])
+    )
+
+    app.exit()
+    await app_task
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_decode_cascaded(mocker: MockerFixture, no_model):
+    mocker.patch("vocoder.app.ctc_serve").return_value.__aenter__.return_value = (
+        aio.Queue[np.ndarray]()
+    )
+    grammar = Grammar()
+    grammar("!start = hello world | hello | world")
+    app = App(grammar, cascade_config=ModelConfig(), cascade_margin=5.0)
+    app_task = aio.create_task(app.run_async())
+    await aio.sleep(0.01)
+    await aio.wrap_future(app._model_future)
+
+    def frames(tokens: list[int]) -> np.ndarray:
+        ctc = np.full((len(tokens), token_encoding.n_tokens), -20.0)
+        ctc[np.arange(len(tokens)), tokens] = 0
+        return ctc
+
+    blank = token_encoding.blank
+    confident = frames(
+        [*token_encoding.encode("hel"), blank, *token_encoding.encode("lo")]
+    )
+    rescored = frames([*token_encoding.encode("world"), blank])
+    rescores = list[bool]()
+
+    async def rescore():
+        rescores.append(True)
+        return rescored
+
+    decoded = await app.decode_cascaded(CascadedCtc(confident, 8000, rescore))
+    assert decoded is not None and decoded[0] == ("hello",)
+    assert not rescores
+
+    # as likely to be "hello" as "world"
+    unsure = np.logaddexp(confident, rescored)
+    decoded = await app.decode_cascaded(CascadedCtc(unsure, 8000, rescore))
+    assert decoded is not None and decoded[0] == ("world",)
+    assert rescores == [True]
+    metrics = app._cascade.metrics
+    assert (metrics.n_utterances, metrics.n_escalated) == (2, 1)
+    assert metrics.audio_seconds == 1.0
+
+    app.exit()
+    await app_task
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_model_loads_while_grammar_compiles(mocker: MockerFixture):
+    loading = threading.Event()
+    load_thread = None
+
+    def load_model(config):
+        nonlocal load_thread
+        load_thread = threading.current_thread()
+        loading.set()
+        return "model"
+
+    def compile_grammar(*args):
+        # deadlocks unless the model is loaded concurrently
+        assert loading.wait(0.5)
+        return _compile_grammar(*args)
+
+    mocker.patch("vocoder.app.load_model", side_effect=load_model)
+    mocker.patch("vocoder.app.compile_grammar", side_effect=compile_grammar)
+    ctc_serve = mocker.patch("vocoder.app.ctc_serve")
+    ctc_serve.return_value.__aenter__.return_value = aio.Queue()
+
+    grammar = Grammar()
+    grammar("!start = hello world")
+    app = App(grammar)
+    app_task = aio.create_task(app.run_async())
+
+    while not ctc_serve.called:
+        await aio.sleep(0.001)
+    assert ctc_serve.call_args.args[0] == "model"
+    assert load_thread is not threading.main_thread()
+    app.exit()
+    await app_task
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_token_encoding_of_the_model(mocker: MockerFixture):
+    class Model:
+        token_encoding = dataclasses.replace(token_encoding)
+
+    ctc_serve = mocker.patch("vocoder.app.ctc_serve")
+    ctc_serve.return_value.__aenter__.return_value = aio.Queue()
+    grammar = Grammar()
+    grammar("!start = hello world")
+    model = Model()
+    app = App(grammar, model=model)
+    app_task = aio.create_task(app.run_async())
+
+    while not ctc_serve.called:
+        await aio.sleep(0.001)
+    assert app.token_encoding is model.token_encoding
+    app.exit()
+    await app_task
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_exit_while_model_loads(mocker: MockerFixture):
+    release = threading.Event()
+    mocker.patch("vocoder.app.load_model", side_effect=lambda config: release.wait())
+    ctc_serve = mocker.patch("vocoder.app.ctc_serve")
+
+    grammar = Grammar()
+    grammar("!start = hello world")
+    app = App(grammar)
+    app_task = aio.create_task(app.run_async())
+    await aio.sleep(0.01)
+    app.exit()
+    await app_task
+    release.set()
+    assert not ctc_serve.called
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_shared_model(mocker: MockerFixture):
+    load_model = mocker.patch("vocoder.app.load_model")
+    ctc_serve = mocker.patch("vocoder.app.ctc_serve")
+    ctc_serve.return_value.__aenter__.return_value = aio.Queue()
+
+    grammar = Grammar()
+    grammar("!start = hello world")
+    app = App(grammar, model=simulate_ctc)
+    app_task = aio.create_task(app.run_async())
+    while not ctc_serve.called:
+        await aio.sleep(0.001)
+    app.exit()
+    await app_task
+
+    assert ctc_serve.call_args.args[0] is simulate_ctc
+    assert not load_model.called
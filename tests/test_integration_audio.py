@@ -3,7 +3,7 @@ from vocoder.acoustic_models.wav2vec2 import token_encoding
 from vocoder.compile_grammar import compile_grammar
 from vocoder.namespace import Namespace
 from vocoder.simulate_ctc import simulate_ctc
-from vocoder.soft_beam_search import beam_search
+from vocoder.soft_beam_search import BeamSearch, beam_search
 from vocoder.soft_simulate import Executor, initial_path_leaves, simplify
 
 
@@ -27,3 +27,31 @@ def test_run_audio(program: Program):
         path_leaves, output = simplify(path_leaves)
         executor.eat(new_words, output)
     program.test()
+
+
+def test_beam_search_in_chunks(program: Program):
+    soft = compile_grammar(
+        program.grammar.config,
+        program.grammar.lexicon_registry,
+        program.grammar.attribute_registry,
+    )
+    path_leaves = initial_path_leaves(soft)
+    for line in program.input:
+        ctc_output = simulate_ctc(line, token_encoding)
+        expected = beam_search(
+            soft,
+            program.grammar.lexicon_registry,
+            path_leaves,
+            ctc_output,
+            token_encoding,
+        )
+        search = BeamSearch(
+            soft, program.grammar.lexicon_registry, path_leaves, token_encoding
+        )
+        for i in range(0, len(ctc_output), 3):
+            search.step(ctc_output[i : i + 3])
+        words, prob, leaves = search.result()
+        assert (words, prob) == expected[:2]
+        assert search.margin() > 0
+        assert [node.state for node in leaves] == [node.state for node in expected[2]]
+        path_leaves, _ = simplify(expected[2])
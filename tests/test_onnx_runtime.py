@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import AcousticModel, ModelConfig, token_encoding
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from vocoder.acoustic_models import onnx_runtime  # noqa: E402
+from vocoder.acoustic_models.onnx_runtime import (  # noqa: E402
+    OnnxAcousticModel,
+    export,
+    export_path,
+    load_onnx_model,
+)
+
+
+def test_matches_torch(tiny_wav2vec2: Wav2Vec2ForCTC, tmp_path):
+    path = tmp_path / "model.onnx"
+    export(tiny_wav2vec2, path)
+    assert [p.name for p in tmp_path.iterdir()] == ["model.onnx"]
+
+    onnx_model = OnnxAcousticModel(path, token_encoding)
+    torch_model = AcousticModel(tiny_wav2vec2, token_encoding)
+    rng = np.random.default_rng(0)
+    # the number of samples is dynamic
+    for n in [16000, 7000, 24000]:
+        audio = torch.from_numpy(rng.uniform(-0.2, 0.2, (1, n)).astype(np.float32))
+        ctc = onnx_model(audio)
+        assert ctc.dtype == np.float32 and ctc.flags.c_contiguous
+        assert np.allclose(ctc, torch_model(audio), atol=1e-4)
+
+
+def test_export_path(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    config = Wav2Vec2Config()
+    path = export_path("facebook/wav2vec2-base-960h", config)
+    assert path.parent == tmp_path / "vocoder" / "onnx"
+    assert path.name.startswith("facebook--wav2vec2-base-960h-")
+    assert export_path("facebook/wav2vec2-base-960h", Wav2Vec2Config()) == path
+    assert export_path("other", config).name.startswith("other-")
+    assert (
+        export_path("facebook/wav2vec2-base-960h", Wav2Vec2Config(vocab_size=5)) != path
+    )
+
+
+def test_export_is_cached(tiny_wav2vec2: Wav2Vec2ForCTC, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        onnx_runtime.Wav2Vec2Config,
+        "from_pretrained",
+        lambda name: tiny_wav2vec2.config,
+    )
+    n_loads = 0
+
+    def from_pretrained(name):
+        nonlocal n_loads
+        n_loads += 1
+        return tiny_wav2vec2
+
+    monkeypatch.setattr(onnx_runtime.Wav2Vec2ForCTC, "from_pretrained", from_pretrained)
+
+    config = ModelConfig(name="tiny", backend="onnx")
+    for _ in range(2):
+        model = load_onnx_model(config)
+        assert isinstance(model, OnnxAcousticModel)
+    assert n_loads == 1
+
+    with pytest.raises(ValueError):
+        load_onnx_model(ModelConfig(name="tiny", backend="onnx", quantize=True))
+    with pytest.raises(ValueError):
+        load_onnx_model(ModelConfig(name="tiny", backend="onnx", buckets=(1.0,)))
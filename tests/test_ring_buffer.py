@@ -0,0 +1,59 @@
+import asyncio as aio
+import threading
+
+import numpy as np
+import pytest
+
+from vocoder.ring_buffer import AudioRingBuffer
+
+
+def _block(value: int, blocksize: int = 480) -> np.ndarray:
+    return np.full((blocksize, 1), value, np.int16)
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_returns_views_in_order():
+    ring = AudioRingBuffer(480, capacity=8, wakeup_blocks=1)
+    for i in range(3):
+        ring.write(_block(i))
+
+    blocks = [await ring.get() for _ in range(3)]
+    assert [int(b[0, 0]) for b in blocks] == [0, 1, 2]
+    assert all(np.shares_memory(b, ring._ring) for b in blocks)
+    assert ring.empty()
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_overrun_drops_oldest():
+    ring = AudioRingBuffer(480, capacity=4, wakeup_blocks=1)
+    for i in range(6):
+        ring.write(_block(i))
+
+    assert ring.qsize() == 4
+    assert int(ring.get_nowait()[0, 0]) == 2
+    assert ring.overruns == 2
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_ring_buffer_wakes_reader_per_batch():
+    ring = AudioRingBuffer(480, capacity=16, wakeup_blocks=3)
+    get_task = aio.create_task(ring.get())
+    await aio.sleep(0)
+
+    def writer(n):
+        for i in range(n):
+            ring.write(_block(i))
+
+    thread = threading.Thread(target=writer, args=(2,))
+    thread.start()
+    thread.join()
+    await aio.sleep(0.01)
+    assert not get_task.done()
+
+    thread = threading.Thread(target=writer, args=(1,))
+    thread.start()
+    thread.join()
+    block = await get_task
+    assert int(block[0, 0]) == 0
+    assert ring.qsize() == 2
@@ -1,10 +1,12 @@
 from tests.fixtures.programs import Program
 from vocoder.compile_grammar import compile_grammar
+from vocoder.grammar import Grammar
 from vocoder.namespace import Namespace
 from vocoder.soft import Soft, add_skip_transition, add_symbol_transition
 from vocoder.soft_simulate import (
     Executor,
     Node,
+    can_continue,
     initial_path_leaves,
     simplify,
     step_tree,
@@ -47,3 +49,13 @@ def test_run_text(program: Program):
         path_leaves, output = simplify(path_leaves)
         interpreter.eat(words, output)
     program.test()
+
+
+def test_can_continue():
+    g = Grammar()
+    g("!start = hello world")
+    soft = compile_grammar(g.config, g.lexicon_registry, g.attribute_registry)
+    path_leaves = initial_path_leaves(soft)
+    assert can_continue(soft, g.lexicon_registry, path_leaves, [])
+    assert can_continue(soft, g.lexicon_registry, path_leaves, ["hello"])
+    assert not can_continue(soft, g.lexicon_registry, path_leaves, ["hello", "world"])
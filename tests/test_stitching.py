@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from vocoder.stitching import CtcStitcher, samples_per_frame
+
+
+def fake_model(audio: np.ndarray) -> np.ndarray:
+    "One frame per samples_per_frame samples, holding the value of its first sample"
+    n_frames = (len(audio) - 80) // samples_per_frame
+    return audio[: n_frames * samples_per_frame : samples_per_frame, None]
+
+
+@pytest.mark.parametrize("piece_length,overlap", [(9600, 960), (4800, 1920)])
+def test_stitched_frames_line_up(piece_length: int, overlap: int):
+    audio = np.arange(50_000, dtype=np.float64)
+    stitcher = CtcStitcher()
+    start = 0
+    while True:
+        piece = audio[start : start + piece_length]
+        stitcher.add(fake_model(piece), len(piece), overlap if start else 0)
+        if start + piece_length >= len(audio):
+            break
+        start += piece_length - overlap
+
+    stitched = stitcher.finish()[:, 0]
+    whole = fake_model(audio)[:, 0]
+    assert np.array_equal(stitched, whole)
+
+
+def test_single_piece():
+    ctc = np.random.rand(10, 4)
+    stitcher = CtcStitcher()
+    stitcher.add(ctc, 3280)
+    assert np.array_equal(stitcher.finish(), ctc)
+
+
+def test_peek_matches_finish():
+    ctc = np.random.rand(100, 4)
+    stitcher = CtcStitcher()
+    stitcher.add(ctc[:60], 60 * samples_per_frame)
+    peeked = stitcher.peek(ctc[50:], 50 * samples_per_frame, 10 * samples_per_frame)
+    assert np.array_equal(peeked, ctc)
+
+    stitcher.add(ctc[50:], 50 * samples_per_frame, 10 * samples_per_frame)
+    assert np.array_equal(stitcher.finish(), peeked)
+
+
+def test_drain_returns_stable_frames():
+    audio = np.arange(30_000, dtype=np.float64)
+    piece_length, overlap = 9600, 1920
+    stitcher = CtcStitcher()
+    drained = list[np.ndarray]()
+    start = 0
+    while start + piece_length < len(audio):
+        piece = audio[start : start + piece_length]
+        stitcher.add(fake_model(piece), len(piece), overlap if start else 0)
+        if (frames := stitcher.drain()) is not None:
+            drained.append(frames)
+        assert stitcher.drain() is None
+        start += piece_length - overlap
+    piece = audio[start:]
+    stitcher.add(fake_model(piece), len(piece), overlap)
+
+    n_drained = stitcher.n_drained
+    assert n_drained == sum(map(len, drained)) > 0
+    whole = stitcher.finish()
+    assert np.array_equal(np.concatenate(drained), whole[:n_drained])
+    assert np.array_equal(whole[:, 0], fake_model(audio)[:, 0])
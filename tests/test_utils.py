@@ -0,0 +1,30 @@
+import asyncio as aio
+
+import pytest
+
+from vocoder.utils import iter_queue
+
+
+@pytest.mark.timeout(1)
+@pytest.mark.asyncio
+async def test_iter_queue_until_exit():
+    q = aio.Queue[int]()
+    exit_event = aio.Event()
+    received = list[int]()
+
+    async def consume():
+        async for item in iter_queue(q, exit_event):
+            received.append(item)
+
+    task = aio.create_task(consume())
+    q.put_nowait(1)
+    q.put_nowait(2)
+    await aio.sleep(0.01)
+    q.put_nowait(3)
+    await aio.sleep(0.01)
+    assert received == [1, 2, 3]
+
+    exit_event.set()
+    await aio.wait_for(task, 0.1)
+    q.put_nowait(4)
+    assert q.qsize() == 1
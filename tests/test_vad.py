@@ -0,0 +1,249 @@
+import asyncio as aio
+
+import numpy as np
+import pytest
+
+from vocoder.audio_source import blocksize
+from vocoder.vad import (
+    EnergyGate,
+    Segment,
+    Segmenter,
+    UtteranceBuffer,
+    VadConfig,
+    frame_audio,
+    segment_decisions,
+)
+from vocoder.vad_backends import VadBackend
+
+
+class ScriptedVad(VadBackend):
+    "Returns a fixed sequence of decisions"
+
+    def __init__(self, decisions: np.ndarray):
+        self._decisions = iter(decisions)
+
+    def is_speech(self, indata: np.ndarray) -> bool:
+        return bool(next(self._decisions))
+
+
+def random_decisions(n_frames: int, seed: int) -> np.ndarray:
+    "Alternating bursts of mostly speech and mostly silence"
+    rng = np.random.default_rng(seed)
+    decisions = list[int]()
+    speech = False
+    while len(decisions) < n_frames:
+        p = 0.9 if speech else 0.1
+        decisions.extend(rng.random(rng.integers(5, 60)) < p)
+        speech = not speech
+    return np.array(decisions[:n_frames], np.int8)
+
+
+def run_frames(frames: np.ndarray, decisions: np.ndarray, config: VadConfig):
+    "Feed frames to a Segmenter and return the utterances it emits, joining parts"
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, config)
+    segmenter.vad = ScriptedVad(decisions)
+    for frame in frames:
+        segmenter.run_frame(frame[:, None])
+
+    utterances = list[np.ndarray]()
+    parts = list[np.ndarray]()
+    while not queue.empty():
+        segment = queue.get_nowait()
+        assert len(segment.audio) <= config.max_segment_blocks * blocksize
+        parts.append(segment.audio[segment.overlap :])
+        if segment.final:
+            utterances.append(np.concatenate(parts))
+            parts.clear()
+    return utterances
+
+
+def test_frame_audio():
+    audio = np.arange(3 * blocksize, dtype=np.int16)
+    frames = frame_audio(audio)
+    assert frames.shape == (3, blocksize)
+    assert np.shares_memory(frames, audio)
+
+    frames = frame_audio(audio[:-10])
+    assert frames.shape == (3, blocksize)
+    assert not frames[-1, -10:].any()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize(
+    "config",
+    [
+        VadConfig(max_segment_duration=None),
+        VadConfig(front_padding=0, n_vad_decisions=6),
+        VadConfig(max_segment_duration=0.3, segment_overlap=0.06),
+        VadConfig(max_segment_duration=0.3, segment_overlap=0.06, trim_margin=0),
+        VadConfig(trim_margin=None),
+    ],
+)
+def test_segment_decisions_matches_run_frame(seed: int, config: VadConfig):
+    decisions = random_decisions(2000, seed)
+    audio = np.arange(len(decisions) * blocksize, dtype=np.int64).astype(np.int16)
+    frames = frame_audio(audio)
+
+    expected = run_frames(frames, decisions, config)
+    segments = segment_decisions(decisions, config)
+
+    assert len(expected) > 0
+    assert len(segments) == len(expected)
+    for (start, end), segment in zip(segments, expected):
+        assert np.array_equal(frames[start:end].reshape(-1) / 32768, segment)
+
+
+def noisy_speech(n_frames: int, seed: int) -> np.ndarray:
+    "Low background noise with loud bursts, as int16 frames"
+    rng = np.random.default_rng(seed)
+    scale = np.where(random_decisions(n_frames, seed).astype(bool), 3000, 20)
+    frames = rng.normal(size=(n_frames, blocksize)) * scale[:, None]
+    return frames.astype(np.int16)
+
+
+def test_energy_gate_skips_background_noise():
+    frames = noisy_speech(1000, 0)
+    loud = np.abs(frames).max(1) > 1000
+    gate = EnergyGate()
+    silent = np.array([gate.is_silence(frame[:, None]) for frame in frames])
+
+    assert not (silent & loud).any()
+    assert silent[~loud][gate.warmup :].mean() > 0.5
+    assert gate.n_frames == len(frames)
+    assert gate.n_skipped == silent.sum()
+
+
+def test_energy_gate_silence_mask_matches_is_silence():
+    frames = noisy_speech(1000, 1)
+    gate = EnergyGate()
+    expected = [gate.is_silence(frame[:, None]) for frame in frames]
+
+    batch_gate = EnergyGate()
+    mask = np.concatenate(
+        [batch_gate.silence_mask(frames[:300]), batch_gate.silence_mask(frames[300:])]
+    )
+    assert np.array_equal(mask, expected)
+    assert batch_gate.n_skipped == gate.n_skipped
+
+
+def test_segmenter_splits_long_utterances():
+    config = VadConfig(max_segment_duration=0.3, segment_overlap=0.06)
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, config)
+    segmenter.vad = ScriptedVad([1] * 40 + [0] * 20)
+    audio = np.arange(60 * blocksize, dtype=np.int16).reshape(60, blocksize)
+    for frame in audio:
+        segmenter.run_frame(frame[:, None])
+
+    segments = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert len(segments) > 1
+    assert [s.final for s in segments] == [False] * (len(segments) - 1) + [True]
+    assert segments[0].overlap == 0
+    for previous, segment in zip(segments, segments[1:]):
+        assert segment.overlap == config.overlap_blocks * blocksize
+        assert np.array_equal(
+            previous.audio[-segment.overlap :], segment.audio[: segment.overlap]
+        )
+
+
+def test_segmenter_trims_padding_and_hangover():
+    config = VadConfig(trim_margin=0.06)
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, config)
+    decisions = [0] * 30 + [1] * 20 + [0] * 30
+    segmenter.vad = ScriptedVad(decisions)
+    audio = np.arange(len(decisions) * blocksize).astype(np.int16)
+    for frame in frame_audio(audio):
+        segmenter.run_frame(frame[:, None])
+
+    segment = queue.get_nowait()
+    assert queue.empty()
+    margin = config.trim_margin_blocks
+    start, end = (30 - margin) * blocksize, (50 + margin) * blocksize
+    assert np.array_equal(segment.audio, audio[start:end] / 32768)
+
+    untrimmed = segment_decisions(np.array(decisions), VadConfig(trim_margin=None))
+    ((untrimmed_start, untrimmed_end),) = untrimmed
+    assert segmenter.n_emitted == (end - start) // blocksize
+    assert segmenter.n_trimmed == untrimmed_end - untrimmed_start - segmenter.n_emitted
+    assert segmenter.n_trimmed > 0
+
+
+def test_segmenter_ends_utterance_early():
+    config = VadConfig(endpoint_silence=0.09)
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, config)
+    decisions = [0] * 10 + [1] * 20 + [0] * 3 + [1] * 20 + [0] * 3 + [0] * 30
+    segmenter.vad = ScriptedVad(decisions)
+    frames = frame_audio(np.arange(len(decisions) * blocksize).astype(np.int16))
+
+    for frame in frames[:33]:
+        segmenter.run_frame(frame[:, None])
+    first = queue.get_nowait()
+    assert first.provisional and queue.empty()
+
+    # speech resumed after the first provisional segment
+    for frame in frames[33:40]:
+        segmenter.run_frame(frame[:, None])
+    assert not segmenter.end_early(first)
+    for frame in frames[40:56]:
+        segmenter.run_frame(frame[:, None])
+    second = queue.get_nowait()
+    assert second.provisional and queue.empty()
+    assert np.array_equal(second.audio[: len(first.audio)], first.audio)
+
+    assert not segmenter.end_early(first)
+    assert segmenter.end_early(second)
+    for frame in frames[56:]:
+        segmenter.run_frame(frame[:, None])
+    assert queue.empty()
+    assert not segmenter.is_active
+
+
+def test_segmenter_speculates_in_hangover():
+    config = VadConfig(speculate=True)
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, config)
+    decisions = [0] * 10 + [1] * 20 + [0] * 8 + [1] * 20 + [0] * 30
+    segmenter.vad = ScriptedVad(decisions)
+    frames = frame_audio(np.arange(len(decisions) * blocksize).astype(np.int16))
+    for frame in frames:
+        segmenter.run_frame(frame[:, None])
+
+    # speech resumed after the first speculation, not after the second
+    first, second, final = [queue.get_nowait() for _ in range(3)]
+    assert queue.empty()
+    assert first.speculative and second.speculative and not final.provisional
+    assert final.audio is second.audio
+    assert first.audio is not final.audio
+
+
+def test_segmenter_calls_on_voice_when_utterances_start():
+    starts = list[int]()
+    queue = aio.Queue[Segment]()
+    segmenter = Segmenter(queue, on_voice=lambda: starts.append(queue.qsize()))
+    decisions = ([0] * 10 + [1] * 20 + [0] * 30) * 2
+    segmenter.vad = ScriptedVad(decisions)
+    for frame in frame_audio(np.zeros(len(decisions) * blocksize, np.int16)):
+        segmenter.run_frame(frame[:, None])
+    assert starts == [0, 1] and queue.qsize() == 2
+
+
+def test_utterance_buffer_grows_without_invalidating_views():
+    blocks = np.arange(10 * blocksize).astype(np.int16).reshape(10, blocksize, 1)
+    buffer = UtteranceBuffer(2)
+    buffer.append(blocks[0])
+    buffer.append(blocks[1])
+    view = buffer.view(0, 2)
+    for block in blocks[2:]:
+        buffer.append(block)
+
+    assert len(buffer) == 10
+    assert view.dtype == np.float32
+    assert np.array_equal(view, blocks[:2].reshape(-1) / 32768)
+    assert np.array_equal(buffer.view(0, 10), blocks.reshape(-1) / 32768)
+
+    continued = UtteranceBuffer(4, buffer.view(8, 10))
+    assert len(continued) == 2
+    assert np.array_equal(continued.view(0, 2), buffer.view(8, 10))
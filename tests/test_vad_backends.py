@@ -0,0 +1,71 @@
+import wave
+
+import numpy as np
+
+from vocoder.audio_source import sample_rate
+from vocoder.vad import frame_audio
+from vocoder.vad_backends import SpectralVad, WebrtcVad
+from vocoder.vad_benchmark import cheapest, load_recordings, run_benchmark
+
+speech = [(1.0, 2.5), (4.0, 4.6)]
+
+
+def synthetic_recording(seed: int = 0) -> np.ndarray:
+    "White noise with voiced, harmonic bursts during the intervals in speech"
+    rng = np.random.default_rng(seed)
+    time = np.arange(6 * sample_rate) / sample_rate
+    audio = rng.normal(scale=30, size=len(time))
+    voiced = np.sin(2 * np.pi * 150 * np.arange(1, 20)[:, None] * time).sum(0)
+    for start, end in speech:
+        mask = (time >= start) & (time < end)
+        audio[mask] += 300 * voiced[mask]
+    return audio.astype(np.int16)
+
+
+def test_spectral_decisions_match_is_speech():
+    frames = frame_audio(synthetic_recording())
+    vad = SpectralVad()
+    expected = [vad.is_speech(frame[:, None]) for frame in frames]
+    assert np.array_equal(SpectralVad().decisions(frames), expected)
+
+
+def test_spectral_vad_finds_voiced_bursts():
+    frames = frame_audio(synthetic_recording())
+    decisions = SpectralVad().decisions(frames)
+    time = (np.arange(len(frames)) + 0.5) * 0.03
+    in_speech = np.zeros(len(frames), bool)
+    for start, end in speech:
+        in_speech |= (time > start + 0.03) & (time < end - 0.03)
+    assert decisions[in_speech].mean() > 0.9
+    assert decisions[~in_speech].mean() < 0.1
+
+
+def test_webrtc_decisions():
+    frames = frame_audio(synthetic_recording())
+    decisions = WebrtcVad(3).decisions(frames)
+    assert decisions.shape == (len(frames),)
+    assert set(np.unique(decisions)) <= {0, 1}
+
+
+def test_benchmark(tmp_path):
+    with wave.open(str(tmp_path / "burst.wav"), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(synthetic_recording().tobytes())
+    (tmp_path / "burst.txt").write_text(
+        "".join(f"{start}\t{end}\tspeech\n" for start, end in speech)
+    )
+
+    recordings = load_recordings(tmp_path)
+    assert [r.name for r in recordings] == ["burst"]
+
+    results = run_benchmark(recordings, [("spectral", 3), ("webrtc", 3)])
+    spectral = results[0]
+    assert spectral.n_frames == 200
+    assert spectral.n_missed == spectral.n_false == 0
+    assert 0 < spectral.onset_delay < 0.5
+    assert 0 < spectral.end_delay < 1.0
+
+    assert cheapest(results, onset_budget=0, end_budget=0) is None
+    assert cheapest(results, onset_budget=1, end_budget=2) is not None
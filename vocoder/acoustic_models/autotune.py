@@ -0,0 +1,228 @@
+"""Measure which thread count, precision, backend and windowing score synthetic
+utterances fastest on this machine while agreeing with the float32 model, and
+write them where load_model picks them up for ModelConfig(tuned=True), run with
+python -m vocoder.acoustic_models.autotune"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import time
+import typing as t
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import numpy as np
+import torch
+from loguru import logger
+
+from vocoder.acoustic_models.wav2vec2 import (
+    ModelConfig,
+    bfloat16_supported,
+    load_model,
+    model_key,
+    sample_rate,
+    tuned_configs_path,
+    tuned_groups,
+    whole_frames,
+)
+
+
+def synthetic_utterance(duration: float, rng: np.random.Generator) -> np.ndarray:
+    """Voice-like float32 audio: harmonics of a gliding pitch, modulated at a
+    syllable rate, over a little noise"""
+    n = round(duration * sample_rate)
+    time_ = np.arange(n) / sample_rate
+    pitch = rng.uniform(100, 220) * (1 + 0.2 * np.sin(2 * np.pi * 0.5 * time_))
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * rng.uniform(3, 5) * time_), 0, None)
+    audio = 0.1 * envelope * voice + rng.normal(0, 0.005, n)
+    return audio.astype(np.float32)
+
+
+def thread_counts() -> list[int]:
+    "Powers of two below the number of cpus, and the number of cpus"
+    n_cpus = os.cpu_count() or 1
+    counts = [2**i for i in range(n_cpus.bit_length()) if 2**i < n_cpus]
+    return counts + [n_cpus]
+
+
+def frame_agreement(reference: list[np.ndarray], ctcs: list[np.ndarray]) -> float:
+    "Fraction of frames whose most likely token is the same as in reference"
+    same = sum(
+        int((r.argmax(-1) == c.argmax(-1)).sum()) for r, c in zip(reference, ctcs)
+    )
+    return same / max(sum(len(r) for r in reference), 1)
+
+
+@dataclass
+class Trial:
+    name: str
+    config: ModelConfig
+    real_time_factor: float
+    agreement: float  # see frame_agreement, against the first trial
+
+
+def run_trial(
+    name: str,
+    config: ModelConfig,
+    audios: list[torch.Tensor],
+    reference: list[np.ndarray] | None,
+    repeats: int,
+) -> tuple[Trial, list[np.ndarray]]:
+    """Trial of a model loaded with config, timed as the sum over audios of the
+    median of repeats calls after a warm up call, and its ctc of audios"""
+    model = load_model(config)
+    ctcs, seconds = list[np.ndarray](), 0.0
+    for audio in audios:
+        ctcs.append(model(audio))
+        times = list[float]()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(audio)
+            times.append(time.perf_counter() - start)
+        seconds += float(np.median(times))
+    del model
+    gc.collect()
+
+    audio_seconds = sum(audio.shape[-1] for audio in audios) / sample_rate
+    agreement = 1.0 if reference is None else frame_agreement(reference, ctcs)
+    trial = Trial(name, config, seconds / audio_seconds, agreement)
+    logger.info(
+        f"{name}: real-time factor {trial.real_time_factor:.3f}, "
+        f"agreement {trial.agreement:.1%}"
+    )
+    return trial, ctcs
+
+
+def autotune(
+    config: ModelConfig | None = None,
+    durations: t.Sequence[float] = (1.0, 2.0, 4.0, 8.0),
+    window_durations: t.Sequence[float | None] = (None, 4.0, 8.0),
+    repeats: int = 3,
+    min_agreement: float = 0.98,
+    seed: int = 0,
+) -> tuple[ModelConfig, list[Trial]]:
+    """The fastest configuration of config's model whose agreement with float32 is
+    at least min_agreement, and every trial. Thread counts are tried first, then
+    precisions and backends with the fastest of them, then window durations,
+    since searching every combination would take too long."""
+    base = replace(config or ModelConfig(), tuned=False)
+    rng = np.random.default_rng(seed)
+    audios = [torch.from_numpy(synthetic_utterance(d, rng))[None] for d in durations]
+    trials = list[Trial]()
+    reference: list[np.ndarray] | None = None
+
+    def best(candidates: dict[str, ModelConfig], incumbent: Trial | None) -> Trial:
+        "The fastest agreeing trial of incumbent and candidates"
+        nonlocal reference
+        stage = [] if incumbent is None else [incumbent]
+        for name, candidate in candidates.items():
+            trial, ctcs = run_trial(name, candidate, audios, reference, repeats)
+            reference = reference or ctcs
+            trials.append(trial)
+            stage.append(trial)
+        passing = [trial for trial in stage if trial.agreement >= min_agreement]
+        return min(passing, key=lambda trial: trial.real_time_factor)
+
+    # the first trial uses every cpu and is the float32 reference
+    chosen = best(
+        {
+            f"{n} threads": replace(base, intra_op_threads=n)
+            for n in reversed(thread_counts())
+        },
+        None,
+    )
+
+    precisions = {"int8": replace(chosen.config, quantize=True)}
+    if bfloat16_supported():
+        precisions["bfloat16"] = replace(chosen.config, bfloat16=True)
+    if all(importlib.util.find_spec(m) for m in ("onnx", "onnxruntime")):
+        precisions["onnx"] = replace(chosen.config, backend="onnx")
+    chosen = best(precisions, chosen)
+
+    longest = max(audio.shape[-1] for audio in audios)
+
+    def one_window(window: float | None) -> bool:
+        "Whether every utterance is scored in one window"
+        return window is None or whole_frames(window) >= longest
+
+    windows = {
+        f"window {w}": replace(chosen.config, window_duration=w)
+        for w in window_durations
+        if w != chosen.config.window_duration
+        and not (one_window(w) and one_window(chosen.config.window_duration))
+    }
+    return best(windows, chosen).config, trials
+
+
+def save_tuned(config: ModelConfig, path: str | os.PathLike | None = None) -> Path:
+    "Record the tuned fields of config for its model, keeping other models' entries"
+    path = Path(path or tuned_configs_path())
+    tuned = {}
+    if path.exists():
+        tuned = json.loads(path.read_text())
+    tuned[model_key(config)] = {
+        field: getattr(config, field) for group in tuned_groups for field in group
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix(f".{os.getpid()}.partial")
+    partial.write_text(json.dumps(tuned, indent=2) + "\n")
+    os.replace(partial, path)
+    return path
+
+
+def format_trials(trials: list[Trial], chosen: ModelConfig) -> str:
+    lines = [f"{'trial':<16}{'rtf':>8}{'agree':>8}"]
+    for trial in trials:
+        mark = " *" if trial.config is chosen else ""
+        lines.append(
+            f"{trial.name:<16}{trial.real_time_factor:>8.3f}"
+            f"{trial.agreement:>8.1%}{mark}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--name", default=ModelConfig.name)
+    parser.add_argument(
+        "--durations",
+        nargs="+",
+        type=float,
+        default=[1.0, 2.0, 4.0, 8.0],
+        help="seconds of the synthetic utterances",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=0.98,
+        help="fraction of frames that must decode as with float32",
+    )
+    parser.add_argument(
+        "--stand-in",
+        action="store_true",
+        help="random weights instead of downloading the model, for timing offline",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the result without saving it"
+    )
+    args = parser.parse_args()
+
+    config = ModelConfig(name=args.name, stand_in=args.stand_in)
+    chosen, trials = autotune(
+        config, args.durations, repeats=args.repeats, min_agreement=args.min_agreement
+    )
+    print(format_trials(trials, chosen))
+    if not args.dry_run:
+        print(f"Saved the configuration marked * to {save_tuned(chosen)}")
+        print("Use it with ModelConfig(tuned=True).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""Compare the per-utterance latency of AcousticModel with scoring through
+Wav2Vec2Processor without inference mode, of its int8 and bfloat16 versions and,
+with --onnx, of onnxruntime, run with python -m vocoder.acoustic_models.benchmark
+
+With --audio DIRECTORY, score the WAV files in DIRECTORY with the fp32, int8 and
+bfloat16 models instead and report their real-time factor, resident memory and
+how often their greedy transcripts agree."""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import typing as t
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+import numpy as np
+import torch
+from transformers import Wav2Vec2FeatureExtractor, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import (
+    AcousticModel,
+    ModelConfig,
+    bfloat16_supported,
+    load_model,
+)
+from vocoder.audio_source import read_pcm, sample_rate
+
+
+def processor_model(
+    model: Wav2Vec2ForCTC, feature_extractor: Wav2Vec2FeatureExtractor
+) -> t.Callable[[torch.Tensor], np.ndarray]:
+    "The way utterances were scored before AcousticModel, as a baseline"
+
+    def _model(x):
+        in_ = feature_extractor(
+            x, sampling_rate=sample_rate, return_tensors="pt"
+        ).input_values[0]
+        logits = model(in_).logits[0]
+        return logits.detach().cpu().numpy()
+
+    return _model
+
+
+def time_per_utterance(
+    model: t.Callable[[torch.Tensor], np.ndarray],
+    durations: t.Sequence[float] = (1.0, 2.0, 4.0, 8.0),
+    repeats: int = 5,
+    seed: int = 0,
+) -> dict[float, float]:
+    "Median seconds to score an utterance of each duration, after one warm up call"
+    rng = np.random.default_rng(seed)
+    out = dict[float, float]()
+    for duration in durations:
+        audio = rng.uniform(-0.1, 0.1, (1, round(duration * sample_rate)))
+        audio = torch.from_numpy(audio.astype(np.float32))
+        model(audio)
+        times = list[float]()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(audio)
+            times.append(time.perf_counter() - start)
+        out[duration] = float(np.median(times))
+    return out
+
+
+def compare(
+    models: dict[str, t.Callable[[torch.Tensor], np.ndarray]],
+    durations: t.Sequence[float] = (1.0, 2.0, 4.0, 8.0),
+    repeats: int = 5,
+) -> str:
+    "Table of the median latency of each model, and its speedup over the first"
+    timings = {
+        name: time_per_utterance(m, durations, repeats) for name, m in models.items()
+    }
+    baseline = next(iter(timings.values()))
+    lines = [f"{'model':<16}" + "".join(f"{f'{d:g} s':>16}" for d in durations)]
+    for name, timing in timings.items():
+        lines.append(
+            f"{name:<16}"
+            + "".join(
+                f"{timing[d] * 1000:>8.0f} ms {baseline[d] / timing[d]:>4.1f}x"
+                for d in durations
+            )
+        )
+    return "\n".join(lines)
+
+
+def padding_deviation(
+    model: t.Callable[[torch.Tensor], np.ndarray],
+    padded: t.Callable[[torch.Tensor], np.ndarray],
+    durations: t.Sequence[float] = (0.7, 1.3, 2.9),
+    seed: int = 0,
+) -> tuple[float, float]:
+    """Largest difference between the log probabilities of model and of padded, a
+    model that pads audio like CompiledAcousticModel, and the fraction of frames
+    whose most likely token is the same"""
+    rng = np.random.default_rng(seed)
+    max_difference, same, n_frames = 0.0, 0, 0
+    for duration in durations:
+        audio = rng.uniform(-0.1, 0.1, (1, round(duration * sample_rate)))
+        audio = torch.from_numpy(audio.astype(np.float32))
+        expected, actual = model(audio), padded(audio)
+        max_difference = max(max_difference, float(np.abs(expected - actual).max()))
+        same += int((expected.argmax(-1) == actual.argmax(-1)).sum())
+        n_frames += len(expected)
+    return max_difference, same / n_frames
+
+
+def resident_memory() -> int:
+    "Resident memory of this process in bytes, or its peak where /proc is missing"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _model_memory(config: ModelConfig) -> int:
+    before = resident_memory()
+    model = load_model(config)
+    loaded = resident_memory()
+    del model
+    return loaded - before
+
+
+def model_memory(config: ModelConfig) -> int:
+    """Resident memory that loading a model with config adds to a fresh process,
+    where earlier models and allocator caches cannot skew it"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_model_memory, (config,))
+
+
+def load_audio_set(directory: str | os.PathLike) -> dict[str, np.ndarray]:
+    "Every WAV file in directory as float32 audio in [-1, 1)"
+    return {
+        wav.stem: read_pcm(wav).astype(np.float32) / 32768
+        for wav in sorted(Path(directory).glob("*.wav"))
+    }
+
+
+@dataclass
+class AccuracyResult:
+    name: str
+    memory: int = 0  # bytes of resident memory added by loading the model
+    audio_seconds: float = 0.0
+    compute_seconds: float = 0.0
+    transcripts: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def real_time_factor(self) -> float:
+        return self.compute_seconds / max(self.audio_seconds, 1e-9)
+
+    def add(self, name: str, audio: np.ndarray, model: AcousticModel):
+        start = time.perf_counter()
+        ctc = model(torch.from_numpy(audio)[None])
+        self.compute_seconds += time.perf_counter() - start
+        self.audio_seconds += len(audio) / sample_rate
+        self.transcripts[name] = model.token_encoding.greedy_decode_tokens(ctc)
+
+
+def score_audio_set(
+    name: str, model: AcousticModel, audio_set: dict[str, np.ndarray], memory: int = 0
+) -> AccuracyResult:
+    "Greedy transcripts and timing of model on audio_set, after one warm up call"
+    result = AccuracyResult(name, memory)
+    if audio_set:
+        model(torch.from_numpy(next(iter(audio_set.values())))[None])
+    for audio_name, audio in audio_set.items():
+        result.add(audio_name, audio, model)
+    return result
+
+
+def edit_distance(a: str, b: str) -> int:
+    row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        diagonal, row[0] = row[0], i
+        for j, char_b in enumerate(b, 1):
+            diagonal, row[j] = row[j], min(
+                row[j] + 1, row[j - 1] + 1, diagonal + (char_a != char_b)
+            )
+    return row[-1]
+
+
+def agreement(reference: AccuracyResult, result: AccuracyResult) -> tuple[float, float]:
+    """Fraction of transcripts that are identical to those of reference, and the
+    character error rate of result taking reference's transcripts as the truth"""
+    names = list(reference.transcripts)
+    if not names:
+        return np.nan, np.nan
+    same = sum(reference.transcripts[n] == result.transcripts[n] for n in names)
+    errors = sum(
+        edit_distance(reference.transcripts[n], result.transcripts[n]) for n in names
+    )
+    n_chars = sum(len(reference.transcripts[n]) for n in names)
+    return same / len(names), errors / max(n_chars, 1)
+
+
+def format_accuracy(results: list[AccuracyResult]) -> str:
+    "Table of each result, with agreement measured against the first"
+    lines = [f"{'model':<10}{'rtf':>8}{'rss MiB':>10}{'same':>8}{'cer':>8}"]
+    for r in results:
+        same, cer = agreement(results[0], r)
+        lines.append(
+            f"{r.name:<10}{r.real_time_factor:>8.3f}{r.memory / 2**20:>10.0f}"
+            f"{same:>8.1%}{cer:>8.1%}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--intra-op-threads", type=int)
+    parser.add_argument("--inter-op-threads", type=int)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--audio", help="directory of 16 kHz mono WAV files")
+    parser.add_argument(
+        "--onnx", action="store_true", help="also time the onnxruntime backend"
+    )
+    parser.add_argument(
+        "--buckets",
+        nargs="+",
+        type=float,
+        help="also time a model compiled for these durations in seconds",
+    )
+    parser.add_argument(
+        "--stand-in",
+        action="store_true",
+        help="random weights instead of downloading the model, for timing offline",
+    )
+    args = parser.parse_args()
+
+    config = ModelConfig(
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        stand_in=args.stand_in,
+        # compare the variants as configured here, not as autotune chose
+        tuned=False,
+    )
+    variants = {"int8": replace(config, quantize=True)}
+    if bfloat16_supported():
+        variants["bf16"] = replace(config, bfloat16=True)
+    else:
+        print("This CPU has no native bfloat16, skipping bf16.")
+
+    model = load_model(config)
+    models = {name: load_model(variant) for name, variant in variants.items()}
+    memory = {name: model_memory(variant) for name, variant in variants.items()}
+    memory["fp32"] = model_memory(config)
+
+    if args.audio is not None:
+        audio_set = load_audio_set(args.audio)
+        if not audio_set:
+            parser.error(f"no WAV files in {args.audio}")
+        results = [score_audio_set("fp32", model, audio_set, memory["fp32"])] + [
+            score_audio_set(name, m, audio_set, memory[name])
+            for name, m in models.items()
+        ]
+        print(format_accuracy(results))
+        return
+
+    # the settings of facebook/wav2vec2-base-960h
+    feature_extractor = Wav2Vec2FeatureExtractor(
+        do_normalize=True, return_attention_mask=False
+    )
+    models = {
+        "processor": processor_model(model.model, feature_extractor),
+        "AcousticModel": model,
+        **models,
+    }
+    if args.onnx:
+        models["onnx"] = load_model(replace(config, backend="onnx"))
+    if args.buckets:
+        models["compiled"] = load_model(replace(config, buckets=tuple(args.buckets)))
+    print(compare(models, repeats=args.repeats))
+    if args.buckets:
+        difference, same = padding_deviation(model, models["compiled"])
+        print(
+            f"compiled vs AcousticModel: log probabilities differ by up to "
+            f"{difference:.3g}, {same:.1%} of frames have the same most likely token"
+        )
+
+
+if __name__ == "__main__":
+    main()
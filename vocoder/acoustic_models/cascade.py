@@ -0,0 +1,86 @@
+"""Scoring utterances with a cheap model first and a full one only when the
+decoder is unsure of the cheap model's ctc"""
+
+import time
+import typing as t
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from loguru import logger
+
+from vocoder.acoustic_models.wav2vec2 import sample_rate
+
+AcousticCallable = t.Callable[[torch.Tensor], np.ndarray]
+
+
+@dataclass
+class CascadeMetrics:
+    # utterances decoded, not counting those scored by the first model and then
+    # discarded, like speculations that missed
+    n_utterances: int = 0
+    n_escalated: int = 0
+    audio_seconds: float = 0.0
+    # compute spent in the first model, including on discarded utterances
+    first_seconds: float = 0.0
+    second_seconds: float = 0.0  # compute spent in the second model
+    # audio scored by the second model, to estimate what it costs per second
+    escalated_audio_seconds: float = 0.0
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.n_escalated / max(self.n_utterances, 1)
+
+    @property
+    def compute_saved(self) -> float:
+        """Estimated mean seconds of compute saved per utterance against scoring
+        every utterance with the second model, nan before any escalation"""
+        if not self.escalated_audio_seconds:
+            return np.nan
+        second_cost = self.second_seconds / self.escalated_audio_seconds
+        without = self.audio_seconds * second_cost
+        spent = self.first_seconds + self.second_seconds
+        return (without - spent) / max(self.n_utterances, 1)
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_utterances} utterances, {self.escalation_rate:.0%} escalated, "
+            f"{self.compute_saved * 1000:.0f} ms compute saved per utterance"
+        )
+
+
+class Cascade:
+    """A first model that scores whole utterances, and a second one that scores them
+    again when the decoder is unsure of the first one's ctc, see
+    App.decode_cascaded. Both models must share a TokenEncoding."""
+
+    def __init__(self, first: AcousticCallable, second: AcousticCallable):
+        encodings = [getattr(m, "token_encoding", None) for m in (first, second)]
+        if None not in encodings and encodings[0] != encodings[1]:
+            raise ValueError("The models of a cascade must share a TokenEncoding")
+        self.first = first
+        self.second = second
+        self.metrics = CascadeMetrics()
+
+    def score_first(self, audio: torch.Tensor) -> np.ndarray:
+        start = time.perf_counter()
+        ctc = self.first(audio)
+        self.metrics.first_seconds += time.perf_counter() - start
+        return ctc
+
+    def score_second(self, audio: torch.Tensor) -> np.ndarray:
+        metrics = self.metrics
+        start = time.perf_counter()
+        ctc = self.second(audio)
+        metrics.second_seconds += time.perf_counter() - start
+        metrics.escalated_audio_seconds += audio.shape[-1] / sample_rate
+        return ctc
+
+    def count(self, n_samples: int, escalated: bool):
+        "Count an utterance of n_samples decoded from the ctc of first or of second"
+        metrics = self.metrics
+        metrics.n_utterances += 1
+        metrics.audio_seconds += n_samples / sample_rate
+        if escalated:
+            metrics.n_escalated += 1
+            logger.debug(f"Escalated an utterance, {metrics.summary()}.")
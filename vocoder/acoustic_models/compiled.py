@@ -0,0 +1,175 @@
+"""Scoring audio padded to a few fixed lengths, so that the model can be compiled
+for each of them"""
+
+import time
+import typing as t
+from collections import Counter, deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+from loguru import logger
+from transformers import Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import (
+    AcousticModel,
+    ModelConfig,
+    load_torch_model,
+    sample_rate,
+    whole_frames,
+)
+from vocoder.stitching import samples_per_frame
+from vocoder.token_encoding import TokenEncoding
+
+
+@dataclass
+class BucketStats:
+    buckets: tuple[int, ...]  # in samples
+    hits: Counter[int] = field(default_factory=Counter)
+    n_unbucketed: int = 0  # audio longer than the largest bucket
+    n_samples: int = 0  # samples of audio that was bucketed
+    n_padding: int = 0  # zeros added to it
+    # recent audio lengths in samples, for choosing buckets
+    lengths: deque[int] = field(default_factory=lambda: deque(maxlen=10000))
+
+    def add(self, length: int, bucket: int | None):
+        self.lengths.append(length)
+        if bucket is None:
+            self.n_unbucketed += 1
+            return
+        self.hits[bucket] += 1
+        self.n_samples += length
+        self.n_padding += bucket - length
+
+    @property
+    def n_calls(self) -> int:
+        return sum(self.hits.values()) + self.n_unbucketed
+
+    @property
+    def hit_rates(self) -> dict[int, float]:
+        "Fraction of calls that each bucket took"
+        return {b: self.hits[b] / max(self.n_calls, 1) for b in self.buckets}
+
+    @property
+    def padding_overhead(self) -> float:
+        "Extra samples scored because of padding, as a fraction of the audio"
+        return self.n_padding / max(self.n_samples, 1)
+
+    def summary(self) -> str:
+        rates = ", ".join(
+            f"{b / sample_rate:g} s {rate:.0%}" for b, rate in self.hit_rates.items()
+        )
+        return (
+            f"buckets {rates}, unbucketed {self.n_unbucketed / max(self.n_calls, 1):.0%}"
+            f", padding overhead {self.padding_overhead:.0%}"
+        )
+
+    def suggest_buckets(self, n_buckets: int) -> tuple[float, ...]:
+        """Durations in seconds of n_buckets buckets that would take equal shares of
+        the recent lengths, the largest covering them all"""
+        if not self.lengths:
+            return ()
+        quantiles = np.quantile(
+            np.array(self.lengths), np.arange(1, n_buckets + 1) / n_buckets
+        )
+        frames = np.ceil(quantiles / samples_per_frame) * samples_per_frame
+        return tuple(sorted({float(f) / sample_rate for f in frames}))
+
+
+class CompiledAcousticModel(AcousticModel):
+    """AcousticModel that pads audio up to the nearest of config.buckets and runs a
+    model compiled with torch.compile, which only sees one shape per bucket. Audio
+    longer than every bucket is scored eagerly. Call warm to compile the buckets
+    before the first utterance."""
+
+    def __init__(
+        self,
+        model: Wav2Vec2ForCTC,
+        token_encoding: TokenEncoding,
+        config: ModelConfig,
+    ):
+        super().__init__(model, token_encoding, config)
+        assert config.buckets, "no buckets to compile"
+        self.buckets = tuple(sorted({whole_frames(b) for b in config.buckets}))
+        self.stats = BucketStats(self.buckets)
+        self.compiled: t.Callable[..., t.Any] = self.model
+        # storage sizes of the weights freed by offload, by name
+        self._offloaded: dict[str, int] | None = None
+        if config.compile_backend is not None:
+            self.compiled = torch.compile(
+                self.model, backend=config.compile_backend, dynamic=False
+            )
+        if not self.masks_padding:
+            logger.warning(
+                "The acoustic model cannot mask padding, bucketed audio is scored"
+                " differently than on its own, python -m"
+                " vocoder.acoustic_models.benchmark --buckets measures how much."
+            )
+
+    def warm(self):
+        "Compile the model for every bucket"
+        for bucket in self.buckets:
+            start = time.perf_counter()
+            with torch.inference_mode():
+                self._run(torch.zeros(1, bucket), bucket)
+            logger.info(
+                f"Compiled the {bucket / sample_rate:g} s bucket in "
+                f"{time.perf_counter() - start:.1f} s."
+            )
+        self.stats = BucketStats(self.buckets)
+
+    def _weights(self) -> list[tuple[str, torch.Tensor]]:
+        return [*self.model.named_parameters(), *self.model.named_buffers()]
+
+    def offload(self):
+        """Free the memory of the weights but keep their tensors, and with them the
+        compiled code, which only checks their shapes; see restore. Quantized linear
+        layers keep their packed weights, and memory-mapped weights are left to the
+        page cache, which the kernel reclaims anyway."""
+        if self._offloaded is not None:
+            return
+        offloaded = {
+            name: weight.untyped_storage().nbytes()
+            for name, weight in self._weights()
+            if weight.untyped_storage().resizable()
+        }
+        for name, weight in self._weights():
+            if name in offloaded:
+                weight.untyped_storage().resize_(0)
+        self._offloaded = offloaded or None
+
+    def restore(self, config: ModelConfig) -> "CompiledAcousticModel":
+        "Copy the weights of the model of config into the offloaded ones"
+        if self._offloaded is None:
+            return self
+        model = load_torch_model(config)
+        loaded = dict(model.named_parameters()) | dict(model.named_buffers())
+        with torch.no_grad():
+            for name, weight in self._weights():
+                if name in self._offloaded:
+                    weight.untyped_storage().resize_(self._offloaded[name])
+                    weight.copy_(loaded[name])
+        self._offloaded = None
+        return self
+
+    def _run(self, x: torch.Tensor, bucket: int) -> torch.Tensor:
+        "Logits of x padded to bucket samples"
+        n = x.shape[-1]
+        padded = torch.zeros(1, bucket, dtype=self.dtype)
+        padded[0, :n] = x[0]
+        attention_mask = None
+        if self.masks_padding:
+            attention_mask = (torch.arange(bucket) < n)[None].long()
+        logits = self.compiled(padded, attention_mask=attention_mask).logits[0]
+        n_frames = int(self.model._get_feat_extract_output_lengths(torch.tensor(n)))
+        return logits[:n_frames]
+
+    def log_probabilities(self, x: torch.Tensor) -> np.ndarray:
+        n = x.shape[-1]
+        bucket = next((b for b in self.buckets if b >= n), None)
+        self.stats.add(n, bucket)
+        if self.stats.n_calls % 100 == 0:
+            logger.info(f"Acoustic model {self.stats.summary()}.")
+        if bucket is None:
+            return super().log_probabilities(x)
+        return torch.log_softmax(self._run(x, bucket).float(), dim=-1).numpy()
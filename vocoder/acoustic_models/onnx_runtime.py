@@ -0,0 +1,128 @@
+"""Run wav2vec2 with onnxruntime's CPU execution provider. Needs the optional
+onnx and onnxruntime packages, pip install vocoder-dictation[onnx]"""
+
+import hashlib
+import os
+import typing as t
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+from loguru import logger
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
+
+from vocoder.acoustic_models.wav2vec2 import (
+    AcousticModel,
+    ModelConfig,
+    cache_dir,
+    load_wav2vec2,
+    set_threads,
+    token_encoding,
+    wav2vec2_config,
+)
+from vocoder.audio_source import sample_rate
+from vocoder.token_encoding import TokenEncoding
+
+opset_version = 17
+# bump when the exported graph changes, so old exports are not reused
+export_version = 1
+
+
+class LogSoftmaxWav2Vec2(torch.nn.Module):
+    "Export wrapper whose output is log probabilities rather than logits"
+
+    def __init__(self, model: Wav2Vec2ForCTC):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_values: torch.Tensor) -> torch.Tensor:
+        logits = self.model(input_values).logits
+        return torch.log_softmax(logits.float(), dim=-1)
+
+
+def export_path(name: str, model_config: Wav2Vec2Config) -> Path:
+    "Where the export of the model called name with model_config is cached"
+    key = "\n".join(
+        [name, model_config.to_json_string(), str(opset_version), str(export_version)]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return cache_dir() / "onnx" / f"{name.replace('/', '--')}-{digest}.onnx"
+
+
+def export(model: Wav2Vec2ForCTC, path: str | os.PathLike):
+    "Export model to path with a dynamic number of samples"
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # export next to path and rename, so that an interrupted export is not cached
+    partial = path.with_suffix(f".{os.getpid()}.partial")
+    with torch.no_grad(), warnings.catch_warnings():
+        # tracing warns about python control flow that is constant for wav2vec2
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        torch.onnx.export(
+            LogSoftmaxWav2Vec2(model.eval()),
+            (torch.zeros(1, sample_rate),),
+            str(partial),
+            input_names=["input_values"],
+            output_names=["log_probs"],
+            dynamic_axes={"input_values": {1: "samples"}, "log_probs": {1: "frames"}},
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    os.replace(partial, path)
+
+
+class OnnxAcousticModel(AcousticModel):
+    "AcousticModel that scores audio with an onnxruntime session of an export"
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        token_encoding: TokenEncoding,
+        config: ModelConfig | None = None,
+    ):
+        import onnxruntime as ort
+
+        self.path = Path(path)
+        self.token_encoding = token_encoding
+        self.config = config or ModelConfig(backend="onnx")
+        self._scratch = torch.empty(0, dtype=torch.float32)
+        # normalize still runs in torch
+        set_threads(self.config)
+
+        options = ort.SessionOptions()
+        if self.config.intra_op_threads is not None:
+            options.intra_op_num_threads = self.config.intra_op_threads
+        if self.config.inter_op_threads is not None:
+            options.inter_op_num_threads = self.config.inter_op_threads
+        self.session = ort.InferenceSession(
+            str(self.path), options, providers=["CPUExecutionProvider"]
+        )
+
+    @property
+    def masks_padding(self) -> bool:
+        # batches are never padded
+        return True
+
+    def batch(self, audios: t.Sequence[torch.Tensor | np.ndarray]) -> list[np.ndarray]:
+        "One at a time, the export has a batch size of 1"
+        return [self(audio) for audio in audios]
+
+    def log_probabilities(self, x: torch.Tensor) -> np.ndarray:
+        (log_probs,) = self.session.run(None, {"input_values": x.numpy()})
+        return log_probs[0]
+
+
+def load_onnx_model(config: ModelConfig) -> OnnxAcousticModel:
+    "Load the cached export of config.name, exporting it first if needed"
+    if config.quantize or config.bfloat16:
+        raise ValueError("The onnx backend does not support quantize or bfloat16")
+    if config.buckets:
+        raise ValueError("The onnx backend does not support buckets")
+
+    name = f"{config.name}-stand-in" if config.stand_in else config.name
+    path = export_path(name, wav2vec2_config(config))
+    if not path.exists():
+        logger.info(f"Exporting {name} to {path}")
+        export(load_wav2vec2(config), path)
+    return OnnxAcousticModel(path, token_encoding, config)
@@ -1,21 +1,600 @@
+import gc
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import typing as t
+import warnings
+from dataclasses import dataclass, replace
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
 import transformers
-from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
+from loguru import logger
+from transformers import Wav2Vec2Config, Wav2Vec2ForCTC
 
+from vocoder.stitching import CtcStitcher, samples_per_frame
 from vocoder.token_encoding import TokenEncoding
 
 transformers.logging.set_verbosity_error()
 
+# wav2vec2 is trained on 16 kHz audio
+sample_rate = 16000
+# samples that the convolutional feature encoder needs for one frame
+receptive_field = 400
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    name: str = "facebook/wav2vec2-base-960h"
+    # torch thread pools, None keeps torch's defaults
+    intra_op_threads: int | None = None
+    inter_op_threads: int | None = None
+    # int8 dynamic quantization of the linear layers, check the accuracy with
+    # python -m vocoder.acoustic_models.benchmark --audio DIRECTORY first
+    quantize: bool = False
+    # keep weights and activations in bfloat16 on CPUs that compute in it natively,
+    # falling back to float32 elsewhere
+    bfloat16: bool = False
+    # "torch" or "onnx", which runs an exported copy of the model with
+    # onnxruntime, see vocoder.acoustic_models.onnx_runtime
+    backend: str = "torch"
+    # random weights with the architecture of facebook/wav2vec2-base-960h instead
+    # of downloading name, for measuring inference cost offline
+    stand_in: bool = False
+    # audio longer than window_duration seconds is scored in windows that overlap
+    # by window_overlap seconds and stitched, so that the cost of self-attention
+    # grows linearly with its length rather than quadratically
+    window_duration: float | None = 15.0
+    window_overlap: float = 2.0
+    # keep a safetensors copy of the weights in the cache directory and memory-map
+    # it, so that the weights live in the page cache rather than in the process
+    mmap_weights: bool = False
+    # pad audio up to the nearest of these durations in seconds and run a model
+    # compiled once per bucket by torch.compile with compile_backend, None only
+    # pads, see vocoder.acoustic_models.compiled
+    buckets: tuple[float, ...] | None = None
+    compile_backend: str | None = "inductor"
+    # release the model after release_after seconds without scoring audio, and
+    # load it again in the background when the vad next detects speech
+    release_after: float | None = None
+    # take the threads, precision, backend and windowing that
+    # python -m vocoder.acoustic_models.autotune measured to be fastest for this
+    # model on this machine, for those of them that are left at their defaults
+    tuned: bool = False
+
+    @property
+    def window_samples(self) -> float:
+        if self.window_duration is None:
+            return float("inf")
+        return whole_frames(self.window_duration)
+
+    @property
+    def window_overlap_samples(self) -> int:
+        return whole_frames(self.window_overlap)
+
+
+def whole_frames(duration: float) -> int:
+    "Samples in duration seconds, rounded to whole ctc frames"
+    return round(duration * sample_rate / samples_per_frame) * samples_per_frame
+
+
+def windows(n_samples: int, window: float, overlap: int) -> list[tuple[int, int]]:
+    """(start, end) of windows of window samples that cover n_samples and overlap
+    by overlap samples. A last window shorter than receptive_field is merged into
+    the one before, which can then be up to receptive_field samples longer."""
+    if n_samples <= window:
+        return [(0, n_samples)]
+    assert window > overlap, "windows must be longer than their overlap"
+    window = int(window)
+    starts = [0]
+    while starts[-1] + window < n_samples:
+        starts.append(starts[-1] + window - overlap)
+    if n_samples - starts[-1] < receptive_field:
+        starts.pop()
+    ends = [start + window for start in starts[:-1]] + [n_samples]
+    return list(zip(starts, ends))
+
+
+class AcousticModel:
+    """Scores 16 kHz float32 audio in [-1, 1) with a wav2vec2 ctc model and returns
+    contiguous float32 log probabilities of shape (frames, tokens).
+
+    Audio is normalized to zero mean and unit variance, like Wav2Vec2Processor
+    does, into a scratch buffer that is reused across calls, so the caller's
+    audio is left untouched. Not safe to call from several threads at once.
+    """
+
+    def __init__(
+        self,
+        model: Wav2Vec2ForCTC,
+        token_encoding: TokenEncoding,
+        config: ModelConfig | None = None,
+    ):
+        self.model = model.eval()
+        self.dtype = next(model.parameters()).dtype
+        self.token_encoding = token_encoding
+        self.config = config or ModelConfig()
+        self._scratch = torch.empty(0, dtype=torch.float32)
+        set_threads(self.config)
+
+    def normalize(self, audio: torch.Tensor) -> torch.Tensor:
+        n = audio.shape[-1]
+        if len(self._scratch) < n:
+            self._scratch = torch.empty(2 * n, dtype=torch.float32)
+        x = self._scratch[:n]
+        x.copy_(audio.reshape(-1))
+        var, mean = torch.var_mean(x, unbiased=False)
+        x.sub_(mean).div_(torch.sqrt(var + 1e-7))
+        return x[None]
+
+    def log_probabilities(self, x: torch.Tensor) -> np.ndarray:
+        "Log probabilities of normalized audio x of shape (1, samples)"
+        logits = self.model(x.to(self.dtype)).logits[0]
+        return torch.log_softmax(logits.float(), dim=-1).numpy()
+
+    def __call__(self, audio: torch.Tensor | np.ndarray) -> np.ndarray:
+        if isinstance(audio, np.ndarray):
+            audio = torch.from_numpy(audio)
+        with torch.inference_mode():
+            x = self.normalize(audio)
+            spans = windows(
+                x.shape[-1],
+                self.config.window_samples,
+                self.config.window_overlap_samples,
+            )
+            if len(spans) == 1:
+                log_probs = self.log_probabilities(x)
+            else:
+                log_probs = self.windowed_log_probabilities(x, spans)
+        return np.ascontiguousarray(log_probs, dtype=np.float32)
+
+    @property
+    def masks_padding(self) -> bool:
+        """Whether padded audio in a batch is scored exactly as on its own. wav2vec2
+        models that group normalize their first conv layer, like wav2vec2-base,
+        take no attention mask and see the padding"""
+        return self.model.config.feat_extract_norm == "layer"
+
+    def batch(self, audios: t.Sequence[torch.Tensor | np.ndarray]) -> list[np.ndarray]:
+        """Score several pieces of audio in one zero padded forward pass and return
+        the ctc of each. Audio longer than a window is scored on its own."""
+        audios = [
+            torch.from_numpy(a) if isinstance(a, np.ndarray) else a for a in audios
+        ]
+        out = list[np.ndarray | None]([None] * len(audios))
+        batched = list[int]()
+        for i, audio in enumerate(audios):
+            if audio.shape[-1] > self.config.window_samples:
+                out[i] = self(audio)
+            else:
+                batched.append(i)
+        if len(batched) == 1:
+            out[batched[0]] = self(audios[batched[0]])
+        elif batched:
+            lengths = torch.tensor([audios[i].shape[-1] for i in batched])
+            with torch.inference_mode():
+                x = torch.zeros(len(batched), int(lengths.max()))
+                for row, i in enumerate(batched):
+                    x[row, : lengths[row]] = self.normalize(audios[i])[0]
+                log_probs = self.batch_log_probabilities(x, lengths)
+            for i, ctc in zip(batched, log_probs):
+                out[i] = np.ascontiguousarray(ctc, dtype=np.float32)
+        return t.cast(list[np.ndarray], out)
+
+    def batch_log_probabilities(
+        self, x: torch.Tensor, lengths: torch.Tensor
+    ) -> list[np.ndarray]:
+        "Log probabilities of each row of normalized audio x, zero padded to lengths"
+        attention_mask = None
+        if self.masks_padding:
+            attention_mask = torch.arange(x.shape[1])[None] < lengths[:, None]
+            attention_mask = attention_mask.long()
+        logits = self.model(x.to(self.dtype), attention_mask=attention_mask).logits
+        log_probs = torch.log_softmax(logits.float(), dim=-1).numpy()
+        n_frames = self.model._get_feat_extract_output_lengths(lengths)
+        return [ctc[:n] for ctc, n in zip(log_probs, n_frames.tolist())]
+
+    def windowed_log_probabilities(
+        self, x: torch.Tensor, spans: list[tuple[int, int]]
+    ) -> np.ndarray:
+        "Score normalized audio x one window at a time and stitch the windows"
+        stitcher = CtcStitcher()
+        last_end = 0
+        for start, end in spans:
+            window = self.log_probabilities(x[:, start:end])
+            stitcher.add(window, end - start, max(last_end - start, 0))
+            last_end = end
+        return stitcher.finish()
+
+
+class ReleasingModel:
+    """Scores audio like the AcousticModel returned by load, releasing it after
+    release_after seconds without scoring and loading it again on the next call, or
+    in the background on prefetch"""
+
+    def __init__(
+        self,
+        load: t.Callable[[], AcousticModel],
+        release_after: float,
+        model: AcousticModel | None = None,
+        on_release: t.Callable[[], t.Any] | None = None,
+    ):
+        self.load = load
+        self.release_after = release_after
+        self.on_release = on_release  # called after the model is released
+        self._model = model
+        self._token_encoding = getattr(model, "token_encoding", None)
+        self._in_use = 0
+        self._timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+        self._closed = False
+        if model is not None:
+            self._release_later()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def token_encoding(self) -> TokenEncoding:
+        "The TokenEncoding of the model, which is loaded for it if it never was"
+        if self._token_encoding is None:
+            self._token_encoding = self._acquire().token_encoding
+            self._done()
+        return self._token_encoding
+
+    def _acquire(self) -> AcousticModel:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._model is None:
+                start = time.perf_counter()
+                self._model = self.load()
+                logger.info(
+                    f"Reloaded the acoustic model in {time.perf_counter() - start:.2f} s."
+                )
+            self._in_use += 1
+            return self._model
+
+    def _done(self):
+        with self._lock:
+            self._in_use -= 1
+        self._release_later()
+
+    def _release_later(self):
+        with self._lock:
+            if self._in_use == 0 and self._timer is None and not self._closed:
+                self._timer = threading.Timer(self.release_after, self.release)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def release(self):
+        "Release the model unless it is in use, the next call loads it again"
+        with self._lock:
+            self._timer = None
+            if self._model is None or self._in_use:
+                return
+            self._model = None
+            if self.on_release is not None:
+                self.on_release()
+        gc.collect()
+        logger.info("Released the idle acoustic model.")
+
+    def prefetch(self):
+        """Start loading the model in a background thread if it was released, for
+        example when speech starts, so that the load overlaps the utterance"""
+        if self._model is None and not self._closed:
+            threading.Thread(
+                target=self._prefetch, name="vocoder-model-reload", daemon=True
+            ).start()
+
+    def _prefetch(self):
+        self._acquire()
+        self._done()
+
+    def close(self):
+        "Stop releasing the model"
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def __call__(self, audio: torch.Tensor | np.ndarray) -> np.ndarray:
+        model = self._acquire()
+        try:
+            return model(audio)
+        finally:
+            self._done()
+
+    def batch(self, audios: t.Sequence[torch.Tensor | np.ndarray]) -> list[np.ndarray]:
+        model = self._acquire()
+        try:
+            return model.batch(audios)
+        finally:
+            self._done()
+
+    @property
+    def masks_padding(self) -> bool:
+        model = self._acquire()
+        try:
+            return model.masks_padding
+        finally:
+            self._done()
+
+
+def set_threads(config: ModelConfig):
+    if config.intra_op_threads is not None:
+        torch.set_num_threads(config.intra_op_threads)
+    if config.inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(config.inter_op_threads)
+        except RuntimeError:
+            # only possible before torch has run any parallel work
+            logger.warning("Could not set the number of inter-op threads.")
+
+
+def quantize(model: Wav2Vec2ForCTC) -> Wav2Vec2ForCTC:
+    """Replace the linear layers of model with ones that have int8 weights and
+    quantize activations on the fly, in place so the fp32 weights can be freed"""
+    with warnings.catch_warnings():
+        # eager mode quantization is deprecated in favour of torchao
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return torch.ao.quantization.quantize_dynamic(
+            model.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+
+def bfloat16_supported() -> bool:
+    """Whether the CPU computes in bfloat16 natively rather than emulating it slowly,
+    from the x86 or arm flags in /proc/cpuinfo and otherwise from oneDNN"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            if re.search(r"\b(avx512_bf16|amx_bf16|bf16)\b", f.read()):
+                return True
+    except OSError:
+        pass
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def stand_in_config() -> Wav2Vec2Config:
+    "The architecture of facebook/wav2vec2-base-960h, with our token_encoding"
+    return Wav2Vec2Config(
+        vocab_size=token_encoding.n_tokens,
+        pad_token_id=token_encoding.blank,
+        feat_extract_norm="group",
+        do_stable_layer_norm=False,
+    )
+
+
+def stand_in_model(seed: int = 0) -> Wav2Vec2ForCTC:
+    "Wav2Vec2ForCTC with random weights that costs as much to run as the real one"
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        return Wav2Vec2ForCTC(stand_in_config()).eval()
+
+
+def wav2vec2_config(config: ModelConfig) -> Wav2Vec2Config:
+    if config.stand_in:
+        return stand_in_config()
+    return Wav2Vec2Config.from_pretrained(config.name)
+
+
+def cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "vocoder"
+
+
+def config_dir() -> Path:
+    base = os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config"
+    return Path(base) / "vocoder"
+
+
+def tuned_configs_path() -> Path:
+    "Where autotune writes the fields it chose, by model_key"
+    return config_dir() / "autotune.json"
+
+
+# fields that autotune chooses, a group is only applied if none of its fields are set
+tuned_groups = (
+    ("intra_op_threads",),
+    ("quantize", "bfloat16", "backend"),
+    ("window_duration",),
+)
+
+
+# fields that only the torch backend supports
+torch_only_fields = ("buckets", "mmap_weights")
+
+
+def unsupported_fields(config: ModelConfig) -> list[str]:
+    "Fields that config sets but that its backend does not support"
+    if config.backend == "torch":
+        return []
+    defaults = ModelConfig()
+    return [f for f in torch_only_fields if getattr(config, f) != getattr(defaults, f)]
+
+
+def model_key(config: ModelConfig) -> str:
+    return f"{config.name}-stand-in" if config.stand_in else config.name
+
+
+def apply_tuned(config: ModelConfig) -> ModelConfig:
+    """config with the fields that autotune chose for its model, in the groups of
+    tuned_groups that config leaves at their defaults and that do not conflict with
+    the fields config sets"""
+    if not config.tuned:
+        return config
+    try:
+        with open(tuned_configs_path()) as f:
+            tuned = json.load(f).get(model_key(config), {})
+    except FileNotFoundError:
+        return config
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring the autotuned configuration: {e}")
+        return config
+
+    defaults = ModelConfig()
+    changes = dict[str, t.Any]()
+    for group in tuned_groups:
+        if any(getattr(config, f) != getattr(defaults, f) for f in group):
+            continue
+        group_changes = {f: tuned[f] for f in group if f in tuned}
+        conflicts = unsupported_fields(replace(config, **group_changes))
+        if conflicts:
+            logger.warning(
+                f"Not using the autotuned {group_changes}, which does not support "
+                f"{', '.join(conflicts)}."
+            )
+            continue
+        changes.update(group_changes)
+    if not changes:
+        return config
+    logger.info(f"Using the autotuned {changes}.")
+    return replace(config, **changes)
+
+
+def weights_path(config: ModelConfig, model_config: Wav2Vec2Config) -> Path:
+    "Where the safetensors copy of the weights of the model of config is cached"
+    name = f"{config.name}-stand-in" if config.stand_in else config.name
+    # parameter names can change between versions of transformers
+    key = "\n".join([name, model_config.to_json_string(), transformers.__version__])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return cache_dir() / "weights" / f"{name.replace('/', '--')}-{digest}.safetensors"
+
+
+def save_weights(model: Wav2Vec2ForCTC, path: str | os.PathLike):
+    from safetensors.torch import save_file
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # save next to path and rename, so that an interrupted save is not cached
+    partial = path.with_suffix(f".{os.getpid()}.partial")
+    save_file({k: v.contiguous() for k, v in model.state_dict().items()}, partial)
+    os.replace(partial, path)
+
+
+_safetensors_dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_weights(path: str | os.PathLike) -> dict[str, torch.Tensor]:
+    """The tensors of a safetensors file as views of a private memory map of it,
+    which are read from the page cache on use rather than copied into memory"""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    start = 8 + header_size
+    storage = torch.UntypedStorage.from_file(
+        str(path), shared=False, nbytes=os.path.getsize(path)
+    )
+
+    tensors = dict[str, torch.Tensor]()
+    for name, info in header.items():
+        dtype = _safetensors_dtypes[info["dtype"]]
+        offset, _ = info["data_offsets"]
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        if (start + offset) % itemsize:
+            raise ValueError(f"{path}: {name} is not aligned to its dtype")
+        tensors[name] = torch.empty(0, dtype=dtype).set_(
+            storage, (start + offset) // itemsize, info["shape"]
+        )
+    return tensors
+
+
+def load_mmap_wav2vec2(config: ModelConfig) -> Wav2Vec2ForCTC:
+    "Wav2Vec2ForCTC with memory-mapped weights, saving them to the cache first"
+    model_config = wav2vec2_config(config)
+    path = weights_path(config, model_config)
+    if not path.exists():
+        logger.info(f"Saving the weights of {config.name} to {path}")
+        save_weights(load_wav2vec2(replace(config, mmap_weights=False)), path)
+
+    with torch.device("meta"):
+        model = Wav2Vec2ForCTC(model_config)
+    model.load_state_dict(mmap_weights(path), assign=True)
+    return model.eval()
+
+
+def load_wav2vec2(config: ModelConfig) -> Wav2Vec2ForCTC:
+    if config.mmap_weights:
+        return load_mmap_wav2vec2(config)
+    if config.stand_in:
+        logger.warning("Using a stand-in acoustic model with random weights.")
+        return stand_in_model()
+    return Wav2Vec2ForCTC.from_pretrained(config.name)
+
+
+def load_torch_model(config: ModelConfig) -> Wav2Vec2ForCTC:
+    "The wav2vec2 module of config, quantized or in bfloat16 if config asks for it"
+    if config.quantize and config.bfloat16:
+        raise ValueError("Choose one of quantize and bfloat16")
+
+    model = load_wav2vec2(config)
+    if config.quantize:
+        model = quantize(model)
+    if config.bfloat16:
+        if bfloat16_supported():
+            model = model.to(torch.bfloat16)
+        else:
+            logger.warning("This CPU has no native bfloat16, using float32.")
+    if config.quantize or config.bfloat16:
+        # the replaced float32 weights are only freed by the cycle collector
+        gc.collect()
+    return model
+
+
+def load_model(config: ModelConfig | None = None) -> AcousticModel | ReleasingModel:
+    config = apply_tuned(config or ModelConfig())
+    if config.release_after is not None:
+        inner = replace(config, release_after=None, tuned=False)
+        model = load_model(inner)
+        if config.buckets:
+            # keep the compiled module across releases and only free its weights,
+            # compiling it again would take minutes
+            return ReleasingModel(
+                partial(model.restore, inner),
+                config.release_after,
+                model,
+                on_release=model.offload,
+            )
+        return ReleasingModel(partial(load_model, inner), config.release_after, model)
+    if config.backend == "onnx":
+        from vocoder.acoustic_models.onnx_runtime import load_onnx_model
 
-def load_model():
-    processor = Wav2Vec2Processor.from_pretrained("facebook/wav2vec2-base-960h")
-    model = Wav2Vec2ForCTC.from_pretrained("facebook/wav2vec2-base-960h")
+        return load_onnx_model(config)
+    if config.backend != "torch":
+        raise ValueError(f"Unknown acoustic model backend {config.backend!r}")
 
-    def _model(x):
-        in_ = processor(x, sampling_rate=16000, return_tensors="pt").input_values[0]
-        logits = model(in_).logits[0]
-        return logits.detach().cpu().numpy()
+    model = load_torch_model(config)
+    if config.buckets:
+        from vocoder.acoustic_models.compiled import CompiledAcousticModel
 
-    return _model
+        compiled = CompiledAcousticModel(model, token_encoding, config)
+        compiled.warm()
+        return compiled
+    return AcousticModel(model, token_encoding, config)
 
 
 token_encoding = TokenEncoding.from_str_to_token(
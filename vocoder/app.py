@@ -1,27 +1,72 @@
 import asyncio as aio
 import signal
+import time
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 
+import numpy as np
+import torch
 from aioconsole import ainput
 from loguru import logger
 
 from vocoder import exceptions
-from vocoder.acoustic_models.wav2vec2 import load_model, token_encoding
-from vocoder.audio_to_ctc import ctc_serve
+from vocoder.acoustic_models.cascade import Cascade
+from vocoder.acoustic_models.wav2vec2 import ModelConfig, load_model, token_encoding
+from vocoder.audio_source import AudioSource, blocksize
+from vocoder.audio_to_ctc import CascadedCtc, ctc_serve
 from vocoder.compile_grammar import compile_grammar
 from vocoder.grammar import Grammar
 from vocoder.namespace import Namespace
-from vocoder.soft_beam_search import beam_search
-from vocoder.soft_simulate import Executor, initial_path_leaves, simplify, text_simulate
-from vocoder.utils import panic, vocoder_listening_message, vocoder_welcome_message
+from vocoder.soft_beam_search import BeamSearch
+from vocoder.soft_simulate import (
+    Executor,
+    PathLeaves,
+    can_continue,
+    initial_path_leaves,
+    simplify,
+    text_simulate,
+)
+from vocoder.stitching import CtcStream, samples_per_frame
+from vocoder.utils import (
+    iter_queue,
+    panic,
+    until_exit,
+    vocoder_listening_message,
+    vocoder_welcome_message,
+)
+from vocoder.vad import VadConfig
 
 
 @dataclass
 class App:
     grammar: Grammar
     quiet: bool = False
+    audio_source: AudioSource | None = None  # defaults to the microphone
+    vad_config: VadConfig = field(default_factory=VadConfig)
+    model_config: ModelConfig = field(default_factory=ModelConfig)
+    # scores audio instead of loading a model with model_config, for example an
+    # InferenceScheduler shared by several apps
+    model: t.Callable[[torch.Tensor], np.ndarray] | None = None
+    max_in_flight: int = 2  # segments queued for or in the acoustic model
+    # decode utterances part by part while they are being scored, use with a short
+    # VadConfig.max_segment_duration
+    stream: bool = False
+    # start loading the acoustic model in a worker thread as soon as the App is
+    # constructed, so that it overlaps compiling the grammar; not needed for text
+    preload_model: bool = True
+    # a smaller model that scores each whole utterance first, which is scored again
+    # with the main model only when the decoding of the small model's ctc beats
+    # its runner up by less than cascade_margin, a log probability; not used when
+    # streaming
+    cascade_config: ModelConfig | None = None
+    cascade_margin: float = 5.0
 
     exit_event: aio.Event = field(default_factory=aio.Event, init=False)
+    _model_future: Future | None = field(default=None, init=False, repr=False)
+    _cascade: Cascade | None = field(default=None, init=False, repr=False)
+    # the last ctc accepted by endpoint, the automaton state and its search
+    _endpointed: tuple | None = field(default=None, init=False, repr=False)
 
     def __post_init__(self):
         if self.quiet:
@@ -29,6 +74,40 @@ class App:
 
         vocoder_welcome_message()
 
+        if self.preload_model:
+            self.start_loading_model()
+
+    def start_loading_model(self):
+        "Load the acoustic model in a worker thread, if it is not already loading"
+        if self._model_future is not None:
+            return
+        if self.model is not None and self.cascade_config is None:
+            self._model_future = Future()
+            self._model_future.set_result(self.model)
+            return
+
+        def _load():
+            model = self.model
+            if model is None:
+                start = time.perf_counter()
+                model = load_model(self.model_config)
+                logger.info(
+                    f"Loaded the acoustic model in {time.perf_counter() - start:.2f} s."
+                )
+            if self.cascade_config is not None:
+                start = time.perf_counter()
+                first = load_model(self.cascade_config)
+                logger.info(
+                    f"Loaded the cascade's first model in "
+                    f"{time.perf_counter() - start:.2f} s."
+                )
+                self._cascade = Cascade(first, model)
+            return model
+
+        pool = ThreadPoolExecutor(1, thread_name_prefix="vocoder-model-load")
+        self._model_future = pool.submit(_load)
+        pool.shutdown(wait=False)
+
     def exit(self):
         logger.info("Exiting...")
         self.exit_event.set()
@@ -38,23 +117,30 @@ class App:
 
     async def run_async(self, text: bool = False):
         try:
+            if not text:
+                self.start_loading_model()
+
+            start = time.perf_counter()
             self.lexicons = self.grammar.lexicon_registry
             self.automaton = compile_grammar(
                 self.grammar.config,
                 self.grammar.lexicon_registry,
                 self.grammar.attribute_registry,
             )
+            compiled = time.perf_counter()
+            logger.info(f"Compiled the grammar in {compiled - start:.2f} s.")
 
             env = Namespace(app=self)
             self.executor = Executor(self.lexicons, env)
-
-            if not text:
-                self.model = load_model()
+            # until the acoustic model is loaded, see main_loop_asr
             self.token_encoding = token_encoding
 
             self.automaton_state = initial_path_leaves(self.automaton)
             self.automaton_state, output = simplify(self.automaton_state)
             self.executor.eat([], output)
+            logger.info(
+                f"Simplified the initial state in {time.perf_counter() - compiled:.2f} s."
+            )
 
         except KeyboardInterrupt:
             return
@@ -74,28 +160,48 @@ class App:
             panic("main loop did not end on time")
 
     async def main_loop_asr(self):
-
-        async with ctc_serve(self.model, self.exit_event) as ctc_queue:
+        start = time.perf_counter()
+        self.start_loading_model()
+        assert self._model_future is not None
+        model_future = aio.wrap_future(self._model_future)
+        await until_exit(model_future, self.exit_event)
+        if self.exit_event.is_set():
+            return
+        self.model = model_future.result()
+        # plain callables standing in for a model score with wav2vec2's encoding
+        self.token_encoding = getattr(self.model, "token_encoding", token_encoding)
+        logger.info(
+            f"Waited {time.perf_counter() - start:.2f} s for the acoustic model."
+        )
+
+        async with ctc_serve(
+            self.model,
+            self.exit_event,
+            self.audio_source,
+            self.vad_config,
+            self.endpoint,
+            self.max_in_flight,
+            self.stream,
+            self._cascade,
+        ) as ctc_queue:
 
             vocoder_listening_message()
 
-            while not self.exit_event.is_set():
-
-                try:
-                    ctc = await aio.wait_for(ctc_queue.get(), 0.001)
-                except aio.TimeoutError:
-                    continue
+            async for ctc in iter_queue(ctc_queue, self.exit_event):
 
                 logger.info("Detected voice activity.")
-                new_words, prob, leaves = beam_search(
-                    self.automaton,
-                    self.lexicons,
-                    self.automaton_state,
-                    ctc,
-                    self.token_encoding,
-                    8,
-                    8,
-                )
+                if isinstance(ctc, CtcStream):
+                    decoded = await self.decode_stream(ctc)
+                    if decoded is None:
+                        break
+                    new_words, prob, leaves = decoded
+                elif isinstance(ctc, CascadedCtc):
+                    decoded = await self.decode_cascaded(ctc)
+                    if decoded is None:
+                        break
+                    new_words, prob, leaves = decoded
+                else:
+                    new_words, prob, leaves = self.decode(ctc)
 
                 if not new_words:
                     logger.info("Did not detect speech.")
@@ -106,6 +212,83 @@ class App:
                 self.automaton_state, output = simplify(leaves)
                 self.executor.eat(new_words, output)
 
+        if self._cascade is not None:
+            logger.info(f"Cascade: {self._cascade.metrics.summary()}.")
+
+    def beam_search(self) -> BeamSearch:
+        "A search from the current automaton state"
+        return BeamSearch(
+            self.automaton,
+            self.lexicons,
+            self.automaton_state,
+            self.token_encoding,
+            8,
+            8,
+        )
+
+    def search(self, ctc: np.ndarray) -> BeamSearch:
+        "A search over ctc, the one of endpoint if it accepted ctc in this state"
+        if self._endpointed is not None:
+            endpointed_ctc, state, search = self._endpointed
+            if endpointed_ctc is ctc and state is self.automaton_state:
+                return search
+        search = self.beam_search()
+        search.step(ctc)
+        return search
+
+    def decode(self, ctc: np.ndarray) -> tuple[tuple[str, ...], float, PathLeaves]:
+        return self.search(ctc).result()
+
+    async def decode_stream(
+        self, ctc_stream: CtcStream
+    ) -> tuple[tuple[str, ...], float, PathLeaves] | None:
+        "Decode chunks of ctc as they arrive, None if the app exits first"
+        search = self.beam_search()
+        async for frames in iter_queue(ctc_stream, self.exit_event):
+            if frames is None:
+                return search.result()
+            search.step(frames)
+        return None
+
+    async def decode_cascaded(
+        self, cascaded: CascadedCtc
+    ) -> tuple[tuple[str, ...], float, PathLeaves] | None:
+        """Decode the first model's ctc of an utterance, or the second model's if the
+        best decoding of the first beats its runner up by less than cascade_margin,
+        None if the app exits first. The automaton state is that of the decode, since
+        the margin depends on what the grammar expects next."""
+        assert self._cascade is not None
+        search = self.search(cascaded.ctc)
+        if search.margin() >= self.cascade_margin:
+            self._cascade.count(cascaded.n_samples, escalated=False)
+            return search.result()
+        ctc = await until_exit(cascaded.rescore(), self.exit_event)
+        if ctc is None:
+            return None
+        self._cascade.count(cascaded.n_samples, escalated=True)
+        return self.decode(ctc)
+
+    def endpoint(self, ctc: np.ndarray) -> bool:
+        """Whether the ctc of an utterance that may still continue can be taken as
+        the whole utterance: it ends in blanks and decodes to words after which the
+        grammar expects no other word in the utterance"""
+        n_blocks = self.vad_config.offered_silence_blocks
+        tail = ctc[-max(int(n_blocks * blocksize // samples_per_frame), 1) :]
+        log_probs = tail - np.logaddexp.reduce(tail, axis=1, keepdims=True)
+        blank_probability = np.exp(log_probs[:, self.token_encoding.blank]).mean()
+        if blank_probability < self.vad_config.endpoint_blank_probability:
+            return False
+
+        search = self.search(ctc)
+        words = search.result()[0]
+        if not words or can_continue(
+            self.automaton, self.lexicons, self.automaton_state, words
+        ):
+            return False
+
+        self._endpointed = ctc, self.automaton_state, search
+        return True
+
     async def main_loop_repl(self):
 
         async for utterance in _text_prompt(self.exit_event):
@@ -128,10 +311,13 @@ class App:
 
 
 async def _text_prompt(exit_event: aio.Event):
-    while True:
-        input_task = aio.create_task(ainput(">>> "))
-        while not input_task.done() and not exit_event.is_set():
-            await aio.sleep(0.005)
-        if exit_event.is_set():
-            return
-        yield input_task.result()
+    exit_task = aio.create_task(exit_event.wait())
+    try:
+        while True:
+            input_task = aio.create_task(ainput(">>> "))
+            await aio.wait((input_task, exit_task), return_when=aio.FIRST_COMPLETED)
+            if exit_event.is_set():
+                return
+            yield input_task.result()
+    finally:
+        exit_task.cancel()
@@ -0,0 +1,221 @@
+import asyncio as aio
+import os
+import struct
+import typing as t
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from vocoder.ring_buffer import AudioRingBuffer
+
+if t.TYPE_CHECKING:
+    import sounddevice as sd
+
+sample_rate = 16000
+block_duration = 30  # milliseconds
+blocksize = int(sample_rate / 1000 * block_duration)
+
+
+class AudioSource(ABC):
+    "Produces 16 kHz int16 audio blocks of shape (blocksize, 1)"
+
+    @abstractmethod
+    def start(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stop(self):
+        "Stop producing audio and release the underlying resources"
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self) -> np.ndarray:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_nowait(self) -> np.ndarray:
+        "Raises asyncio.QueueEmpty if no block is available"
+        raise NotImplementedError
+
+    @abstractmethod
+    def empty(self) -> bool:
+        raise NotImplementedError
+
+
+class MicrophoneSource(AudioSource):
+    def __init__(self, ring: bool = True, wakeup_blocks: int = 2):
+        self.ring = ring
+        self.wakeup_blocks = wakeup_blocks
+        self._stream: "sd.InputStream | None" = None
+        self._queue: aio.Queue[np.ndarray] | AudioRingBuffer | None = None
+
+    def start(self):
+        self._stream, self._queue = get_audio_stream(self.ring, self.wakeup_blocks)
+        self._stream.start()
+
+    def stop(self):
+        assert self._stream is not None, "source was never started"
+        self._stream.stop()
+        self._stream.close()
+
+    async def get(self) -> np.ndarray:
+        assert self._queue is not None, "source was never started"
+        return await self._queue.get()
+
+    def get_nowait(self) -> np.ndarray:
+        assert self._queue is not None, "source was never started"
+        return self._queue.get_nowait()
+
+    def empty(self) -> bool:
+        return self._queue is None or self._queue.empty()
+
+
+class FileSource(AudioSource):
+    """Replays a memory-mapped 16 kHz mono int16 WAV or raw PCM file.
+
+    With realtime=False blocks are handed out as fast as they are consumed, in
+    batches of batch_blocks so that consumers still yield to the event loop,
+    otherwise at the pace of a microphone. tail_silence seconds of silence are
+    appended so that the VAD closes the last segment. Once the file is exhausted
+    `finished` is set and the source behaves like a silent microphone that never
+    delivers another block.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        realtime: bool = False,
+        tail_silence: float = 1.0,
+        batch_blocks: int = 8,
+    ):
+        self.path = path
+        self.realtime = realtime
+        self.batch_blocks = batch_blocks
+        self.audio = read_pcm(path)
+        self.n_blocks = -(-len(self.audio) // blocksize)
+        self.n_tail_blocks = round(tail_silence * 1000 / block_duration)
+
+        self._silence = np.zeros((blocksize, 1), np.int16)
+        self._index = 0
+        self._available = 0  # blocks up to this index can be taken without waiting
+        self._start_time = 0.0
+        self._loop: aio.AbstractEventLoop | None = None
+        self.finished = aio.Event()
+
+    @property
+    def duration(self) -> float:
+        "Duration of the file in seconds, without the tail silence"
+        return len(self.audio) / sample_rate
+
+    def start(self):
+        self._loop = aio.get_event_loop()
+        self._start_time = self._loop.time()
+        self._index = self._available = 0
+        self.finished.clear()
+
+    def stop(self):
+        self._index = self.n_blocks + self.n_tail_blocks
+
+    def _block(self, i: int) -> np.ndarray:
+        if i >= self.n_blocks:
+            return self._silence
+        block = self.audio[blocksize * i : blocksize * i + blocksize]
+        if len(block) < blocksize:
+            block = np.concatenate([block, np.zeros(blocksize - len(block), np.int16)])
+        return block[:, None]
+
+    def _deadline(self, i: int) -> float:
+        return self._start_time + (i + 1) * block_duration / 1000
+
+    def empty(self) -> bool:
+        if self._index >= self.n_blocks + self.n_tail_blocks:
+            return True
+        if self.realtime:
+            assert self._loop is not None, "source was never started"
+            return self._loop.time() < self._deadline(self._index)
+        return self._index >= self._available
+
+    def get_nowait(self) -> np.ndarray:
+        if self.empty():
+            raise aio.QueueEmpty
+        block = self._block(self._index)
+        self._index += 1
+        if self._index == self.n_blocks + self.n_tail_blocks:
+            self.finished.set()
+        return block
+
+    async def get(self) -> np.ndarray:
+        assert self._loop is not None, "source was never started"
+        if self._index >= self.n_blocks + self.n_tail_blocks:
+            await aio.Future()  # exhausted, wait until cancelled
+        if self.realtime:
+            await aio.sleep(max(0, self._deadline(self._index) - self._loop.time()))
+        else:
+            await aio.sleep(0)  # let the consumers run
+            self._available = self._index + self.batch_blocks
+        return self.get_nowait()
+
+
+def read_pcm(path: str | os.PathLike) -> np.ndarray:
+    "Memory-map the samples of a 16 kHz mono int16 WAV file, or of a raw PCM file"
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return np.memmap(path, dtype=np.int16, mode="r")
+
+        while chunk_header := f.read(8):
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                audio_format, channels, rate, _, _, bits = struct.unpack(
+                    "<HHIIHH", f.read(16)
+                )
+                if (audio_format, channels, rate, bits) != (1, 1, sample_rate, 16):
+                    raise ValueError(
+                        f"{path}: expected 16 kHz mono 16-bit PCM, got format "
+                        f"{audio_format}, {channels} channels, {rate} Hz, {bits} bits"
+                    )
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                # streamed wav files may not fill in the data chunk size
+                n_bytes = min(chunk_size, os.path.getsize(path) - f.tell())
+                return np.memmap(
+                    path,
+                    dtype=np.int16,
+                    mode="r",
+                    offset=f.tell(),
+                    shape=(n_bytes // 2,),
+                )
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    raise ValueError(f"{path}: no data chunk")
+
+
+def get_audio_stream(ring: bool = False, wakeup_blocks: int = 2):
+    """With ring=True, blocks are written into a preallocated AudioRingBuffer and
+    the event loop is only woken once every wakeup_blocks blocks"""
+    # imported here so that file sources work without PortAudio
+    import sounddevice as sd
+
+    loop = aio.get_event_loop()
+
+    if ring:
+        audio_queue = AudioRingBuffer(blocksize, wakeup_blocks=wakeup_blocks, loop=loop)
+
+        def callback(indata, frame_count, time_info, status):
+            audio_queue.write(indata)
+
+    else:
+        audio_queue = aio.Queue[np.ndarray]()
+
+        def callback(indata, frame_count, time_info, status):
+            loop.call_soon_threadsafe(audio_queue.put_nowait, indata.copy())
+
+    stream = sd.InputStream(
+        samplerate=sample_rate,
+        blocksize=blocksize,  # This is supposed to be 30 milliseconds?
+        channels=1,
+        dtype=np.int16,
+        callback=callback,
+    )
+    return stream, audio_queue
@@ -1,36 +1,84 @@
 import asyncio as aio
+import math
+import time
 import typing as t
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import partial
 
 import numpy as np
-import sounddevice as sd
 import torch
 import torch.nn as nn
-import webrtcvad
+from loguru import logger
 
-from vocoder.utils import panic
+from vocoder.acoustic_models.cascade import Cascade
+from vocoder.audio_source import AudioSource, MicrophoneSource
+from vocoder.stitching import CtcStitcher, CtcStream
+from vocoder.utils import iter_queue, panic, until_exit
+from vocoder.vad import Segment, Segmenter, VadConfig
+
+# decides from the ctc of an utterance that may continue whether it can end there
+Endpointer = t.Callable[[np.ndarray], bool]
+
+
+@dataclass
+class CascadedCtc:
+    """The ctc of a whole utterance of n_samples from a cascade's first model, and
+    rescore to score the utterance again with its second model in the acoustic
+    model's worker"""
+
+    ctc: np.ndarray
+    n_samples: int
+    rescore: t.Callable[[], t.Awaitable[np.ndarray]]
+
+
+# the ctc of whole utterances, or of utterances being scored when streaming
+CtcQueue = aio.Queue[np.ndarray | CtcStream | CascadedCtc]
 
 
 @asynccontextmanager
-async def ctc_serve(model: nn.Module, stop: aio.Event):
+async def ctc_serve(
+    model: nn.Module,
+    stop: aio.Event,
+    source: AudioSource | None = None,
+    vad_config: VadConfig | None = None,
+    endpointer: Endpointer | None = None,
+    max_in_flight: int = 2,
+    stream: bool = False,
+    cascade: Cascade | None = None,
+):
+
+    if source is None:
+        source = MicrophoneSource()
 
-    stream, audio_queue = get_audio_stream()
-    voice_active_queue = aio.Queue[np.ndarray]()
-    ctc_queue = aio.Queue[np.ndarray]()
-    vad_task = aio.create_task(
-        produce_vad(audio_queue, voice_active_queue, stop), name="vad"
+    voice_active_queue = aio.Queue[Segment]()
+    ctc_queue = CtcQueue()
+    # models that load lazily, like ReleasingModel, start loading on speech
+    segmenter = Segmenter(
+        voice_active_queue, vad_config or VadConfig(), getattr(model, "prefetch", None)
     )
+    vad_task = aio.create_task(produce_vad(source, segmenter, stop), name="vad")
     model_task = aio.create_task(
-        produce_ctc(voice_active_queue, stop, ctc_queue, model), name="model"
+        produce_ctc(
+            voice_active_queue,
+            stop,
+            ctc_queue,
+            model,
+            segmenter,
+            endpointer,
+            max_in_flight,
+            stream,
+            cascade,
+        ),
+        name="model",
     )
 
-    stream.start()
+    source.start()
     try:
         yield ctc_queue
     finally:
-        stream.stop()
-        stream.close()
+        source.stop()
         try:
             await aio.wait_for(vad_task, 0.1)
             await aio.wait_for(model_task, 0.1)
@@ -38,121 +86,231 @@ async def ctc_serve(model: nn.Module, stop: aio.Event):
             panic("audio tasks did not end in time")
 
 
-def get_audio_stream():
-    audio_queue = aio.Queue[np.ndarray]()
-
-    block_duration = 30  # milliseconds
-    sample_rate = 16000
-    blocksize = int(sample_rate / 1000 * block_duration)
-
-    loop = aio.get_event_loop()
-
-    def callback(indata, frame_count, time_info, status):
-        loop.call_soon_threadsafe(audio_queue.put_nowait, indata.copy())
-
-    stream = sd.InputStream(
-        samplerate=sample_rate,
-        blocksize=blocksize,  # This is supposed to be 30 milliseconds?
-        channels=1,
-        dtype=np.int16,
-        callback=callback,
-    )
-    return stream, audio_queue
-
-
 async def produce_vad(
-    audio_queue: aio.Queue[np.ndarray],
-    vad_queue: aio.Queue[np.ndarray],
+    source: AudioSource,
+    segmenter: Segmenter,
     exit_event: aio.Event,
 ):
-    front_padding = 5
-    n_vad_decisions = 15
-    on_threshold_fraction = 0.7
-    off_threshold_fraction = 0.1
-
-    vad = webrtcvad.Vad(3)
-
-    decisions = deque[int](  # last n decisions returned by webrtcvad
-        [0] * n_vad_decisions, maxlen=n_vad_decisions
-    )
-    current_vote = 0  # moving sum of vad decisions == sum(decisions)
-
-    on_threshold = round(on_threshold_fraction * n_vad_decisions)
-    off_threshold = round(off_threshold_fraction * n_vad_decisions)
-
-    tentative_buffer = deque[np.ndarray](maxlen=front_padding + n_vad_decisions)
-    indata_buffer = deque[np.ndarray]()
-
-    is_active = False
-
-    while not exit_event.is_set():
-        try:
-            audio = await aio.wait_for(audio_queue.get(), 0.001)
-        except aio.TimeoutError:
-            continue
-
-        current_vote, is_active = run_frame(
-            audio,
-            vad_queue,
-            vad,
-            decisions,
-            current_vote,
-            tentative_buffer,
-            is_active,
-            indata_buffer,
-            off_threshold,
-            on_threshold,
+    async for audio in iter_queue(source, exit_event):
+        segmenter.run_frame(audio)
+
+    logger.debug(segmenter.trim_summary())
+    if segmenter.gate is not None:
+        logger.debug(segmenter.gate.summary())
+
+
+@dataclass
+class SpeculationMetrics:
+    # speculative segments scored, endpoint offers are not counted
+    n_speculated: int = 0
+    n_hits: int = 0  # of them whose ctc was reused for the final segment
+    # how much earlier the ctc of those final segments was ready than if they had
+    # been scored when they arrived
+    saved_seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.n_hits / max(self.n_speculated, 1)
+
+    @property
+    def mean_saved(self) -> float:
+        return self.saved_seconds / max(self.n_hits, 1)
+
+    def summary(self) -> str:
+        return (
+            f"Speculated on {self.n_speculated} segments, {self.hit_rate:.0%} hits "
+            f"saving {self.mean_saved * 1000:.0f} ms each."
         )
 
 
-def run_frame(
-    indata: np.ndarray,
-    voice_active_queue: aio.Queue[np.ndarray],
-    vad: webrtcvad.Vad,
-    decisions: deque[int],
-    current_vote: int,
-    tentative_buffer: deque[np.ndarray],
-    is_active: bool,
-    indata_buffer: deque[np.ndarray],
-    off_threshold: float,
-    on_threshold: float,
-):
-    is_speech = int(vad.is_speech(indata.tobytes(), 16000))
-    current_vote = -decisions.popleft() + current_vote + is_speech
-    decisions.append(is_speech)
-    tentative_buffer.append(indata)
+@dataclass
+class _Speculation:
+    audio: np.ndarray
+    future: aio.Future
+    rescore: t.Callable | None
+    speculative: bool  # see Segment.speculative, counted in SpeculationMetrics
+    submitted: float
+    ready: float = math.inf
 
-    if is_active:
-        indata_buffer.append(indata)
+    def done(self, _future: aio.Future):
+        self.ready = time.monotonic()
 
-        if current_vote <= off_threshold:
-            is_active = False
-            queue_item = np.concatenate(indata_buffer)
-            voice_active_queue.put_nowait(queue_item)
-            indata_buffer.clear()
 
-    elif not is_active and current_vote >= on_threshold:
-        is_active = True
-        indata_buffer.extend(tentative_buffer)
+async def produce_ctc(
+    vad_queue: aio.Queue[Segment],
+    exit_event: aio.Event,
+    ctc_queue: CtcQueue,
+    model: t.Callable,
+    segmenter: Segmenter | None = None,
+    endpointer: Endpointer | None = None,
+    max_in_flight: int = 2,
+    stream: bool = False,
+    cascade: Cascade | None = None,
+    metrics: SpeculationMetrics | None = None,
+):
+    """Runs the model in a worker thread so that the event loop, and with it the
+    vad, keeps running during inference. At most max_in_flight segments are queued
+    for or in the worker, and their ctc is delivered in order, see deliver_ctc.
+    Segments that hold a whole utterance are scored with the first model of cascade
+    if given and delivered as CascadedCtc, so that the decoder can decide whether to
+    rescore them. Parts of longer utterances, and every segment when streaming, are
+    always scored with model so that their ctc can be stitched. A segment with the
+    same audio as the last provisional one reuses its ctc, see
+    Segmenter.trimmed_view."""
+    loop = aio.get_running_loop()
+    executor = ThreadPoolExecutor(1, thread_name_prefix="acoustic-model")
+    slots = aio.Semaphore(max_in_flight)
+    scoring = aio.Queue[tuple[Segment, aio.Future, t.Callable | None]]()
+    deliver_task = aio.create_task(
+        deliver_ctc(
+            scoring, slots, exit_event, ctc_queue, segmenter, endpointer, stream
+        ),
+        name="deliver ctc",
+    )
+    continuing = False  # the last segment did not end its utterance
+    if metrics is None:
+        metrics = SpeculationMetrics()
+    speculation: _Speculation | None = None
 
-    return current_vote, is_active
+    try:
+        async for segment in iter_queue(vad_queue, exit_event):
+            if segment.provisional and (
+                (endpointer is None and not segment.speculative)
+                or segmenter is None
+                or not segmenter.is_latest_offer(segment)
+            ):
+                continue
+
+            if not await until_exit(slots.acquire(), exit_event):
+                break
+
+            if speculation is not None and segment.audio is speculation.audio:
+                future, rescore = speculation.future, speculation.rescore
+                if not segment.provisional and speculation.speculative:
+                    ready = min(time.monotonic(), speculation.ready)
+                    metrics.n_hits += 1
+                    metrics.saved_seconds += ready - speculation.submitted
+            else:
+                # a view of the segmenter's buffer, already normalized
+                audio = torch.from_numpy(segment.audio)[None]
+                whole = not continuing and (segment.final or segment.provisional)
+                rescore = None
+                if cascade is not None and whole and not stream:
+                    future = loop.run_in_executor(executor, cascade.score_first, audio)
+                    rescore = partial(
+                        loop.run_in_executor, executor, cascade.score_second, audio
+                    )
+                else:
+                    future = loop.run_in_executor(executor, model, audio)
+                if segment.speculative:
+                    metrics.n_speculated += 1
+                if segment.provisional:
+                    speculation = _Speculation(
+                        segment.audio,
+                        future,
+                        rescore,
+                        segment.speculative,
+                        time.monotonic(),
+                    )
+                    future.add_done_callback(speculation.done)
+
+            if not segment.provisional:
+                continuing = not segment.final
+                speculation = None
+            scoring.put_nowait((segment, future, rescore))
+
+        await deliver_task
+    finally:
+        if metrics.n_speculated:
+            logger.debug(metrics.summary())
+        deliver_task.cancel()
+        # a forward pass that is already running is left to finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
-async def produce_ctc(
-    vad_queue: aio.Queue[np.ndarray],
+async def deliver_ctc(
+    scoring: aio.Queue[tuple[Segment, aio.Future, t.Callable | None]],
+    slots: aio.Semaphore,
     exit_event: aio.Event,
-    ctc_queue: aio.Queue[np.ndarray],
-    model: t.Callable,
+    ctc_queue: CtcQueue,
+    segmenter: Segmenter | None = None,
+    endpointer: Endpointer | None = None,
+    stream: bool = False,
 ):
-    while not exit_event.is_set():
+    """Stitch the ctc of segments in the order they were queued for the model. With
+    stream=True a CtcStream is queued as soon as the first part of an utterance is
+    scored and fed the frames of each further part as they become stable. An
+    utterance is dropped if the model fails to score one of its parts."""
+    stitcher = CtcStitcher()
+    ctc_stream: CtcStream | None = None
+
+    def deliver(
+        frames: np.ndarray,
+        final: bool,
+        rescore: t.Callable | None = None,
+        n_samples: int = 0,
+    ):
+        """frames are the ctc of the utterance that was not drained yet, rescore is
+        set if they are the whole utterance of n_samples scored by a cascade's first
+        model"""
+        nonlocal ctc_stream
+        if not stream:
+            assert final
+            ctc_queue.put_nowait(
+                frames if rescore is None else CascadedCtc(frames, n_samples, rescore)
+            )
+            return
+        if ctc_stream is None:
+            ctc_stream = CtcStream()
+            ctc_queue.put_nowait(ctc_stream)
+        if final:
+            ctc_stream.close(frames)
+            ctc_stream = None
+        else:
+            ctc_stream.put_nowait(frames)
+
+    dropping = False  # the rest of an utterance whose part failed to score
+
+    async for segment, future, rescore in iter_queue(scoring, exit_event):
         try:
-            audio_ = await aio.wait_for(vad_queue.get(), 0.001)
-        except aio.TimeoutError:
+            ctc = await until_exit(future, exit_event)
+        except Exception:
+            logger.exception("The acoustic model failed to score a segment.")
+            slots.release()
+            if not segment.provisional:
+                # the rest of the utterance cannot be stitched without this part
+                stitcher = CtcStitcher()
+                if ctc_stream is not None:
+                    ctc_stream.close()
+                    ctc_stream = None
+                dropping = not segment.final
+            continue
+        slots.release()
+        if ctc is None:
+            break
+
+        if dropping:
+            dropping = not (segment.final and not segment.provisional)
+            continue
+        if segment.speculative:
+            continue
+        if segment.provisional:
+            assert segmenter is not None and endpointer is not None
+            ctc = stitcher.peek(ctc, len(segment.audio), segment.overlap)
+            if endpointer(ctc) and segmenter.end_early(segment):
+                # the same array as the endpointer's, so that its decoding is reused
+                if stitcher.n_drained:
+                    ctc = ctc[stitcher.n_drained :]
+                deliver(ctc, True, rescore, len(segment.audio))
+                stitcher = CtcStitcher()
             continue
 
-        audio = audio_ndarray_to_tensor(format_vad_to_model(audio_))
-        ctc = model(audio)
-        ctc_queue.put_nowait(ctc)
+        stitcher.add(ctc, len(segment.audio), segment.overlap)
+        if segment.final:
+            n_drained = stitcher.n_drained
+            deliver(stitcher.finish()[n_drained:], True, rescore, len(segment.audio))
+        elif stream and (frames := stitcher.drain()) is not None:
+            deliver(frames, final=False)
 
 
 def audio_ndarray_to_tensor(x: np.ndarray, cuda: bool = False) -> torch.Tensor:
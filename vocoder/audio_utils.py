@@ -1,49 +1,56 @@
 import asyncio as aio
+import math
 
 import numpy as np
 import torch
 
-from vocoder.audio_to_ctc import format_vad_to_model, get_audio_stream
-from vocoder.utils import queue_to_list
+from vocoder.audio_source import (
+    AudioSource,
+    MicrophoneSource,
+    block_duration,
+    blocksize,
+)
+from vocoder.audio_to_ctc import format_vad_to_model
+from vocoder.vad import frame_audio
 
 
-async def record_duration(seconds: float = 60):
+async def record_duration(seconds: float = 60, source: AudioSource | None = None):
     "Set model_format to false if you want to run vad on audio"
-    stream, audio_queue = get_audio_stream()
-    stream.start()
-    try:
-        await aio.sleep(seconds)
-    except:
-        pass
-    stream.stop()
-    stream.close()
-    audio_ = np.concatenate(queue_to_list(audio_queue))
-    return format_vad_to_model(audio_)
+    audio_ = await _record(seconds, source)
+    return format_vad_to_model(audio_.reshape(-1, 1))
 
 
-async def record_duration_raw(seconds: float = 60):
+async def record_duration_raw(seconds: float = 60, source: AudioSource | None = None):
     "Set model_format to false if you want to run vad on audio"
-    stream, audio_queue = get_audio_stream()
-    stream.start()
+    return list(await _record(seconds, source))
+
+
+async def _record(seconds: float, source: AudioSource | None) -> np.ndarray:
+    "Copy blocks from the source straight into a preallocated recording"
+    if source is None:
+        source = MicrophoneSource()
+
+    n_blocks = math.ceil(seconds * 1000 / block_duration)
+    recording = np.empty((n_blocks, blocksize, 1), np.int16)
+    n_recorded = 0
+
+    async def drain():
+        nonlocal n_recorded
+        while n_recorded < n_blocks:
+            recording[n_recorded] = await source.get()
+            n_recorded += 1
+
+    source.start()
     try:
-        await aio.sleep(seconds)
+        await aio.wait_for(drain(), seconds + 1)
     except:
         pass
-    stream.stop()
-    stream.close()
-    return queue_to_list(audio_queue)
+    source.stop()
+    return recording[:n_recorded]
 
 
 def format_audio_for_vad(audio: torch.Tensor):
     if not isinstance(audio, np.ndarray):
         audio = audio.numpy()
     audio_ = (audio.flatten() * 32768).astype(np.int16)
-    (L,) = audio_.shape
-    q, r = divmod(L, 480)
-    segments = list[np.ndarray]()
-    for i in range(q):
-        segments.append(audio_[480 * i : 480 * i + 480][:, None])
-    segments.append(
-        np.concatenate([audio_[q * 480 :], np.zeros(480 - r, np.int16)])[:, None]
-    )
-    return segments
+    return list(frame_audio(audio_)[:, :, None])
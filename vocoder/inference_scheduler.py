@@ -0,0 +1,154 @@
+"""Batching the acoustic inference of several ctc_serve pipelines, so that one
+process can serve several microphones with one model"""
+
+import queue
+import threading
+import time
+import typing as t
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from loguru import logger
+
+from vocoder.acoustic_models.wav2vec2 import AcousticModel
+
+
+@dataclass
+class SchedulerMetrics:
+    max_batch_size: int
+    n_batches: int = 0
+    n_requests: int = 0
+    # seconds from submitting audio until its batch starts being scored
+    total_queueing_delay: float = 0.0
+    max_queueing_delay: float = 0.0
+
+    @property
+    def batch_fill(self) -> float:
+        "Mean fraction of max_batch_size that batches used"
+        return self.n_requests / max(self.n_batches * self.max_batch_size, 1)
+
+    @property
+    def mean_queueing_delay(self) -> float:
+        return self.total_queueing_delay / max(self.n_requests, 1)
+
+    def add(self, queueing_delays: list[float]):
+        self.n_batches += 1
+        self.n_requests += len(queueing_delays)
+        self.total_queueing_delay += sum(queueing_delays)
+        self.max_queueing_delay = max(self.max_queueing_delay, *queueing_delays)
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_requests} segments in {self.n_batches} batches, "
+            f"{self.batch_fill:.0%} batch fill, queueing delay "
+            f"{self.mean_queueing_delay * 1000:.1f} ms mean "
+            f"{self.max_queueing_delay * 1000:.1f} ms max"
+        )
+
+
+class _Request(t.NamedTuple):
+    audio: torch.Tensor | np.ndarray
+    submitted: float
+    future: Future
+
+
+class InferenceScheduler:
+    """Scores audio submitted from any thread with AcousticModel.batch, in batches
+    of up to max_batch_size pieces collected for at most max_wait seconds after the
+    first one arrives. Calling the scheduler blocks until the ctc of the audio is
+    ready, so it can stand in for the model of several ctc_serve pipelines."""
+
+    def __init__(
+        self, model: AcousticModel, max_batch_size: int = 4, max_wait: float = 0.01
+    ):
+        self.model = model
+        self.token_encoding = model.token_encoding
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = SchedulerMetrics(max_batch_size)
+        if not model.masks_padding:
+            logger.warning(
+                "The acoustic model cannot mask padding, batched segments are scored"
+                " slightly differently than on their own."
+            )
+
+        self._requests = queue.Queue[_Request | None]()
+        # held while checking _closed and queueing, so that nothing is queued after
+        # the None that stops the thread
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="vocoder-inference-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, audio: torch.Tensor | np.ndarray) -> Future:
+        "A future of the ctc of audio"
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The inference scheduler is closed")
+            self._requests.put(_Request(audio, time.monotonic(), future))
+        return future
+
+    def __call__(self, audio: torch.Tensor | np.ndarray) -> np.ndarray:
+        return self.submit(audio).result()
+
+    def close(self):
+        "Score what was already submitted and stop the scheduler thread"
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._requests.put(None)
+        self._thread.join()
+
+    def __enter__(self) -> "InferenceScheduler":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _collect(self, first: _Request) -> tuple[list[_Request], bool]:
+        "A batch starting with first, and whether the scheduler was closed"
+        batch = [first]
+        deadline = first.submitted + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    request = self._requests.get(timeout=timeout)
+                else:
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            first = self._requests.get()
+            if first is None:
+                return
+            batch, closed = self._collect(first)
+            self._score(batch)
+
+    def _score(self, batch: list[_Request]):
+        start = time.monotonic()
+        self.metrics.add([start - request.submitted for request in batch])
+        try:
+            ctcs = self.model.batch([request.audio for request in batch])
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, ctc in zip(batch, ctcs):
+            request.future.set_result(ctc)
+        logger.debug(
+            f"Scored a batch of {len(batch)} in {time.monotonic() - start:.3f} s, "
+            + self.metrics.summary()
+        )
@@ -0,0 +1,74 @@
+import asyncio as aio
+
+import numpy as np
+from loguru import logger
+
+
+class AudioRingBuffer:
+    """Preallocated int16 ring of fixed size audio blocks.
+
+    Blocks are written from the PortAudio callback thread and read on the event
+    loop. Reads return views into the ring, so a block stays valid only until
+    the writer laps it, i.e. for `capacity` further blocks; consumers that keep
+    audio around longer than that must copy it. The reader is woken at most once
+    every `wakeup_blocks` blocks. The read methods mirror the `asyncio.Queue`
+    api so that the ring can stand in for the audio queue.
+    """
+
+    def __init__(
+        self,
+        blocksize: int,
+        capacity: int = 128,
+        wakeup_blocks: int = 2,
+        loop: aio.AbstractEventLoop | None = None,
+    ):
+        if wakeup_blocks > capacity:
+            raise ValueError("wakeup_blocks must not exceed capacity")
+
+        self.blocksize = blocksize
+        self.capacity = capacity
+        self.wakeup_blocks = wakeup_blocks
+        self.overruns = 0  # number of blocks dropped because the reader fell behind
+
+        self._ring = np.zeros((capacity, blocksize, 1), np.int16)
+        self._written = 0  # total blocks written, only touched by the writer
+        self._notified = 0  # value of _written at the last wakeup
+        self._read = 0  # total blocks read, only touched by the reader
+        self._ready = aio.Event()
+        self._loop = loop or aio.get_event_loop()
+
+    def write(self, indata: np.ndarray):
+        "Copy a block into the ring. Called from the audio thread."
+        self._ring[self._written % self.capacity] = indata
+        self._written += 1
+        if self._written - self._notified >= self.wakeup_blocks:
+            self._notified = self._written
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def qsize(self) -> int:
+        return min(self._written - self._read, self.capacity)
+
+    def empty(self) -> bool:
+        return self._written == self._read
+
+    def get_nowait(self) -> np.ndarray:
+        written = self._written
+        if written == self._read:
+            raise aio.QueueEmpty
+
+        if written - self._read > self.capacity:
+            dropped = written - self._read - self.capacity
+            self.overruns += dropped
+            self._read = written - self.capacity
+            logger.warning(f"Audio ring buffer overrun, dropped {dropped} blocks.")
+
+        block = self._ring[self._read % self.capacity]
+        self._read += 1
+        return block
+
+    async def get(self) -> np.ndarray:
+        while self.empty():
+            self._ready.clear()
+            if self.empty():
+                await self._ready.wait()
+        return self.get_nowait()
@@ -102,6 +102,168 @@ def valid_prediction(
     return prefix_complete(token_encoding, lexicon_cache, hyp) or not hyp.prefix
 
 
+class BeamSearch:
+    """Grammar constrained ctc beam search that can be fed the ctc of an utterance
+    a few frames at a time with step, see beam_search"""
+
+    def __init__(
+        self,
+        soft: Soft,
+        lexicon_registry: LexiconRegistry,
+        initial_leaves: PathLeaves,
+        token_encoding: TokenEncoding,
+        beam_width: int = 8,
+        n_token_proposals: int = 8,
+    ):
+        self.soft = soft
+        self.lexicon_registry = lexicon_registry
+        self.initial_leaves = initial_leaves
+        self.token_encoding = token_encoding
+        self.beam_width = beam_width
+        self.n_token_proposals = n_token_proposals
+
+        self.lexicon_cache = dict[tuple[TokenWord, ...], AbstractLexicon]()
+        self.grammar_states = dict[tuple[TokenWord, ...], PathLeaves]()
+
+        leaves = initial_leaves.copy()
+        lex = lexicon_registry.get_union(*get_predicate_transitions(soft, leaves))
+        hyp = Hypothesis.empty()
+
+        self.lexicon_cache[()] = lex
+        self.grammar_states[()] = leaves
+
+        self._last_token = partial(last_token, token_encoding)
+        self._prefix_complete = partial(
+            prefix_complete, token_encoding, self.lexicon_cache
+        )
+        self._token_proposals = partial(
+            token_proposals, token_encoding, self.lexicon_cache
+        )
+        self._valid_prediction = partial(
+            valid_prediction, token_encoding, self.lexicon_cache
+        )
+
+        # pruned to beam_width before the next frame, the last frame is not pruned
+        self.sorted_beam = [(hyp, HypothesisProbabilities.initial())]
+        self.failed = False
+
+    def _transition(self, hyp: Hypothesis) -> Hypothesis:
+        "Complete the prefix of hyp as a word, stepping the grammar if needed"
+        next_hyp = hyp.transition()
+        if next_hyp.completed not in self.grammar_states:
+            # step path tree
+            leaves = transition_from_word(
+                self.soft,
+                self.lexicon_registry,
+                self.grammar_states[hyp.completed],
+                self.token_encoding.decode(hyp.prefix),
+            )
+            leaves = step_tree(self.soft, leaves)
+            self.grammar_states[next_hyp.completed] = leaves
+
+            lex = self.lexicon_registry.get_union(
+                *get_predicate_transitions(self.soft, leaves)
+            )
+            self.lexicon_cache[next_hyp.completed] = lex
+        return next_hyp
+
+    def step(self, ctc_output: np.ndarray):
+        token_encoding = self.token_encoding
+
+        for ctc_frame in ctc_output:
+            if self.failed:
+                return
+
+            top_tokens = get_top_n_indices(ctc_frame, self.n_token_proposals)
+            next_beam = defaultdict[Hypothesis, HypothesisProbabilities](
+                HypothesisProbabilities.new
+            )
+
+            for hyp, probs in self.sorted_beam[: self.beam_width]:
+                ## propose hyp-preserving tokens
+                # propose unextended blank
+                if token_encoding.blank in top_tokens:
+                    next_beam[hyp].propose_blank(probs, ctc_frame[token_encoding.blank])
+
+                # propose unextended last char
+                if (lt := self._last_token(hyp)) in top_tokens:
+                    next_beam[hyp].propose_last_token_unchanged(probs, ctc_frame[lt])
+
+                ## grammar transition
+                # propose space extended hyp
+                if token_encoding.space in top_tokens and self._prefix_complete(hyp):
+                    next_hyp = self._transition(hyp)
+                    next_beam[next_hyp].propose_new_char(
+                        probs, ctc_frame[token_encoding.space]
+                    )
+
+                ## extend prefix
+                # propose prefix extensions
+                for token in self._token_proposals(hyp):
+                    if token in top_tokens:
+                        next_hyp = hyp.extend_current_prefix(token)
+                        next_probs = next_beam[next_hyp]
+                        if token == self._last_token(hyp):
+                            next_probs.propose_last_token_extended(
+                                probs, ctc_frame[token]
+                            )
+                        else:
+                            next_probs.propose_new_char(probs, ctc_frame[token])
+
+            if not next_beam:
+                # Bad end
+                self.failed = True
+                return
+
+            self.sorted_beam = sorted(
+                next_beam.items(),
+                key=lambda item: item[1].total_probability,
+                reverse=True,
+            )
+
+    def results(self) -> t.Iterator[tuple[tuple[str, ...], float, PathLeaves]]:
+        "Hypotheses that complete an utterance given the frames so far, best first"
+        if self.failed:
+            return
+
+        for hyp, probs in self.sorted_beam:
+
+            # prefix incomplete
+            if not self._valid_prediction(hyp):
+                continue
+
+            # perform grammar transition if needed
+            if self._prefix_complete(hyp):
+                hyp = self._transition(hyp)
+
+            leaves = self.grammar_states[hyp.completed]
+            leaves = batch_separator_transition(self.soft, leaves)
+            leaves = step_tree(self.soft, leaves)
+
+            if not leaves:
+                continue
+
+            words = tuple(self.token_encoding.decode(t) for t in hyp.completed)
+            yield words, probs.total_probability, leaves
+
+    def result(self) -> tuple[tuple[str, ...], float, PathLeaves]:
+        "The best hypothesis that completes an utterance, given the frames so far"
+        bad_out = (), -float("inf"), self.initial_leaves
+        return next(self.results(), bad_out)
+
+    def margin(self) -> float:
+        """Log probability by which the best result beats the best one with other
+        words, -inf without results and inf without a runner up"""
+        results = self.results()
+        best = next(results, None)
+        if best is None:
+            return -float("inf")
+        for words, prob, _ in results:
+            if words != best[0]:
+                return best[1] - prob
+        return float("inf")
+
+
 def beam_search(
     soft: Soft,
     lexicon_registry: LexiconRegistry,
@@ -111,124 +273,13 @@ def beam_search(
     beam_width: int = 8,
     n_token_proposals: int = 8,
 ) -> tuple[tuple[str, ...], float, PathLeaves]:
-
-    bad_out = (), -float("inf"), initial_leaves
-
-    lexicon_cache = dict[tuple[TokenWord, ...], AbstractLexicon]()
-    grammar_states = dict[tuple[TokenWord, ...], PathLeaves]()
-
-    leaves = initial_leaves.copy()
-    lex = lexicon_registry.get_union(*get_predicate_transitions(soft, leaves))
-    hyp = Hypothesis.empty()
-
-    lexicon_cache[()] = lex
-    grammar_states[()] = leaves
-
-    _last_token = partial(last_token, token_encoding)
-    _prefix_complete = partial(prefix_complete, token_encoding, lexicon_cache)
-    _token_proposals = partial(token_proposals, token_encoding, lexicon_cache)
-    _valid_prediction = partial(valid_prediction, token_encoding, lexicon_cache)
-
-    sorted_beam = [(hyp, HypothesisProbabilities.initial())]
-
-    for i, ctc_frame in enumerate(ctc_output):
-        top_tokens = get_top_n_indices(ctc_frame, n_token_proposals)
-        next_beam = defaultdict[Hypothesis, HypothesisProbabilities](
-            HypothesisProbabilities.new
-        )
-
-        for hyp, probs in sorted_beam:
-            ## propose hyp-preserving tokens
-            # propose unextended blank
-            if token_encoding.blank in top_tokens:
-                next_beam[hyp].propose_blank(probs, ctc_frame[token_encoding.blank])
-
-            # propose unextended last char
-            if (lt := _last_token(hyp)) in top_tokens:
-                next_beam[hyp].propose_last_token_unchanged(probs, ctc_frame[lt])
-
-            ## grammar transition
-            # propose space extended hyp
-            if token_encoding.space in top_tokens and _prefix_complete(hyp):
-                next_hyp = hyp.transition()
-                if next_hyp.completed not in grammar_states:
-                    # step path tree
-                    leaves = transition_from_word(
-                        soft,
-                        lexicon_registry,
-                        grammar_states[hyp.completed],
-                        token_encoding.decode(hyp.prefix),
-                    )
-                    leaves = step_tree(soft, leaves)
-                    grammar_states[next_hyp.completed] = leaves
-
-                    lex = lexicon_registry.get_union(
-                        *get_predicate_transitions(soft, leaves)
-                    )
-                    lexicon_cache[next_hyp.completed] = lex
-                next_beam[next_hyp].propose_new_char(
-                    probs, ctc_frame[token_encoding.space]
-                )
-
-            ## extend prefix
-            # propose prefix extensions
-            for token in _token_proposals(hyp):
-                if token in top_tokens:
-                    next_hyp = hyp.extend_current_prefix(token)
-                    next_probs = next_beam[next_hyp]
-                    if token == _last_token(hyp):
-                        next_probs.propose_last_token_extended(probs, ctc_frame[token])
-                    else:
-                        next_probs.propose_new_char(probs, ctc_frame[token])
-
-        if not next_beam:
-            # Bad end
-            return bad_out
-
-        sorted_beam = sorted(
-            next_beam.items(),
-            key=lambda item: item[1].total_probability,
-            reverse=True,
-        )
-
-        if i != len(ctc_output) - 1:
-            sorted_beam = sorted_beam[:beam_width]
-
-    # return first valid hyp
-    for hyp, probs in sorted_beam:
-
-        # prefix incomplete
-        if not _valid_prediction(hyp):
-            continue
-
-        # perform grammar transition if needed
-        if _prefix_complete(hyp):
-            next_hyp = hyp.transition()
-            if next_hyp.completed not in grammar_states:
-                # step path tree
-                leaves = transition_from_word(
-                    soft,
-                    lexicon_registry,
-                    grammar_states[hyp.completed],
-                    token_encoding.decode(hyp.prefix),
-                )
-                leaves = step_tree(soft, leaves)
-                grammar_states[next_hyp.completed] = leaves
-
-                lex = lexicon_registry.get_union(
-                    *get_predicate_transitions(soft, leaves)
-                )
-                lexicon_cache[next_hyp.completed] = lex
-            hyp = next_hyp
-
-        leaves = grammar_states[hyp.completed]
-        leaves = batch_separator_transition(soft, leaves)
-        leaves = step_tree(soft, leaves)
-
-        if not leaves:
-            continue
-
-        words = tuple(token_encoding.decode(t) for t in hyp.completed)
-        return words, probs.total_probability, leaves
-
-    return bad_out
+    search = BeamSearch(
+        soft,
+        lexicon_registry,
+        initial_leaves,
+        token_encoding,
+        beam_width,
+        n_token_proposals,
+    )
+    search.step(ctc_output)
+    return search.result()
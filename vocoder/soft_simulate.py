@@ -108,6 +108,20 @@ def batch_separator_transition(soft: Soft, path_leaves: PathLeaves) -> PathLeave
     return leaves
 
 
+def can_continue(
+    soft: Soft,
+    lexicon_registry: LexiconRegistry,
+    path_leaves: PathLeaves,
+    words: Iterable[str],
+) -> bool:
+    "Whether the grammar accepts another word in the current utterance after words"
+    path_leaves = step_tree(soft, path_leaves)
+    for word in words:
+        path_leaves = transition_from_word(soft, lexicon_registry, path_leaves, word)
+        path_leaves = step_tree(soft, path_leaves)
+    return bool(get_predicate_transitions(soft, path_leaves))
+
+
 def get_predicate_transitions(soft: Soft, path_leaves: PathLeaves) -> list[str]:
     out = list[str]()
     for node in path_leaves:
@@ -0,0 +1,78 @@
+"Joining ctc matrices computed from overlapping pieces of audio"
+
+import asyncio as aio
+
+import numpy as np
+
+# wav2vec2 emits one ctc frame per 320 samples of 16 kHz audio
+samples_per_frame = 320
+
+
+def _frames_before(n_samples: int) -> int:
+    "Number of frames that start before sample n_samples"
+    return -(-n_samples // samples_per_frame)
+
+
+class CtcStitcher:
+    """Joins the ctc matrices of consecutive pieces of audio. Where two pieces
+    overlap, frames before the middle of the overlap are taken from the earlier
+    piece and the rest from the later one, so that each frame comes from the piece
+    with more context around it. Overlaps and piece lengths should be multiples
+    of samples_per_frame for the frames of the pieces to line up."""
+
+    def __init__(self):
+        self.frames = list[np.ndarray]()
+        self.n_drained = 0  # number of frames returned by drain
+        self._drained_pieces = 0
+        self._last: np.ndarray | None = None
+        self._last_start = 0  # frames of _last already taken from the piece before
+        self._last_length = 0
+
+    def add(self, ctc: np.ndarray, length: int, overlap: int = 0):
+        """Add the ctc of a piece of audio that is length samples long and starts
+        with overlap samples repeated from the end of the previous piece"""
+        start = 0
+        if self._last is not None:
+            end = _frames_before(self._last_length - overlap // 2)
+            self.frames.append(self._last[self._last_start : end])
+            start = _frames_before(overlap // 2)
+        self._last = ctc
+        self._last_start = start
+        self._last_length = length
+
+    def drain(self) -> np.ndarray | None:
+        """The frames that later pieces can no longer change and that have not been
+        drained yet, None if there are none"""
+        if self._drained_pieces == len(self.frames):
+            return None
+        out = np.concatenate(self.frames[self._drained_pieces :])
+        self._drained_pieces = len(self.frames)
+        self.n_drained += len(out)
+        return out
+
+    def peek(self, ctc: np.ndarray, length: int, overlap: int = 0) -> np.ndarray:
+        "What finish would return after add(ctc, length, overlap), without adding it"
+        frames, start = self.frames, 0
+        if self._last is not None:
+            end = _frames_before(self._last_length - overlap // 2)
+            frames = frames + [self._last[self._last_start : end]]
+            start = _frames_before(overlap // 2)
+        return np.concatenate(frames + [ctc[start:]])
+
+    def finish(self) -> np.ndarray:
+        "Join and return everything added so far and reset the stitcher"
+        assert self._last is not None, "nothing to stitch"
+        self.frames.append(self._last[self._last_start :])
+        out = np.concatenate(self.frames)
+        self.__init__()
+        return out
+
+
+class CtcStream(aio.Queue):
+    """The ctc of an utterance that is still being scored, as consecutive chunks of
+    frames followed by None"""
+
+    def close(self, frames: np.ndarray | None = None):
+        if frames is not None and len(frames):
+            self.put_nowait(frames)
+        self.put_nowait(None)
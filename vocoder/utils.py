@@ -1,7 +1,7 @@
 import asyncio as aio
 import sys
 import typing as t
-from collections.abc import Iterable
+from collections.abc import AsyncIterator, Iterable
 
 from loguru import logger
 
@@ -28,6 +28,47 @@ def queue_to_list(q: aio.Queue[T]) -> list[T]:
     return out
 
 
+class _Queue(t.Protocol[T]):
+    "Implemented by asyncio.Queue, AudioRingBuffer and AudioSource"
+
+    async def get(self) -> T: ...
+
+    def get_nowait(self) -> T: ...
+
+
+async def iter_queue(q: _Queue[T], exit_event: aio.Event) -> AsyncIterator[T]:
+    "Yield items from q as they arrive until exit_event is set, without polling"
+    exit_task = aio.create_task(exit_event.wait())
+    try:
+        while not exit_event.is_set():
+            try:
+                item = q.get_nowait()
+            except aio.QueueEmpty:
+                get_task = aio.ensure_future(q.get())
+                await aio.wait((get_task, exit_task), return_when=aio.FIRST_COMPLETED)
+                if not get_task.done():
+                    get_task.cancel()  # cancelling a pending get does not lose an item
+                    continue
+                item = get_task.result()
+            yield item
+    finally:
+        exit_task.cancel()
+
+
+async def until_exit(aw: t.Awaitable[T], exit_event: aio.Event) -> T | None:
+    "The result of aw, or None if exit_event is set first, in which case aw is cancelled"
+    task = aio.ensure_future(aw)
+    exit_task = aio.create_task(exit_event.wait())
+    try:
+        await aio.wait((task, exit_task), return_when=aio.FIRST_COMPLETED)
+    finally:
+        exit_task.cancel()
+    if not task.done():
+        task.cancel()
+        return None
+    return task.result()
+
+
 def vocoder_welcome_message():
     logger.opt(colors=True).info("<red>Welcome to vocoder.</red>")
 
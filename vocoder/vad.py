@@ -0,0 +1,496 @@
+import asyncio as aio
+import math
+import typing as t
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+from loguru import logger
+
+from vocoder.audio_source import block_duration, blocksize
+from vocoder.vad_backends import NoiseFloor, VadBackend, get_backend
+
+
+@dataclass(frozen=True)
+class VadConfig:
+    front_padding: int = 5  # blocks kept from before the vote reached on_threshold
+    n_vad_decisions: int = 15
+    on_threshold_fraction: float = 0.7
+    off_threshold_fraction: float = 0.1
+    backend: str = "webrtc"  # see vad_backends.backends
+    aggressiveness: int = 3
+    energy_gate: bool = False
+    gate_margin_db: float = 3.0
+    gate_audit: bool = False  # see EnergyGate
+    # longer utterances are emitted in parts that overlap by segment_overlap seconds
+    max_segment_duration: float | None = 10.0
+    segment_overlap: float = 1.0
+    # seconds of non-speech kept around the first and last voiced block of an
+    # utterance, the rest of the front padding and hangover is trimmed
+    trim_margin: float | None = 0.15
+    # after endpoint_silence seconds of non-speech within an utterance, a
+    # provisional segment is offered to the endpointer, which may end the utterance
+    # early if the audio so far completes the grammar, see Segmenter.end_early
+    endpoint_silence: float | None = None
+    endpoint_blank_probability: float = 0.9  # required at the end of the utterance
+    # offer the utterance so far as a speculative segment as soon as its trimmed
+    # audio stops growing, trim_margin seconds after the last voiced block, so that
+    # its ctc is ready when the vote decays; needs a trim_margin
+    speculate: bool = False
+
+    @property
+    def on_threshold(self) -> int:
+        return round(self.on_threshold_fraction * self.n_vad_decisions)
+
+    @property
+    def off_threshold(self) -> int:
+        return round(self.off_threshold_fraction * self.n_vad_decisions)
+
+    @property
+    def max_segment_blocks(self) -> float:
+        if self.max_segment_duration is None:
+            return math.inf
+        # a segment starts out with front_padding + n_vad_decisions blocks
+        min_blocks = self.front_padding + self.n_vad_decisions + 1
+        return max(
+            _even_blocks(self.max_segment_duration),
+            self.overlap_blocks + 2,
+            min_blocks + min_blocks % 2,
+        )
+
+    @property
+    def overlap_blocks(self) -> int:
+        return max(_even_blocks(self.segment_overlap), 2)
+
+    @property
+    def trim_margin_blocks(self) -> float:
+        if self.trim_margin is None:
+            return math.inf
+        return math.ceil(self.trim_margin * 1000 / block_duration)
+
+    @property
+    def endpoint_blocks(self) -> float:
+        if self.endpoint_silence is None:
+            return math.inf
+        return max(math.ceil(self.endpoint_silence * 1000 / block_duration), 1)
+
+    @property
+    def offered_silence_blocks(self) -> float:
+        """Non-speech blocks at the end of a segment offered for endpointing, which
+        is trimmed trim_margin after the last voiced block"""
+        return min(self.endpoint_blocks, self.trim_margin_blocks)
+
+    @property
+    def speculate_blocks(self) -> float:
+        if not self.speculate:
+            return math.inf
+        return max(self.trim_margin_blocks, 1)
+
+
+def _even_blocks(seconds: float) -> int:
+    """Even numbers of blocks are a multiple of the acoustic model's frame stride,
+    which lets overlapping parts be stitched without shifting frames"""
+    return 2 * math.ceil(seconds * 1000 / block_duration / 2)
+
+
+class EnergyGate:
+    """Scores frames whose energy is within margin_db of an adaptive noise floor as
+    non-speech, without calling the vad backend.
+
+    The floor follows the frame energy down immediately and rises by at most
+    floor_rise_db per second, so speech does not drag it up. Nothing is gated
+    during the first warmup frames. With audit=True gated frames are still passed
+    to the backend and n_missed counts the ones it would have scored as speech.
+    """
+
+    def __init__(
+        self,
+        margin_db: float = 3.0,
+        floor_rise_db: float = 0.5,
+        warmup: int = 10,
+        audit: bool = False,
+    ):
+        self.margin_db = margin_db
+        self.warmup = warmup
+        self.audit = audit
+        self.n_skipped = 0
+        self.n_missed = 0
+
+        self.floor = NoiseFloor(floor_rise_db)
+        self._scratch = np.empty(blocksize, np.float32)
+
+    @property
+    def n_frames(self) -> int:
+        return self.floor.n_frames
+
+    def is_silence(self, indata: np.ndarray) -> bool:
+        np.copyto(self._scratch, indata[:, 0])
+        energy_db = 10 * math.log10(self._scratch.dot(self._scratch) / blocksize + 1)
+
+        t = self.n_frames
+        floor = self.floor.update(energy_db)
+
+        silent = t >= self.warmup and energy_db < floor + self.margin_db
+        self.n_skipped += silent
+        return silent
+
+    def silence_mask(self, frames: np.ndarray) -> np.ndarray:
+        "Vectorized is_silence over the rows of frame_audio's output"
+        x = frames.astype(np.float32)
+        energy_db = 10 * np.log10(np.einsum("ij,ij->i", x, x) / blocksize + 1)
+
+        t = np.arange(self.n_frames, self.n_frames + len(frames))
+        floor = self.floor.update_many(energy_db)
+
+        silent = (t >= self.warmup) & (energy_db < floor + self.margin_db)
+        self.n_skipped += int(silent.sum())
+        return silent
+
+    def summary(self) -> str:
+        fraction = self.n_skipped / max(self.n_frames, 1)
+        out = f"Energy gate skipped {self.n_skipped}/{self.n_frames} frames"
+        out += f" ({fraction:.0%})"
+        if self.audit:
+            out += f", {self.n_missed} of them scored as speech by the vad backend"
+        return out + "."
+
+
+class UtteranceBuffer:
+    """Growable preallocated float32 audio, written one int16 block at a time and
+    normalized to [-1, 1) on the way in. Views taken with view stay valid when the
+    buffer grows, since growing moves the samples to a new array."""
+
+    def __init__(self, capacity: int, head: np.ndarray | None = None):
+        "capacity is in blocks, head holds normalized samples to start out with"
+        self._samples = np.empty(max(capacity, 1) * blocksize, np.float32)
+        self.n_blocks = 0
+        if head is not None:
+            self.n_blocks = len(head) // blocksize
+            self._reserve(self.n_blocks)
+            self._samples[: len(head)] = head
+
+    def __len__(self) -> int:
+        return self.n_blocks
+
+    def _reserve(self, n_blocks: int):
+        if n_blocks * blocksize > len(self._samples):
+            n_samples = max(2 * len(self._samples), n_blocks * blocksize)
+            samples = np.empty(n_samples, np.float32)
+            samples[: len(self._samples)] = self._samples
+            self._samples = samples
+
+    def append(self, indata: np.ndarray):
+        self._reserve(self.n_blocks + 1)
+        start = self.n_blocks * blocksize
+        np.multiply(
+            indata.reshape(-1),
+            np.float32(1 / 32768),
+            out=self._samples[start : start + blocksize],
+        )
+        self.n_blocks += 1
+
+    def view(self, start: int, end: int) -> np.ndarray:
+        "Samples of blocks [start, end)"
+        return self._samples[start * blocksize : end * blocksize]
+
+
+class Segment(t.NamedTuple):
+    audio: np.ndarray  # float32 in [-1, 1), shape (n,), see UtteranceBuffer
+    # False if the utterance continues in the next segment
+    final: bool = True
+    # number of samples at the start of audio repeated from the previous segment
+    overlap: int = 0
+    # the utterance so far, which may still continue, see Segmenter.end_early
+    provisional: bool = False
+    # provisional only so that its ctc is ready if the utterance ends with the same
+    # audio, not offered for endpointing
+    speculative: bool = False
+
+
+@dataclass
+class Segmenter:
+    "The online vad state machine, feed it one block at a time with run_frame"
+
+    voice_active_queue: aio.Queue[Segment]
+    config: VadConfig = field(default_factory=VadConfig)
+    # called when an utterance starts, before any of its segments are queued
+    on_voice: t.Callable[[], t.Any] | None = None
+
+    def __post_init__(self):
+        config = self.config
+        self.vad = get_backend(config.backend, config.aggressiveness)
+        self.gate = (
+            EnergyGate(config.gate_margin_db, audit=config.gate_audit)
+            if config.energy_gate
+            else None
+        )
+
+        self.decisions = deque[int](  # last n decisions of the vad backend
+            [0] * config.n_vad_decisions, maxlen=config.n_vad_decisions
+        )
+        self.current_vote = 0  # moving sum of vad decisions == sum(decisions)
+
+        history = config.front_padding + config.n_vad_decisions
+        self.tentative_buffer = deque[np.ndarray](maxlen=history)
+        self.tentative_speech = deque[int](maxlen=history)
+        # a new buffer is started for each part since emitted parts are views of it
+        self.buffer_blocks = min(config.max_segment_blocks, 256)
+        self.indata_buffer = UtteranceBuffer(0)
+        self.overlap = 0  # overlap of indata_buffer with the last emitted part
+        self.first_voiced = 0  # indices into indata_buffer
+        self.last_voiced = 0
+        self.silent_run = 0  # non-speech blocks since last_voiced
+        # the last provisional segment and the length of indata_buffer when it was
+        # taken, None once the utterance has moved on
+        self.snapshot: tuple[Segment, int] | None = None
+        # the last view of indata_buffer taken by trimmed_view and its block range
+        self._trimmed: tuple[UtteranceBuffer, int, int, np.ndarray] | None = None
+
+        self.is_active = False
+
+        # blocks emitted and blocks trimmed from the segments before emitting them
+        self.n_emitted = 0
+        self.n_trimmed = 0
+
+    def is_speech(self, indata: np.ndarray) -> int:
+        gate = self.gate
+        if gate is not None and gate.is_silence(indata):
+            if gate.audit:
+                gate.n_missed += self.vad.is_speech(indata)
+            return 0
+        return int(self.vad.is_speech(indata))
+
+    def run_frame(self, indata: np.ndarray):
+        is_speech = self.is_speech(indata)
+        self.current_vote += is_speech - self.decisions.popleft()
+        self.decisions.append(is_speech)
+        self.tentative_buffer.append(indata)
+        self.tentative_speech.append(is_speech)
+
+        if self.is_active:
+            self.indata_buffer.append(indata)
+            if is_speech:
+                self.last_voiced = len(self.indata_buffer) - 1
+                self.silent_run = 0
+            else:
+                self.silent_run += 1
+
+            if self.current_vote <= self.config.off_threshold:
+                self.is_active = False
+                self.emit(final=True)
+            elif len(self.indata_buffer) >= self.config.max_segment_blocks:
+                self.emit(final=False)
+            elif self.silent_run == self.config.endpoint_blocks:
+                self.offer()
+            elif self.silent_run == self.config.speculate_blocks:
+                self.offer(speculative=True)
+
+        elif self.current_vote >= self.config.on_threshold:
+            self.is_active = True
+            if self.on_voice is not None:
+                self.on_voice()
+            self.indata_buffer = UtteranceBuffer(self.buffer_blocks)
+            for x in self.tentative_buffer:
+                self.indata_buffer.append(x)
+            voiced = np.flatnonzero(self.tentative_speech)
+            self.first_voiced, self.last_voiced = voiced[0], voiced[-1]
+            self.silent_run = len(self.tentative_speech) - 1 - voiced[-1]
+
+    def trim(self, final: bool) -> tuple[int, int]:
+        """Block range [start, end) of indata_buffer to emit. Only the first part of
+        an utterance is trimmed at the front, by an even number of blocks so that
+        the following parts stay on the model's frame grid, and only the final
+        part at the back, never into the audio shared with the previous part."""
+        margin = self.config.trim_margin_blocks
+        start, end = 0, len(self.indata_buffer)
+        if self.overlap == 0 and self.first_voiced > margin:
+            start = int(self.first_voiced - margin) // 2 * 2
+        if final and end > self.last_voiced + 1 + margin:
+            end = max(int(self.last_voiced + 1 + margin), self.overlap // blocksize)
+        return start, end
+
+    def trimmed_view(self, start: int, end: int) -> np.ndarray:
+        """indata_buffer.view(start, end), the same array as last time if the range
+        did not change, so that the ctc of a provisional segment can be reused for
+        the final one by identity of their audio"""
+        buffer = self.indata_buffer
+        if self._trimmed is not None and self._trimmed[:3] == (buffer, start, end):
+            return self._trimmed[3]
+        audio = buffer.view(start, end)
+        self._trimmed = buffer, start, end, audio
+        return audio
+
+    def offer(self, speculative: bool = False):
+        "Queue the utterance so far as a provisional segment"
+        audio = self.trimmed_view(*self.trim(final=True))
+        segment = Segment(audio, True, self.overlap, True, speculative)
+        self.voice_active_queue.put_nowait(segment)
+        self.snapshot = segment, len(self.indata_buffer)
+
+    def is_latest_offer(self, segment: Segment) -> bool:
+        "Whether segment is the provisional segment of the utterance so far"
+        return self.snapshot is not None and self.snapshot[0] is segment
+
+    def end_early(self, segment: Segment) -> bool:
+        """End the utterance with the provisional segment instead of waiting for the
+        vote to decay. Returns False, leaving the utterance open, if the segment is
+        not the latest one offered or speech resumed after it was taken."""
+        if not self.is_latest_offer(segment):
+            return False
+        if self.last_voiced >= self.snapshot[1]:
+            return False
+
+        offered = len(segment.audio) // blocksize
+        self.n_emitted += offered - self.overlap // blocksize
+        self.n_trimmed += len(self.indata_buffer) - offered
+        logger.debug(
+            f"Ended utterance {self.silent_run} blocks after the last voiced block."
+        )
+
+        self.is_active = False
+        self.overlap = 0
+        self.snapshot = None
+        # start over so that the hangover cannot reopen the utterance
+        self.decisions.extend([0] * self.config.n_vad_decisions)
+        self.current_vote = 0
+        self.tentative_buffer.clear()
+        self.tentative_speech.clear()
+        return True
+
+    def emit(self, final: bool):
+        self.snapshot = None
+        start, end = self.trim(final)
+        self.n_emitted += end - start - self.overlap // blocksize
+        self.n_trimmed += len(self.indata_buffer) - (end - start)
+        audio = self.trimmed_view(start, end)
+        self.voice_active_queue.put_nowait(Segment(audio, final, self.overlap))
+
+        if final:
+            self.overlap = 0
+        else:
+            overlap_blocks = self.config.overlap_blocks
+            self.indata_buffer = UtteranceBuffer(
+                self.buffer_blocks, audio[-overlap_blocks * blocksize :]
+            )
+            self.overlap = overlap_blocks * blocksize
+            self.last_voiced -= end - overlap_blocks
+
+    def trim_summary(self) -> str:
+        trimmed = self.n_trimmed * block_duration / 1000
+        total = trimmed + self.n_emitted * block_duration / 1000
+        out = f"Trimming saved {trimmed:.1f} s of {total:.1f} s of segmented audio"
+        return out + f" ({trimmed / max(total, 1e-9):.0%})."
+
+
+def frame_audio(audio: np.ndarray) -> np.ndarray:
+    """Split 1d int16 audio into rows of blocksize samples. The result is a view of
+    audio unless the last frame has to be zero padded."""
+    audio = np.ascontiguousarray(audio).reshape(-1)
+    r = len(audio) % blocksize
+    if r:
+        audio = np.concatenate([audio, np.zeros(blocksize - r, audio.dtype)])
+    return audio.reshape(-1, blocksize)
+
+
+def vad_decisions(
+    frames: np.ndarray, vad: VadBackend, gate: EnergyGate | None = None
+) -> np.ndarray:
+    "Decisions of the vad backend for each row of frame_audio's output"
+    if gate is None:
+        return vad.decisions(frames)
+    decisions = np.zeros(len(frames), np.int8)
+    candidates = np.flatnonzero(~gate.silence_mask(frames))
+    decisions[candidates] = vad.decisions(frames[candidates])
+    return decisions
+
+
+def utterance_switches(
+    decisions: np.ndarray, config: VadConfig | None = None
+) -> list[tuple[int, int]]:
+    """The frames (on, off) at which Segmenter opens and closes each utterance for
+    the given sequence of vad decisions. An utterance still open at the end of the
+    decisions is not included, just like Segmenter never emits it."""
+    if config is None:
+        config = VadConfig()
+
+    n = config.n_vad_decisions
+    cumulative = np.concatenate([[0], np.cumsum(decisions, dtype=np.int64)])
+    votes = (
+        cumulative[1:] - cumulative[np.maximum(np.arange(len(decisions)) + 1 - n, 0)]
+    )
+
+    # only the frames where the state machine can switch matter
+    on_frames = np.flatnonzero(votes >= config.on_threshold)
+    off_frames = np.flatnonzero(votes <= config.off_threshold)
+
+    switches = list[tuple[int, int]]()
+    frame = 0
+    while True:
+        i = np.searchsorted(on_frames, frame)
+        if i == len(on_frames):
+            break
+        on = int(on_frames[i])
+        j = np.searchsorted(off_frames, on + 1)
+        if j == len(off_frames):
+            break
+        off = int(off_frames[j])
+        switches.append((on, off))
+        frame = off + 1
+    return switches
+
+
+def segment_decisions(
+    decisions: np.ndarray, config: VadConfig | None = None
+) -> list[tuple[int, int]]:
+    """Frame ranges [start, end) of the utterances that Segmenter would emit for the
+    given sequence of vad decisions, trimmed the same way but not split into parts
+    of at most max_segment_duration"""
+    if config is None:
+        config = VadConfig()
+
+    history = config.front_padding + config.n_vad_decisions
+    voiced = np.flatnonzero(decisions)
+    margin = config.trim_margin_blocks
+    max_blocks, overlap = config.max_segment_blocks, config.overlap_blocks
+
+    segments = list[tuple[int, int]]()
+    for on, off in utterance_switches(decisions, config):
+        start, end = max(0, on + 1 - history), off + 1
+
+        first_voiced = voiced[np.searchsorted(voiced, start)]
+        last_voiced = voiced[np.searchsorted(voiced, end) - 1]
+        trimmed_start = start
+        if first_voiced - start > margin:
+            trimmed_start += int(first_voiced - start - margin) // 2 * 2
+        trimmed_end = end
+        if end > last_voiced + 1 + margin:
+            trimmed_end = int(last_voiced + 1 + margin)
+        if end - start > max_blocks:
+            # the final part of a split utterance keeps the overlap in any case
+            stride = max_blocks - overlap
+            final_start = (
+                start + math.ceil((end - start - max_blocks) / stride) * stride
+            )
+            trimmed_end = max(trimmed_end, int(final_start) + overlap)
+        segments.append((trimmed_start, trimmed_end))
+    return segments
+
+
+def segment_audio(
+    audio: np.ndarray, config: VadConfig | None = None
+) -> list[tuple[int, int]]:
+    "Sample ranges [start, end) of the utterances Segmenter would emit for int16 audio"
+    if config is None:
+        config = VadConfig()
+
+    vad = get_backend(config.backend, config.aggressiveness)
+    gate = (
+        EnergyGate(config.gate_margin_db, audit=config.gate_audit)
+        if config.energy_gate
+        else None
+    )
+    decisions = vad_decisions(frame_audio(audio), vad, gate)
+    return [
+        (start * blocksize, end * blocksize)
+        for start, end in segment_decisions(decisions, config)
+    ]
@@ -0,0 +1,126 @@
+"Frame level speech detectors that the Segmenter can be configured with"
+
+import math
+from abc import ABC, abstractmethod
+
+import numpy as np
+import webrtcvad
+
+from vocoder.audio_source import block_duration, blocksize, sample_rate
+
+
+class NoiseFloor:
+    """Adaptive noise floor in dB. The floor follows the energy down immediately
+    and rises by at most rise_db per second, so speech does not drag it up."""
+
+    def __init__(self, rise_db: float = 0.5):
+        self.n_frames = 0
+        self._rise = rise_db * block_duration / 1000  # per frame
+        # floor at frame t == self._offset + t * self._rise
+        self._offset = math.inf
+
+    def update(self, energy_db: float) -> float:
+        "Floor after the frame with the given energy"
+        t = self.n_frames
+        self.n_frames += 1
+        self._offset = min(self._offset, energy_db - t * self._rise)
+        return self._offset + t * self._rise
+
+    def update_many(self, energy_db: np.ndarray) -> np.ndarray:
+        "Vectorized update over consecutive frames"
+        t = np.arange(self.n_frames, self.n_frames + len(energy_db))
+        self.n_frames += len(energy_db)
+        offsets = np.minimum.accumulate(energy_db - t * self._rise)
+        offsets = np.minimum(offsets, self._offset)
+        if len(offsets):
+            self._offset = offsets[-1]
+        return offsets + t * self._rise
+
+
+class VadBackend(ABC):
+    "Scores 16 kHz int16 blocks of shape (blocksize, 1) as speech or not"
+
+    @abstractmethod
+    def is_speech(self, indata: np.ndarray) -> bool:
+        raise NotImplementedError
+
+    def decisions(self, frames: np.ndarray) -> np.ndarray:
+        """Decisions for consecutive rows of frame_audio's output, with the same
+        result as calling is_speech on each of them"""
+        out = np.zeros(len(frames), np.int8)
+        for i, frame in enumerate(frames):
+            out[i] = self.is_speech(frame[:, None])
+        return out
+
+
+class WebrtcVad(VadBackend):
+    def __init__(self, aggressiveness: int = 3):
+        self.vad = webrtcvad.Vad(aggressiveness)
+
+    def is_speech(self, indata: np.ndarray) -> bool:
+        return self.vad.is_speech(indata.tobytes(), sample_rate)
+
+
+class SpectralVad(VadBackend):
+    """Scores a frame as speech if the energy in the speech band is more than
+    margin_db above its noise floor and the band's spectrum is not flat, as it is
+    for stationary noise. Higher aggressiveness raises the margin."""
+
+    band = (300, 3400)  # Hz
+    max_flatness = 0.5
+    warmup = 10  # frames before the floor is trusted
+
+    def __init__(self, aggressiveness: int = 3, floor_rise_db: float = 0.5):
+        self.margin_db = 6.0 + 2 * aggressiveness
+        self.floor = NoiseFloor(floor_rise_db)
+
+        self._window = np.hanning(blocksize).astype(np.float32)
+        self._scratch = np.empty(blocksize, np.float32)
+        frequencies = np.fft.rfftfreq(blocksize, 1 / sample_rate)
+        self._bins = np.flatnonzero(
+            (frequencies >= self.band[0]) & (frequencies <= self.band[1])
+        )
+
+    def _score(self, power: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        "Band energy in dB and spectral flatness of the rows of a power spectrum"
+        power = power[..., self._bins] + 1
+        energy_db = 10 * np.log10(power.mean(-1))
+        flatness = np.exp(np.log(power).mean(-1)) / power.mean(-1)
+        return energy_db, flatness
+
+    def is_speech(self, indata: np.ndarray) -> bool:
+        np.multiply(indata.reshape(-1), self._window, out=self._scratch)
+        spectrum = np.fft.rfft(self._scratch)
+        energy_db, flatness = self._score(spectrum.real**2 + spectrum.imag**2)
+
+        t = self.floor.n_frames
+        floor = self.floor.update(float(energy_db))
+        return bool(
+            t >= self.warmup
+            and energy_db > floor + self.margin_db
+            and flatness < self.max_flatness
+        )
+
+    def decisions(self, frames: np.ndarray) -> np.ndarray:
+        spectrum = np.fft.rfft(frames.astype(np.float32) * self._window)
+        energy_db, flatness = self._score(spectrum.real**2 + spectrum.imag**2)
+
+        t = np.arange(self.floor.n_frames, self.floor.n_frames + len(frames))
+        floor = self.floor.update_many(energy_db)
+        speech = (
+            (t >= self.warmup)
+            & (energy_db > floor + self.margin_db)
+            & (flatness < self.max_flatness)
+        )
+        return speech.astype(np.int8)
+
+
+backends = {"webrtc": WebrtcVad, "spectral": SpectralVad}
+
+
+def get_backend(name: str, aggressiveness: int = 3) -> VadBackend:
+    if name not in backends:
+        raise ValueError(
+            f"Unknown vad backend {name}, expected one of {list(backends)}"
+        )
+    return backends[name](aggressiveness)
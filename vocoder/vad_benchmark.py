@@ -0,0 +1,186 @@
+"""Measure the cost and endpointing latency of the vad backends on labelled
+recordings, run with python -m vocoder.vad_benchmark DIRECTORY"""
+
+import argparse
+import os
+import time
+import typing as t
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+import numpy as np
+
+from vocoder.audio_source import block_duration, read_pcm
+from vocoder.vad import VadConfig, frame_audio, utterance_switches
+from vocoder.vad_backends import backends, get_backend
+
+
+class Recording(t.NamedTuple):
+    name: str
+    audio: np.ndarray  # 16 kHz int16
+    speech: list[tuple[float, float]]  # labelled intervals of speech in seconds
+
+
+def read_labels(path: str | os.PathLike) -> list[tuple[float, float]]:
+    "Intervals of an Audacity label track export, one 'start\\tend\\tlabel' per line"
+    intervals = list[tuple[float, float]]()
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                start, end = line.split()[:2]
+                intervals.append((float(start), float(end)))
+    return sorted(intervals)
+
+
+def load_recordings(directory: str | os.PathLike) -> list[Recording]:
+    "Every WAV file in directory that has a label file with the same name"
+    recordings = list[Recording]()
+    for wav in sorted(Path(directory).glob("*.wav")):
+        labels = wav.with_suffix(".txt")
+        if labels.exists():
+            recordings.append(Recording(wav.stem, read_pcm(wav), read_labels(labels)))
+    return recordings
+
+
+@dataclass
+class BenchmarkResult:
+    backend: str
+    aggressiveness: int
+    n_frames: int = 0
+    cpu_time: float = 0.0  # seconds spent in the backend
+    # seconds from the labelled start of speech until the utterance is opened
+    onset_delays: list[float] = field(default_factory=list)
+    # seconds from the labelled end of speech until the utterance is emitted
+    end_delays: list[float] = field(default_factory=list)
+    n_missed: int = 0  # labelled intervals that no utterance overlaps
+    n_false: int = 0  # utterances that overlap no labelled interval
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.n_frames / max(self.cpu_time, 1e-9)
+
+    @property
+    def onset_delay(self) -> float:
+        return float(np.median(self.onset_delays)) if self.onset_delays else np.nan
+
+    @property
+    def end_delay(self) -> float:
+        return float(np.median(self.end_delays)) if self.end_delays else np.nan
+
+    def add(self, recording: Recording, config: VadConfig):
+        vad = get_backend(self.backend, self.aggressiveness)
+        frames = frame_audio(recording.audio)
+
+        # one block at a time, like the Segmenter
+        start = time.process_time()
+        decisions = np.array([vad.is_speech(frame[:, None]) for frame in frames])
+        self.cpu_time += time.process_time() - start
+        self.n_frames += len(frames)
+
+        block = block_duration / 1000
+        history = (config.front_padding + config.n_vad_decisions) * block
+        utterances = [
+            ((on + 1) * block, (off + 1) * block)
+            for on, off in utterance_switches(decisions, config)
+        ]
+
+        matched = set[int]()
+        for speech_start, speech_end in recording.speech:
+            overlapping = [
+                i
+                for i, (opened, closed) in enumerate(utterances)
+                if opened - history < speech_end and closed > speech_start
+            ]
+            if not overlapping:
+                self.n_missed += 1
+                continue
+            matched.update(overlapping)
+            self.onset_delays.append(utterances[overlapping[0]][0] - speech_start)
+            self.end_delays.append(utterances[overlapping[-1]][1] - speech_end)
+        self.n_false += len(utterances) - len(matched)
+
+
+def run_benchmark(
+    recordings: list[Recording],
+    candidates: t.Iterable[tuple[str, int]],
+    config: VadConfig | None = None,
+) -> list[BenchmarkResult]:
+    "Benchmark each (backend, aggressiveness) pair on all recordings"
+    if config is None:
+        config = VadConfig()
+
+    results = list[BenchmarkResult]()
+    for backend, aggressiveness in candidates:
+        result = BenchmarkResult(backend, aggressiveness)
+        backend_config = replace(config, backend=backend, aggressiveness=aggressiveness)
+        for recording in recordings:
+            result.add(recording, backend_config)
+        results.append(result)
+    return results
+
+
+def cheapest(
+    results: list[BenchmarkResult],
+    onset_budget: float,
+    end_budget: float,
+    max_missed: float = 0.05,
+) -> BenchmarkResult | None:
+    """The result with the highest throughput among those whose median delays are
+    within budget and that miss at most a max_missed fraction of the speech"""
+
+    def acceptable(result: BenchmarkResult) -> bool:
+        n_speech = result.n_missed + len(result.onset_delays)
+        return (
+            result.onset_delay <= onset_budget
+            and result.end_delay <= end_budget
+            and result.n_missed <= max_missed * n_speech
+        )
+
+    acceptable_results = [result for result in results if acceptable(result)]
+    if not acceptable_results:
+        return None
+    return max(acceptable_results, key=lambda result: result.frames_per_second)
+
+
+def format_results(results: list[BenchmarkResult]) -> str:
+    lines = [
+        f"{'backend':<10}{'aggr':>5}{'frames/s':>12}{'cpu s':>8}"
+        f"{'onset ms':>10}{'end ms':>8}{'missed':>8}{'false':>7}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r.backend:<10}{r.aggressiveness:>5}{r.frames_per_second:>12.0f}"
+            f"{r.cpu_time:>8.2f}{r.onset_delay * 1000:>10.0f}"
+            f"{r.end_delay * 1000:>8.0f}{r.n_missed:>8}{r.n_false:>7}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "directory", help="WAV files, each with an Audacity label file of its speech"
+    )
+    parser.add_argument("--backend", nargs="+", default=list(backends))
+    parser.add_argument("--aggressiveness", nargs="+", type=int, default=[0, 1, 2, 3])
+    parser.add_argument("--onset-budget", type=float, default=0.3, help="seconds")
+    parser.add_argument("--end-budget", type=float, default=0.6, help="seconds")
+    args = parser.parse_args()
+
+    recordings = load_recordings(args.directory)
+    if not recordings:
+        parser.error(f"no labelled recordings in {args.directory}")
+
+    candidates = [(b, a) for b in args.backend for a in args.aggressiveness]
+    results = run_benchmark(recordings, candidates)
+    print(format_results(results))
+
+    best = cheapest(results, args.onset_budget, args.end_budget)
+    if best is None:
+        print("No backend meets the latency budget.")
+    else:
+        print(f"Cheapest within budget: {best.backend} {best.aggressiveness}")
+
+
+if __name__ == "__main__":
+    main()